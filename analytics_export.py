@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+import db_setup
+
+"""
+Exports tables for analytics to compressed Parquet files, so reports don't run on the production tables.
+
+Every run exports the rows that changed since the previous run, per table keyed on a timestamp
+column (EXPORT_TABLES), into a new file <output>/<table>/<table>-<until>.parquet. The export
+position per table is kept in <output>/watermarks.json and only moves once a file is complete,
+so a failed run is simply repeated by the next one. Updated listings show up again in a later
+file, take the row with the latest updated_at per id.
+
+- Reads from the first replica in DATABASE_REPLICAS when there is one (--from-primary to override)
+- Rows are streamed through a server-side cursor, CHUNK_ROWS at a time, and every chunk becomes
+  a Parquet row group, so memory use doesn't depend on the table size
+- The time range is exported in slices of --slice-hours, each in its own short read-only
+  transaction, so no transaction stays open for the whole export
+- Rows newer than SETTLE_SECONDS are left for the next run, a transaction that started
+  earlier may still commit rows with older timestamps
+
+Needs pyarrow (pip install pyarrow), which the API itself doesn't use.
+Run with: python analytics_export.py --output exports
+          python analytics_export.py --output exports --tables listing_bids --full
+"""
+
+
+# table: timestamp column the incremental export is keyed on
+EXPORT_TABLES = {
+    "listings": "updated_at",
+    "listing_bids": "bid_at",
+    "listing_views": "viewed_at",
+    "user_ratings": "reviewed_at",
+}
+CHUNK_ROWS = 50_000
+SETTLE_SECONDS = 60
+WATERMARKS_FILE = "watermarks.json"
+
+
+def arrow_type(type_code):
+    """
+    The Arrow type for a Postgres type oid, values of unknown types are exported as text.
+    """
+    import pyarrow as pa
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1700: pa.float64(),
+        1082: pa.date32(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="UTC"),
+    }.get(type_code, pa.string())
+
+
+def arrow_schema(description):
+    import pyarrow as pa
+    return pa.schema([(column.name, arrow_type(column.type_code)) for column in description])
+
+
+def to_record_batch(rows, schema):
+    import pyarrow as pa
+    columns = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_string(field.type):
+            values = [None if value is None else str(value) for value in values]
+        elif pa.types.is_floating(field.type):
+            values = [None if value is None else float(value) for value in values]
+        columns.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def load_watermarks(output):
+    path = os.path.join(output, WATERMARKS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return {table: datetime.fromisoformat(value) for table, value in json.load(file).items()}
+
+
+def save_watermarks(output, watermarks):
+    path = os.path.join(output, WATERMARKS_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({table: value.isoformat() for table, value in watermarks.items()}, file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def export_range(connection, table, column, start, end, slice_size):
+    """
+    Yield RecordBatches with the rows of table where start < column <= end, one slice of
+    the range per read-only transaction, streamed through a server-side cursor.
+    """
+    slice_start = start
+    while slice_start < end:
+        slice_end = min(slice_start + slice_size, end)
+        with connection:
+            # Named cursors are server-side, rows come over CHUNK_ROWS at a time.
+            with connection.cursor(name=f"export_{table}") as cursor:
+                cursor.itersize = CHUNK_ROWS
+                cursor.execute(f"""
+                               SELECT * FROM {table}
+                               WHERE {column} > %s AND {column} <= %s
+                               ORDER BY {column};
+                               """, (slice_start, slice_end))
+                schema = None
+                while True:
+                    rows = cursor.fetchmany(CHUNK_ROWS)
+                    if not rows:
+                        break
+                    schema = schema or arrow_schema(cursor.description)
+                    yield to_record_batch(rows, schema)
+        slice_start = slice_end
+
+
+def export_table(connection, output, table, since, until, slice_size):
+    """
+    Write the rows changed between since and until to a new Parquet file.
+    Returns the number of rows written, no file is written when there are none.
+    """
+    import pyarrow.parquet as pq
+
+    column = EXPORT_TABLES[table]
+    directory = os.path.join(output, table)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table}-{until.strftime('%Y%m%dT%H%M%SZ')}.parquet")
+    writer = None
+    written = 0
+    try:
+        for batch in export_range(connection, table, column, since, until, slice_size):
+            if writer is None:
+                writer = pq.ParquetWriter(path + ".tmp", batch.schema, compression="zstd")
+            writer.write_batch(batch)
+            written += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(path + ".tmp", path)
+    return written
+
+
+def earliest_timestamp(connection, table):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""SELECT min({EXPORT_TABLES[table]}) FROM {table};""")
+            return cursor.fetchone()[0]
+
+
+def settled_until(connection):
+    """
+    The database's current time minus SETTLE_SECONDS, the database clock is the one the timestamps come from.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT now() - make_interval(secs => %s);""", (SETTLE_SECONDS,))
+            return cursor.fetchone()[0]
+
+
+def connect(from_primary=False):
+    if db_setup.replica_pools and not from_primary:
+        connection = psycopg2.connect(**db_setup.replica_pools[0].parameters)
+    else:
+        connection = psycopg2.connect(**db_setup.CONNECTION_PARAMETERS)
+    connection.set_session(readonly=True)
+    return connection
+
+
+def run_export(output, tables, full=False, slice_hours=24, from_primary=False):
+    os.makedirs(output, exist_ok=True)
+    watermarks = load_watermarks(output)
+    connection = connect(from_primary)
+    try:
+        until = settled_until(connection).astimezone(timezone.utc)
+        for table in tables:
+            since = None if full else watermarks.get(table)
+            if since is None:
+                since = earliest_timestamp(connection, table)
+                if since is None:
+                    print(f"{table}: empty")
+                    continue
+                # The range is exclusive at the start, begin just before the first row.
+                since -= timedelta(microseconds=1)
+            written = export_table(connection, output, table, since, until, timedelta(hours=slice_hours))
+            watermarks[table] = until
+            save_watermarks(output, watermarks)
+            print(f"{table}: {written} rows up to {until.isoformat()}")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export tables to Parquet files for analytics.")
+    parser.add_argument("--output", default="exports", help="Directory for the files and watermarks.")
+    parser.add_argument("--tables", nargs="+", choices=sorted(EXPORT_TABLES), default=list(EXPORT_TABLES))
+    parser.add_argument("--full", action="store_true", help="Ignore the watermarks and export everything again.")
+    parser.add_argument("--slice-hours", type=int, default=24, help="Time range per transaction.")
+    parser.add_argument("--from-primary", action="store_true", help="Read from the primary even if there are replicas.")
+    args = parser.parse_args()
+
+    run_export(args.output, args.tables, args.full, args.slice_hours, args.from_primary)
@@ -1,274 +1,571 @@
+import environment  # loads .env, keep it first
+import hashlib
+import logging
 import os
 import psycopg2
+import dashboard
+import db
+import http_cache
+import metrics
+import pricing_insights
+import query_timeouts
+import replicas
+import shipping_quotes
+import single_flight
 
-from db_setup import get_connection
-from fastapi import FastAPI, HTTPException, status
-from psycopg2.extras import RealDictCursor
-from schemas import (CountryCreate, CityCreate, UserCreate, UserDetailsCreate, 
-                     UserNotificationSettingsCreate, NewsletterFrequencyOptionCreate
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from compression import CompressionMiddleware
+from db_setup import close_pool, pooled_connection, primary_pool, replica_pools
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, status
+from load_shedding import LoadSheddingMiddleware
+from psycopg2.pool import PoolError
+from query_timeouts import QueryCancellationMiddleware
+from rate_limiting import RateLimitMiddleware
+from responses import FastJSONResponse, RawJSONResponse, dumps
+from schemas import (CountryCreate, CityCreate, UserCreate, UserDetailsCreate,
+                     UserNotificationSettingsCreate, NewsletterFrequencyOptionCreate,
+                     SavedListingCreate, UserDetailsUpdate, UserNotificationSettingsUpdate,
+                     ListingCreate, ListingPhotosDelete, ListingPhotosReorder
                      )
 
 
-app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
+# Readiness of this worker, see /health/ready.
+worker_state = {"ready": False}
+
+
+def warm_up():
+    """Load reference data and prepare the hot statements on every pool before taking traffic.
+    A database that is down is logged and not fatal, /health/ready reports it."""
+    try:
+        shipping_quotes.get_shipping_matrix()
+    except psycopg2.Error as error:
+        logger.warning("Could not load the shipping matrix: %s", error)
+    for pool in [primary_pool, *replica_pools]:
+        try:
+            pool.warm_up(db.warm_up)
+        except (psycopg2.Error, PoolError) as error:
+            logger.warning("Could not warm up the %s pool: %s", pool.name, error)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker process, so every worker gets its own pools, caches and threads.
+    shipping_quotes.start_listener()
+    replicas.start_monitor()
+    warm_up()
+    worker_state["ready"] = True
+    yield
+    # Uvicorn has stopped accepting connections and finished the requests in progress by now.
+    worker_state["ready"] = False
+    replicas.stop_monitor()
+    shipping_quotes.stop_listener()
+    close_pool()
+
+
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "100"))
+SINGLE_FLIGHT_REUSE_SECONDS = float(os.getenv("SINGLE_FLIGHT_REUSE_SECONDS", "0"))
+IDEMPOTENCY_KEY_TTL = timedelta(hours=int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24")))
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+# Middlewares run outermost-last: rate limiting, then load shedding, then compression,
+# then query cancellation on client disconnect.
+app.add_middleware(QueryCancellationMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(LoadSheddingMiddleware)
+app.add_middleware(RateLimitMiddleware)
+
+
+@app.exception_handler(PoolError)
+def pool_exhausted(request: Request, error: PoolError):
+    """No database connection became free in time, ask the client to come back later."""
+    return FastJSONResponse({"detail": "Service overloaded, try again later"},
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": "2"})
+
+@app.exception_handler(psycopg2.errors.QueryCanceled)
+def query_canceled(request: Request, error: psycopg2.errors.QueryCanceled):
+    """A query ran out of the route's statement_timeout, or was cancelled because the client left."""
+    route = query_timeouts.route_key(request)
+    if query_timeouts.client_disconnected(request):
+        metrics.increment("cancelled_queries", route=route)
+        return FastJSONResponse({"detail": "Client disconnected"}, status_code=499)
+    metrics.increment("query_timeouts", route=route, kind="statement")
+    return FastJSONResponse({"detail": "Database query took too long"},
+                            status_code=status.HTTP_504_GATEWAY_TIMEOUT)
+
+@app.exception_handler(psycopg2.errors.LockNotAvailable)
+def lock_not_available(request: Request, error: psycopg2.errors.LockNotAvailable):
+    """A write waited longer than the route's lock_timeout for a row another transaction holds."""
+    metrics.increment("query_timeouts", route=query_timeouts.route_key(request), kind="lock")
+    return FastJSONResponse({"detail": "Resource busy, try again later"},
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": "1"})
+
+@app.exception_handler(psycopg2.OperationalError)
+def database_unavailable(request: Request, error: psycopg2.OperationalError):
+    """The database can't be reached or dropped the connection. QueryCanceled and LockNotAvailable
+    are OperationalErrors too, but their own handlers above take precedence."""
+    metrics.increment("database_unavailable", route=query_timeouts.route_key(request))
+    return FastJSONResponse({"detail": "Database unavailable, try again later"},
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"Retry-After": "2"})
+
+
+def get_db(request: Request, response: Response):
+    """Lend a pooled connection to an endpoint for the duration of the request.
+    Reads go to a replica when one is configured and healthy, writes go to the primary
+    and keep the client's reads on the primary for a while (see replicas.py).
+    The connection gets the route's query timeouts, and its query is cancelled when the
+    client disconnects (see query_timeouts.py)."""
+    timeouts = query_timeouts.for_request(request)
+    if request.method in ("GET", "HEAD"):
+        with replicas.read_connection(request, timeouts) as connection:
+            with query_timeouts.cancel_on_disconnect(request, connection):
+                yield connection
+    else:
+        replicas.stick_to_primary(response)
+        with pooled_connection(timeouts) as connection:
+            with query_timeouts.cancel_on_disconnect(request, connection):
+                yield connection
+
+
+listing_flight = single_flight.SingleFlight("listing", SINGLE_FLIGHT_REUSE_SECONDS)
+listing_photos_flight = single_flight.SingleFlight("listing_photos", SINGLE_FLIGHT_REUSE_SECONDS)
+
+
+def read_coalesced(request, flight, key, function):
+    """Run function(connection) on a read connection, shared with concurrent identical reads
+    (see single_flight.py). The connection is only taken by the read that actually runs.
+    Clients that wrote recently read on their own, from the primary. The shared read isn't
+    cancelled when one of its clients disconnects, the others still wait for it."""
+    def load():
+        with replicas.read_connection(request, query_timeouts.for_request(request)) as connection:
+            return function(connection)
+    if replicas.is_sticky(request):
+        return load()
+    return flight.do(key, load)
+
+
+def run_idempotent(request, connection, idempotency_key, payload, write):
+    """Run write() and return its result once per Idempotency-Key. A retry with the same key
+    gets the stored response back after a single lookup, another request with a used key gets 422.
+    Only successful responses are stored, so failed requests can be retried as they are."""
+    if idempotency_key is None:
+        return write()
+    method, path = request.method, request.url.path
+    request_hash = hashlib.sha256(dumps(payload)).hexdigest()
+    stored = db.get_idempotent_response(connection, idempotency_key, method, path)
+    if stored:
+        if stored["request_hash"] != request_hash:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail="Idempotency-Key was already used for a different request")
+        metrics.increment("idempotent_replays", route=path)
+        return FastJSONResponse(stored["response_body"], status_code=stored["status_code"],
+                                headers={"Idempotent-Replayed": "true"})
+    result = write()
+    db.save_idempotent_response(connection, idempotency_key, method, path, request_hash,
+                                status.HTTP_200_OK, dumps(result).decode(), IDEMPOTENCY_KEY_TTL)
+    return result
+
+
+def parse_fields(fields):
+    """Split a comma separated fields= query parameter, None means all fields."""
+    if fields is None:
+        return None
+    return tuple(field.strip() for field in fields.split(",") if field.strip())
+
+
+# Health endpoints
+
+READINESS_POOL_TIMEOUT_SECONDS = 1
+
+@app.get("/health/live")
+async def liveness():
+    """The worker process is running and its event loop answers."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def readiness():
+    """Ready for traffic: warmed up, not shutting down, and the primary pool can lend a working connection."""
+    if not worker_state["ready"]:
+        return FastJSONResponse({"status": "unavailable", "reason": "starting or shutting down"},
+                                status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    try:
+        with primary_pool.connection(timeout=READINESS_POOL_TIMEOUT_SECONDS) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+    except PoolError:
+        return FastJSONResponse({"status": "unavailable", "reason": "connection pool exhausted"},
+                                status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except psycopg2.Error:
+        return FastJSONResponse({"status": "unavailable", "reason": "database unreachable"},
+                                status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return {
+        "status": "ready",
+        "replicas": len(replica_pools),
+        "healthy_replicas": len(replicas.healthy_replicas())
+    }
+
+
+# Metrics
+
+@app.get("/metrics")
+def get_metrics():
+    """Get the in-memory metrics of this worker process, e.g response sizes per route."""
+    return FastJSONResponse({**metrics.snapshot(), "single_flight_hot_keys": single_flight.hot_keys()})
 
 
 # Detail endpoints
 
 @app.get("/user/{id}")
-def get_user(id: int):
-    """Get a user by provided user_id."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM users
-                           WHERE id = %s;""", (id,))
-            result = cursor.fetchone()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-            return result
+def get_user(id: int, request: Request, connection=Depends(get_db)):
+    """Get a user by provided user_id. Supports If-None-Match / If-Modified-Since."""
+    version = db.get_user_version(connection, id)
+    if not version:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    validators = http_cache.make_validators(request, version)
+    if http_cache.is_not_modified(request, validators):
+        return http_cache.not_modified(validators, "user")
+    result = db.get_user(connection, id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return http_cache.apply_headers(FastJSONResponse(result), validators, "user")
 
 @app.get("/users")
-def list_users(limit: int = 25):
-    """List all users."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM users 
-                           LIMIT %s;""", (limit,))
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Users not found")
-            return result
+def list_users(limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE), fields: str | None = None,
+               connection=Depends(get_db)):
+    """List all users. Use fields=id,username to only get some of the columns."""
+    try:
+        result = db.list_users_json(connection, limit, parse_fields(fields))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Users not found")
+    return RawJSONResponse(result)
 
 @app.get("/user/{id}/newsletter_frequency")
-def get_user_newsletter_frequency_choice(id: int):
+def get_user_newsletter_frequency_choice(id: int, connection=Depends(get_db)):
     """Get a specific user's newsletter frequency setting."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT user_id, id, title
-                              FROM newsletter_frequency_options
-                              INNER JOIN user_email_notification_settings
-                              ON newsletter_frequency_options.id = user_email_notification_settings.newsletter_frequency_id
-                              WHERE user_id = %s;""", (id,))
-            result = cursor.fetchone()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-            return result
+    result = db.get_user_newsletter_frequency(connection, id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return FastJSONResponse(result)
 
 @app.get("/listing/{id}")
-def get_listing(id: int):
-    """Get a specific listing by listing_id."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM listings 
-                           WHERE id = %s;""", (id,))
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listing not found")
-            return result
+def get_listing(id: int, request: Request, include_deleted: bool = False, fields: str | None = None):
+    """Get a specific listing by listing_id. Soft deleted listings are only
+    returned when include_deleted is true. Use fields=id,title to only get some of the columns.
+    Supports If-None-Match / If-Modified-Since. Concurrent identical requests share their queries."""
+    fields = parse_fields(fields)
+    version = read_coalesced(request, listing_flight, ("version", id, include_deleted),
+                             lambda connection: db.get_listing_version(connection, id, include_deleted))
+    if not version:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listing not found")
+    validators = http_cache.make_validators(request, version)
+    if http_cache.is_not_modified(request, validators):
+        return http_cache.not_modified(validators, "listing")
+    try:
+        result = read_coalesced(request, listing_flight, ("listing", id, include_deleted, fields),
+                                lambda connection: db.get_listing(connection, id, include_deleted, fields))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listing not found")
+    return http_cache.apply_headers(FastJSONResponse(result), validators, "listing")
 
 @app.get("/listing/{id}/photos")
-def get_listing_photos(id: int):
-    """Get all photos that belongs to a specific listing_id."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM listing_photos 
-                           WHERE listing_id = %s;""", (id,))
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photos not found")
-            return result
+def get_listing_photos(id: int, request: Request):
+    """Get all photos that belongs to a specific listing_id. Supports If-None-Match / If-Modified-Since.
+    Concurrent identical requests share their queries."""
+    version = read_coalesced(request, listing_photos_flight, ("version", id),
+                             lambda connection: db.get_listing_photos_version(connection, id))
+    if not version:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photos not found")
+    validators = http_cache.make_validators(request, version)
+    if http_cache.is_not_modified(request, validators):
+        return http_cache.not_modified(validators, "listing_photos")
+    result = read_coalesced(request, listing_photos_flight, ("photos", id),
+                            lambda connection: db.get_listing_photos_json(connection, id))
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photos not found")
+    return http_cache.apply_headers(RawJSONResponse(result), validators, "listing_photos")
 
 @app.get("/listings/photos")
-def list_listing_photos():
-    """List all listing photos."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM listing_photos;""")
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photos not found")
-            return result
+def list_listing_photos(limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE), after_id: int = 0,
+                        connection=Depends(get_db)):
+    """List all listing photos, ordered by id. Pass the last id you got as after_id to get the next page."""
+    result = db.list_listing_photos_json(connection, limit, after_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photos not found")
+    return RawJSONResponse(result)
 
 @app.get("/listings")
-def list_listings(limit: int = 25):
-    """List all listings."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM listings 
-                           LIMIT %s;""", (limit,))
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listings not found")
-            return result
+def list_listings(limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE), include_deleted: bool = False,
+                  fields: str | None = None, connection=Depends(get_db)):
+    """List all listings. Soft deleted listings are only included when include_deleted is true.
+    Use fields=id,title to only get some of the columns."""
+    try:
+        result = db.list_listings_json(connection, limit, include_deleted, parse_fields(fields))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listings not found")
+    return RawJSONResponse(result)
+
+@app.get("/listings/trending")
+def list_trending_listings(limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE), category_id: int | None = None,
+                           connection=Depends(get_db)):
+    """List the listings with the most recent views, bids and saves, optionally within one category.
+    Scores are recomputed in the background by trending.py."""
+    result = db.list_trending_listings_json(connection, limit, category_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trending listings not found")
+    return RawJSONResponse(result)
 
 @app.get("/user/{user_id}/recieved-ratings")
-def get_received_ratings(user_id: int):
+def get_received_ratings(user_id: int, connection=Depends(get_db)):
     """Get all ratings a specific user_id has received."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                           SELECT user_id, listing_id, reviewing_user_id, reviewed_at, 
-                                  positive_review, review_comment, listing_description_rating, 
-                                  listing_communication_rating, listing_delivery_time_rating
-                           FROM listings
-                           INNER JOIN user_ratings
-                           ON listings.id = user_ratings.listing_id
-                           WHERE user_id = %s;
-                           """, (user_id,))
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ratings not found")
-            return result
+    result = db.get_received_ratings(connection, user_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ratings not found")
+    return FastJSONResponse(result)
 
 @app.get("/user/{id}/provided-ratings")
-def get_provided_ratings(user_id: int):
+def get_provided_ratings(user_id: int, connection=Depends(get_db)):
     """Get all ratings a specific user has given another user."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                           SELECT * 
-                           FROM user_ratings
-                           WHERE reviewing_user_id = %s;
-                           """, (user_id,))
-            result = cursor.fetchone()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ratings not found")
-            return result
+    result = db.get_provided_ratings(connection, user_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ratings not found")
+    return FastJSONResponse(result)
+
+@app.get("/user/{id}/dashboard")
+async def get_user_dashboard(id: int, request: Request):
+    """Get a seller's dashboard: active listings with bid and view counts, unread messages and
+    rating summary. Parts that time out are null and listed under 'missing'."""
+    result = await dashboard.build_dashboard(request, id)
+    if result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    if len(result["missing"]) == len(dashboard.COMPONENTS):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Dashboard unavailable",
+                            headers={"Retry-After": "2"})
+    return FastJSONResponse(result)
 
 @app.get("/ratings")
-def list_ratings(limit: int = 25):
-    """List all ratings."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""SELECT * FROM user_ratings 
-                              LIMIT %s;""", (limit,))
-            result = cursor.fetchall()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ratings not found")
-            return result
+def list_ratings(limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE), fields: str | None = None,
+                 connection=Depends(get_db)):
+    """List all ratings. Use fields=listing_id,positive_review to only get some of the columns."""
+    try:
+        result = db.list_ratings_json(connection, limit, parse_fields(fields))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ratings not found")
+    return RawJSONResponse(result)
+
+@app.get("/user/{user_id}/saved-listings")
+def list_saved_listings(user_id: int, limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE),
+                        after_listing_id: int = 0, connection=Depends(get_db)):
+    """List a user's saved listings with current status, price or highest bid and first photo.
+    Pages by listing_id: pass the returned next_after_listing_id to get the next page."""
+    result = db.list_saved_listings(connection, user_id, limit, after_listing_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Saved listings not found")
+    return FastJSONResponse({
+        "items": result,
+        "next_after_listing_id": result[-1]["listing_id"] if len(result) == limit else None
+    })
+
+
+# Location endpoints
+# Listings are located by their seller's user_details. Counts are kept up to date by triggers,
+# so these pages cost the same however many listings there are.
+
+@app.get("/locations")
+def list_country_listing_counts(connection=Depends(get_db)):
+    """List the countries with active listings and how many there are, most listings first."""
+    result = db.list_country_listing_counts(connection)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Locations not found")
+    return FastJSONResponse(result)
+
+@app.get("/locations/{country_id}")
+def list_city_listing_counts(country_id: int, connection=Depends(get_db)):
+    """List the cities of a country with active listings and how many there are.
+    city_id 0 counts the listings of sellers without a city."""
+    result = db.list_city_listing_counts(connection, country_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Locations not found")
+    return FastJSONResponse({"country_id": country_id, "cities": result})
+
+@app.get("/listings/by-location")
+def list_listings_by_location(country_id: int | None = None, city_id: int | None = None,
+                              limit: int = Query(25, ge=1, le=MAX_PAGE_SIZE), after_id: int = 0,
+                              fields: str | None = None, connection=Depends(get_db)):
+    """List the active listings of sellers in a city (city_id) or country (country_id), ordered by id.
+    Pass the last id you got as after_id to get the next page. Use fields=id,title to only get some of the columns."""
+    if country_id is None and city_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Give a country_id or city_id")
+    try:
+        result = db.list_listings_by_location_json(connection, limit, after_id, country_id, city_id,
+                                                   parse_fields(fields))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listings not found")
+    return RawJSONResponse(result)
+
+
+# Pricing endpoints
+
+@app.get("/pricing-insights")
+def get_pricing_insights(category_id: int, option_id: list[int] = Query([]), connection=Depends(get_db)):
+    """Get price percentiles (p10-p90) per price kind for a category, narrowed down by the
+    category filter options given as option_id, and a suggested price for a new listing.
+    Rollups are recomputed in the background by pricing_insights.py."""
+    rows = db.get_price_rollups(connection, category_id, option_id)
+    chosen = pricing_insights.choose_rollups(rows)
+    if not chosen:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No pricing data for this category")
+    return FastJSONResponse({
+        "category_id": category_id,
+        "suggested_price": pricing_insights.suggest_price(chosen),
+        "prices": chosen
+    })
+
+
+# Shipping endpoints
+
+@app.get("/shipping-quotes")
+def get_shipping_quotes(product_weight_id: int, product_size_id: int | None = None,
+                        shipping_range_id: int | None = None):
+    """Get shipping options for a weight (and optionally size and range), cheapest first."""
+    try:
+        return shipping_quotes.quote_shipping(product_weight_id, product_size_id, shipping_range_id)
+    except LookupError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
+
+@app.get("/listing/{id}/shipping-quotes")
+def get_listing_shipping_quotes(id: int, connection=Depends(get_db)):
+    """Get shipping options for a specific listing, including the seller's packaging fee
+    and own shipping cost, cheapest first."""
+    settings = db.get_listing_shipping_settings(connection, id)
+    if not settings:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Shipping settings not found")
+    try:
+        quote = shipping_quotes.quote_shipping(
+            settings["product_weight_id"], settings["product_size_id"], settings["shipping_range_id"],
+            packaging_fee=settings["packaging_fee"],
+            seller_company_id=settings["shipping_company_id"],
+            user_shipping_cost=settings["user_shipping_cost"]
+        )
+    except LookupError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
+    return {"listing_id": id, **quote}
 
 
 # Delete endpoints
 
 @app.delete("/listing/photos/{id}")
-def delete_listing_photo(id: int):
+def delete_listing_photo(id: int, connection=Depends(get_db)):
     """Delete a specific listing photo by photo id."""
-    connection = get_connection()
-    with connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""DELETE FROM listing_photos 
-                              WHERE id = %s
-                              RETURNING id;""", (id,))
-            result = cursor.fetchone()
-            if not result:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
-            return {"message": f"Photo with ID {id} was deleted."}
+    result = db.delete_listing_photo(connection, id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
+    return {"message": f"Photo with ID {id} was deleted."}
+
+@app.delete("/listing/{id}/photos")
+def delete_listing_photos(id: int, photos_input: ListingPhotosDelete, connection=Depends(get_db)):
+    """Delete several photos of a listing at once. Either all given photos are deleted or,
+    when one of them isn't a photo of this listing owned by user_id, none are."""
+    result = db.delete_listing_photos(connection, id, photos_input.user_id, photos_input.photo_ids)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Photos not found on this listing or listing not owned by user")
+    return {"listing_id": id, "deleted_photo_ids": result}
+
+@app.delete("/listing/{id}")
+def delete_listing(id: int, connection=Depends(get_db)):
+    """Soft delete a specific listing by listing_id.
+    The listing is moved to the archive tables later by listing_purge.py."""
+    result = db.soft_delete_listing(connection, id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Listing not found")
+    return {"message": f"Listing with ID {id} was deleted."}
+
+@app.delete("/user/{user_id}/saved-listings/{listing_id}")
+def delete_saved_listing(user_id: int, listing_id: int, connection=Depends(get_db)):
+    """Remove a listing from a user's saved listings."""
+    result = db.delete_saved_listing(connection, user_id, listing_id)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Saved listing not found")
+    return {"message": f"Listing with ID {listing_id} was removed from saved listings."}
 
 
 # Post endpoints
 
 @app.post("/countries")
-def create_country(country_input: CountryCreate):
+def create_country(country_input: CountryCreate, connection=Depends(get_db)):
     """Create a new country in the 'countries' table.
     Returns the newly created country object with its id."""
-    with get_connection() as connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                cursor.execute("""
-                               INSERT INTO countries(name)
-                               VALUES (%s)
-                               RETURNING id;
-                               """, (country_input.name,)
-                               )
-                inserted = cursor.fetchone()
-            except psycopg2.errors.UniqueViolation:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Country already exists")
+    try:
+        inserted_id = db.add_country(connection, country_input.name)
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Country already exists")
     return {
-        "id": inserted["id"],
+        "id": inserted_id,
         "name": country_input.name
     }
 
 @app.post("/cities")
-def create_city(city_input: CityCreate):
+def create_city(city_input: CityCreate, connection=Depends(get_db)):
     """Create a new city in the 'cities' table.
     Returns the newly created city object with its id."""
-    with get_connection() as connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                cursor.execute("""
-                               INSERT INTO cities(name, country_id)
-                               VALUES (%s, %s)
-                               RETURNING id;
-                               """, (city_input.name, city_input.country_id)
-                               )
-                inserted = cursor.fetchone()
-            except psycopg2.errors.UniqueViolation:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="City already exists")
+    try:
+        inserted_id = db.add_city(connection, city_input.name, city_input.country_id)
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="City already exists")
     return {
-        "id": inserted["id"],
+        "id": inserted_id,
         "name": city_input.name,
         "country_id": city_input.country_id
     }
 
 @app.post("/users")
-def create_user(user_input: UserCreate):
+def create_user(user_input: UserCreate, connection=Depends(get_db)):
     """Create a new user in the 'users' table.
     Returns the newly created user object with its id."""
-    with get_connection() as connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                cursor.execute("""
-                               INSERT INTO users(username, email)
-                               VALUES (%s, %s)
-                               RETURNING id;
-                               """, (user_input.username, user_input.email)
-                               )
-                inserted = cursor.fetchone()
-            except psycopg2.errors.UniqueViolation:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists")
+    try:
+        inserted_id = db.add_user(connection, user_input.username, user_input.email)
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists")
     return {
-        "id": inserted["id"],
+        "id": inserted_id,
         "username": user_input.username,
         "email": user_input.email
     }
 
 @app.post("/user_details")
-def create_user_details(user_details_input: UserDetailsCreate):
+def create_user_details(user_details_input: UserDetailsCreate, connection=Depends(get_db)):
     """Create new user details in the 'user_details' table.
     Returns the newly created user_details object."""
-    with get_connection() as connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                cursor.execute("""
-                               INSERT INTO user_details(
-                                   user_id, first_name, last_name, phone, 
-                                   street_address, zip_code, city_id, 
-                                   country_id, is_company
-                               )
-                               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                               ;
-                               """, (user_details_input.user_id, 
-                                     user_details_input.first_name, 
-                                     user_details_input.last_name, 
-                                     user_details_input.phone, 
-                                     user_details_input.street_address, 
-                                     user_details_input.zip_code, 
-                                     user_details_input.city_id, 
-                                     user_details_input.country_id, 
-                                     user_details_input.is_company
-                                     )
-                               )
-            except psycopg2.errors.UniqueViolation:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User doesn't exists")
+    try:
+        db.add_user_details(connection, user_details_input.user_id,
+                            user_details_input.first_name,
+                            user_details_input.last_name,
+                            user_details_input.phone,
+                            user_details_input.street_address,
+                            user_details_input.zip_code,
+                            user_details_input.city_id,
+                            user_details_input.country_id,
+                            user_details_input.is_company
+                            )
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User details already exist")
+    except psycopg2.errors.ForeignKeyViolation:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User, city or country not found")
     return {
         "user_id": user_details_input.user_id,
         "first_name": user_details_input.first_name,
@@ -281,59 +578,83 @@ def create_user_details(user_details_input: UserDetailsCreate):
         "is_company": user_details_input.is_company
     }
 
+@app.post("/user/{user_id}/saved-listings")
+def create_saved_listing(user_id: int, saved_listing_input: SavedListingCreate,
+                         connection=Depends(get_db)):
+    """Add a listing to a user's saved listings in the 'user_saved_listings' table.
+    Saving an already saved listing does nothing."""
+    try:
+        db.add_saved_listing(connection, user_id, saved_listing_input.listing_id)
+    except psycopg2.errors.ForeignKeyViolation:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User or listing not found")
+    return {
+        "user_id": user_id,
+        "listing_id": saved_listing_input.listing_id
+    }
+
+@app.post("/listings")
+def create_listing(listing_input: ListingCreate, connection=Depends(get_db)):
+    """Create a listing with its auction and/or buy-now attributes, shipping settings, category
+    filter options and photos in one transaction. Returns the created listing with all of its parts."""
+    photos = [(photo.url, photo.view_order if photo.view_order is not None else position)
+              for position, photo in enumerate(listing_input.photos, start=1)]
+    try:
+        return db.create_listing(
+            connection,
+            listing_input.model_dump(include={"user_id", "title", "description", "pickup_available",
+                                              "buyer_insurance", "type_id", "status_id", "category_id"}),
+            auction=listing_input.auction.model_dump() if listing_input.auction else None,
+            buy_now=listing_input.buy_now.model_dump() if listing_input.buy_now else None,
+            shipping=listing_input.shipping.model_dump() if listing_input.shipping else None,
+            category_filter_option_ids=listing_input.category_filter_option_ids,
+            photos=photos
+        )
+    except psycopg2.errors.ForeignKeyViolation as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=error.diag.message_detail)
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Photo url already in use")
+
 @app.post("/newsletter_frequency_options")
-def create_newsletter_frequency_options(newsletter_frequency_options_input: NewsletterFrequencyOptionCreate):
+def create_newsletter_frequency_options(newsletter_frequency_options_input: NewsletterFrequencyOptionCreate,
+                                        connection=Depends(get_db)):
     """Create a new newsletter frequency option in the 'newsletter_frequency_options' table.
     Returns the newly created newsletter frequency option object with its id."""
-    with get_connection() as connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                cursor.execute("""
-                               INSERT INTO newsletter_frequency_options(title)
-                               VALUES (%s)
-                               RETURNING id;
-                               """, (newsletter_frequency_options_input.title,)
-                               )
-                inserted = cursor.fetchone()
-            except psycopg2.errors.UniqueViolation:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Option already exists")
+    try:
+        inserted_id = db.add_newsletter_frequency_option(connection,
+                                                         newsletter_frequency_options_input.title,
+                                                         newsletter_frequency_options_input.send_interval,
+                                                         newsletter_frequency_options_input.starts_after)
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Option already exists")
     return {
-        "id": inserted["id"],
-        "title": newsletter_frequency_options_input.title
+        "id": inserted_id,
+        "title": newsletter_frequency_options_input.title,
+        "send_interval": newsletter_frequency_options_input.send_interval,
+        "starts_after": newsletter_frequency_options_input.starts_after
     }
 
 @app.post("/user_notification_settings")
-def create_user_notification_settings(user_notification_settings_input: UserNotificationSettingsCreate):
+def create_user_notification_settings(user_notification_settings_input: UserNotificationSettingsCreate,
+                                      connection=Depends(get_db)):
     """Create new user notification_settings in the 'user_email_notification_settings' table.
     Returns the newly created user_email_notification_settings object."""
-    with get_connection() as connection:
-        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                cursor.execute("""
-                               INSERT INTO user_email_notification_settings(
-                                   user_id, upon_new_device_login, 
-                                   copy_read_messages, favorites_list_updates, 
-                                   upon_missing_payment, upon_failed_auction, 
-                                   upon_bid_exceeding_starting_price, 
-                                   other_companies_promotions, newsletters, 
-                                   newsletter_frequency_id
-                               )
-                               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                               ;
-                               """, (user_notification_settings_input.user_id,
-                                     user_notification_settings_input.upon_new_device_login,
-                                     user_notification_settings_input.copy_read_messages,
-                                     user_notification_settings_input.favorites_list_updates,
-                                     user_notification_settings_input.upon_missing_payment,
-                                     user_notification_settings_input.upon_failed_auction,
-                                     user_notification_settings_input.upon_bid_exceeding_starting_price,
-                                     user_notification_settings_input.other_companies_promotions,
-                                     user_notification_settings_input.newsletters,
-                                     user_notification_settings_input.newsletter_frequency_id
-                                     )
-                               )
-            except psycopg2.errors.UniqueViolation:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists")
+    try:
+        db.add_user_notification_settings(connection,
+                                          user_notification_settings_input.user_id,
+                                          user_notification_settings_input.upon_new_device_login,
+                                          user_notification_settings_input.copy_read_messages,
+                                          user_notification_settings_input.favorites_list_updates,
+                                          user_notification_settings_input.upon_missing_payment,
+                                          user_notification_settings_input.upon_failed_auction,
+                                          user_notification_settings_input.upon_bid_exceeding_starting_price,
+                                          user_notification_settings_input.other_companies_promotions,
+                                          user_notification_settings_input.newsletters,
+                                          user_notification_settings_input.newsletter_frequency_id
+                                          )
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Notification settings already exist")
+    except psycopg2.errors.ForeignKeyViolation:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User or newsletter frequency not found")
     return {
         "user_id": user_notification_settings_input.user_id,
         "upon_new_device_login": user_notification_settings_input.upon_new_device_login,
@@ -345,4 +666,66 @@ def create_user_notification_settings(user_notification_settings_input: UserNoti
         "other_companies_promotions": user_notification_settings_input.other_companies_promotions,
         "newsletters": user_notification_settings_input.newsletters,
         "newsletter_frequency_id": user_notification_settings_input.newsletter_frequency_id
-    }
\ No newline at end of file
+    }
+
+
+# Put endpoints
+# Create or replace a user's row in one statement. Send an Idempotency-Key header to make
+# retries replay the first response instead of writing again.
+
+@app.put("/user/{user_id}/details")
+def put_user_details(user_id: int, user_details_input: UserDetailsUpdate, request: Request,
+                     idempotency_key: str | None = Header(None, max_length=200),
+                     connection=Depends(get_db)):
+    """Create or replace a user's details in the 'user_details' table.
+    Returns the stored user_details object."""
+    def write():
+        try:
+            return db.upsert_user_details(connection, user_id,
+                                          user_details_input.first_name,
+                                          user_details_input.last_name,
+                                          user_details_input.phone,
+                                          user_details_input.street_address,
+                                          user_details_input.zip_code,
+                                          user_details_input.city_id,
+                                          user_details_input.country_id,
+                                          user_details_input.is_company
+                                          )
+        except psycopg2.errors.ForeignKeyViolation:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User, city or country not found")
+    return run_idempotent(request, connection, idempotency_key,
+                          {"user_id": user_id, **user_details_input.model_dump()}, write)
+
+@app.put("/user/{user_id}/notification_settings")
+def put_user_notification_settings(user_id: int, user_notification_settings_input: UserNotificationSettingsUpdate,
+                                   request: Request, idempotency_key: str | None = Header(None, max_length=200),
+                                   connection=Depends(get_db)):
+    """Create or replace a user's settings in the 'user_email_notification_settings' table.
+    Returns the stored user_email_notification_settings object."""
+    def write():
+        try:
+            return db.upsert_user_notification_settings(connection, user_id,
+                                                        user_notification_settings_input.upon_new_device_login,
+                                                        user_notification_settings_input.copy_read_messages,
+                                                        user_notification_settings_input.favorites_list_updates,
+                                                        user_notification_settings_input.upon_missing_payment,
+                                                        user_notification_settings_input.upon_failed_auction,
+                                                        user_notification_settings_input.upon_bid_exceeding_starting_price,
+                                                        user_notification_settings_input.other_companies_promotions,
+                                                        user_notification_settings_input.newsletters,
+                                                        user_notification_settings_input.newsletter_frequency_id
+                                                        )
+        except psycopg2.errors.ForeignKeyViolation:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User or newsletter frequency not found")
+    return run_idempotent(request, connection, idempotency_key,
+                          {"user_id": user_id, **user_notification_settings_input.model_dump()}, write)
+
+@app.put("/listing/{id}/photos/order")
+def reorder_listing_photos(id: int, photos_input: ListingPhotosReorder, connection=Depends(get_db)):
+    """Reorder all photos of a listing in one go: photo_ids lists every photo of the listing,
+    in the new order. Returns the photos with their new view_order."""
+    result = db.reorder_listing_photos(connection, id, photos_input.user_id, photos_input.photo_ids)
+    if not result:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="photo_ids must list every photo of a listing owned by user_id exactly once")
+    return {"listing_id": id, "photos": result}
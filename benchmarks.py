@@ -0,0 +1,241 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import db
+import responses
+from db_setup import get_connection
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+"""
+Small benchmark suite for the data-access layer.
+
+- queries: runs every read query in db.py as a plain query and as a prepared statement
+  on the same connection and prints a timing table per query.
+- serialization: compares the ways of turning a large page into a JSON body: RealDictCursor rows through
+  jsonable_encoder and the json module (FastAPI's default), the same rows through orjson
+  (responses.FastJSONResponse), and JSON built by Postgres with json_agg (responses.RawJSONResponse).
+- startup: cold starts of the app in fresh interpreters: import time per module (python -X importtime),
+  and time to import the app, run the lifespan (warm-up) and answer the first request.
+
+Needs a database with the tables from db_setup.py (and preferably the fictive data).
+Run with: python benchmarks.py queries --iterations 500
+          python benchmarks.py serialization --iterations 50 --limit 1000
+          python benchmarks.py startup --runs 5
+"""
+
+
+def sample_ids(connection):
+    """
+    Pick a user and a listing that exist, so the lookups return rows.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT min(id) FROM users;""")
+            user_id = cursor.fetchone()[0] or 1
+            cursor.execute("""SELECT min(id) FROM listings WHERE NOT soft_deleted;""")
+            listing_id = cursor.fetchone()[0] or 1
+    return user_id, listing_id
+
+
+def read_queries(user_id, listing_id):
+    """
+    The read queries behind the GET endpoints, as (name, function(connection)) pairs.
+    """
+    return [
+        ("get_user", lambda con: db.get_user(con, user_id)),
+        ("list_users", lambda con: db.list_users(con, 25)),
+        ("get_user_newsletter_frequency", lambda con: db.get_user_newsletter_frequency(con, user_id)),
+        ("get_listing", lambda con: db.get_listing(con, listing_id)),
+        ("list_listings", lambda con: db.list_listings(con, 25)),
+        ("get_listing_photos", lambda con: db.get_listing_photos(con, listing_id)),
+        ("list_listing_photos", lambda con: db.list_listing_photos(con, 25)),
+        ("get_listing_shipping_settings", lambda con: db.get_listing_shipping_settings(con, listing_id)),
+        ("list_saved_listings", lambda con: db.list_saved_listings(con, user_id, 25, 0)),
+        ("get_received_ratings", lambda con: db.get_received_ratings(con, user_id)),
+        ("list_ratings", lambda con: db.list_ratings(con, 25)),
+    ]
+
+
+def time_calls(function, connection, iterations):
+    """
+    Call function(connection) iterations times and return the durations in milliseconds.
+    """
+    function(connection)
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        function(connection)
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+    print("  ".join(str(header).ljust(width) for header, width in zip(headers, widths)))
+    print("  ".join("-" * width for width in widths))
+    for row in rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def benchmark_queries(iterations):
+    """
+    Print mean and p95 per query, plain versus prepared.
+    """
+    connection = get_connection()
+    try:
+        user_id, listing_id = sample_ids(connection)
+        rows = []
+        for name, function in read_queries(user_id, listing_id):
+            db.PREPARED_STATEMENTS = False
+            plain = time_calls(function, connection, iterations)
+            db.PREPARED_STATEMENTS = True
+            prepared = time_calls(function, connection, iterations)
+            plain_mean, prepared_mean = statistics.mean(plain), statistics.mean(prepared)
+            rows.append((
+                name,
+                f"{plain_mean:.3f}",
+                f"{statistics.quantiles(plain, n=20)[-1]:.3f}",
+                f"{prepared_mean:.3f}",
+                f"{statistics.quantiles(prepared, n=20)[-1]:.3f}",
+                f"{(1 - prepared_mean / plain_mean) * 100:.1f}%",
+            ))
+    finally:
+        connection.close()
+    print_table(
+        ["query", "plain mean ms", "plain p95 ms", "prepared mean ms", "prepared p95 ms", "saving"],
+        rows
+    )
+
+
+def serialization_paths(limit):
+    """
+    The response paths to compare, as (endpoint, path, function(connection) -> bytes) triples.
+    """
+    return [
+        ("/listings", "RealDictRow + jsonable_encoder + json",
+         lambda con: JSONResponse(jsonable_encoder(db.list_listings(con, limit))).body),
+        ("/listings", "RealDictRow + orjson",
+         lambda con: responses.dumps(db.list_listings(con, limit))),
+        ("/listings", "json_agg bytes",
+         lambda con: db.list_listings_json(con, limit)),
+        ("/listings/photos", "RealDictRow + jsonable_encoder + json",
+         lambda con: JSONResponse(jsonable_encoder(db.list_listing_photos(con, limit))).body),
+        ("/listings/photos", "RealDictRow + orjson",
+         lambda con: responses.dumps(db.list_listing_photos(con, limit))),
+        ("/listings/photos", "json_agg bytes",
+         lambda con: db.list_listing_photos_json(con, limit)),
+    ]
+
+
+def benchmark_serialization(iterations, limit):
+    """
+    Print mean and p95 time from query to response body per path, and the body size.
+    """
+    connection = get_connection()
+    try:
+        rows = []
+        for endpoint, path, function in serialization_paths(limit):
+            durations = time_calls(function, connection, iterations)
+            rows.append((
+                endpoint,
+                path,
+                f"{statistics.mean(durations):.3f}",
+                f"{statistics.quantiles(durations, n=20)[-1]:.3f}",
+                len(function(connection) or b""),
+            ))
+    finally:
+        connection.close()
+    print_table(["endpoint", "path", "mean ms", "p95 ms", "body bytes"], rows)
+
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PROJECT_MODULES = {name[:-3] for name in os.listdir(PROJECT_DIRECTORY) if name.endswith(".py")}
+
+# Printed timings are seconds since the interpreter started running the script.
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client_ready = time.perf_counter()
+with TestClient(app.app) as client:
+    started_up = time.perf_counter()
+    client.get("/health/live")
+    answered = time.perf_counter()
+print(imported - started, started_up - client_ready, answered - started_up)
+"""
+
+
+def import_times():
+    """
+    Import the app in a fresh interpreter with -X importtime and return
+    {top level package: (self ms, cumulative ms)}, summed over its modules.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=PROJECT_DIRECTORY, capture_output=True, text=True, check=True
+    )
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        own, cumulative = packages.get(package, (0.0, 0.0))
+        # A package's cumulative time is the largest cumulative time of its modules (the package itself).
+        packages[package] = (own + int(self_us) / 1000, max(cumulative, int(cumulative_us) / 1000))
+    return packages
+
+
+def benchmark_startup(runs, top):
+    """
+    Print import time per module and the median time to first request over a number of cold starts.
+    """
+    packages = import_times()
+    rows = sorted(packages.items(), key=lambda item: item[1][1], reverse=True)
+    rows = [row for row in rows if row[0] in PROJECT_MODULES] + \
+           [row for row in rows if row[0] not in PROJECT_MODULES][:top]
+    print_table(
+        ["module", "project", "self ms", "cumulative ms"],
+        [(name, "yes" if name in PROJECT_MODULES else "", f"{own:.1f}", f"{cumulative:.1f}")
+         for name, (own, cumulative) in rows]
+    )
+    print()
+
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=PROJECT_DIRECTORY, capture_output=True, text=True, check=True
+        )
+        timings.append([float(value) * 1000 for value in result.stdout.split()[-3:]])
+    import_ms, lifespan_ms, request_ms = (statistics.median(column) for column in zip(*timings))
+    print_table(
+        ["import app ms", "lifespan startup ms", "first request ms", "time to first request ms"],
+        [(f"{import_ms:.1f}", f"{lifespan_ms:.1f}", f"{request_ms:.1f}",
+          f"{import_ms + lifespan_ms + request_ms:.1f}")]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the data-access layer.")
+    parser.add_argument("suite", choices=["queries", "serialization", "startup"])
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=1000, help="Page size for the serialization suite.")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts for the startup suite.")
+    parser.add_argument("--top", type=int, default=15,
+                        help="Number of third-party packages in the startup import table.")
+    args = parser.parse_args()
+
+    if args.suite == "queries":
+        benchmark_queries(args.iterations)
+    elif args.suite == "serialization":
+        benchmark_serialization(args.iterations, args.limit)
+    elif args.suite == "startup":
+        benchmark_startup(args.runs, args.top)
@@ -0,0 +1,120 @@
+import gzip
+import os
+
+import brotli
+
+import metrics
+
+"""
+ASGI middleware that compresses responses with brotli or gzip, depending on the
+client's Accept-Encoding, and records response sizes per route.
+
+Only complete (non-streaming) bodies of at least COMPRESSION_MINIMUM_SIZE bytes with
+a compressible content type are compressed, small bodies are not worth the CPU.
+Streaming responses are passed through as they are.
+
+Metrics (see metrics.py), labelled with the route path, e.g /listing/{id}:
+- response_bytes: body size before compression
+- response_bytes_sent: body size on the wire
+"""
+
+
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1000"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick 'br' or 'gzip' from an Accept-Encoding header, or None.
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.strip().partition(";")
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def route_label(scope):
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        start_message = None
+        streaming = False
+        sizes = {"body": 0, "sent": 0}
+
+        async def send_wrapper(message):
+            nonlocal start_message, streaming
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            sizes["body"] += len(body)
+            if start_message is not None and not streaming and message.get("more_body", False):
+                streaming = True
+            if start_message is not None and not streaming:
+                response_headers = dict(start_message["headers"])
+                content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+                if (len(body) >= self.minimum_size
+                        and b"content-encoding" not in response_headers
+                        and content_type.startswith(COMPRESSIBLE_TYPES)):
+                    # Vary whether compressed or not, so caches don't serve one encoding to clients asking for another.
+                    new_headers = [(name, value) for name, value in start_message["headers"] if name != b"vary"]
+                    vary = response_headers.get(b"vary")
+                    if vary and b"accept-encoding" not in vary.lower():
+                        vary += b", Accept-Encoding"
+                    new_headers.append((b"vary", vary or b"Accept-Encoding"))
+                    if encoding is not None:
+                        body = compress(body, encoding)
+                        new_headers = [(name, value) for name, value in new_headers if name != b"content-length"]
+                        new_headers += [
+                            (b"content-encoding", encoding.encode()),
+                            (b"content-length", str(len(body)).encode()),
+                        ]
+                        message = {**message, "body": body}
+                    start_message = {**start_message, "headers": new_headers}
+            if start_message is not None:
+                await send(start_message)
+                start_message = None
+            sizes["sent"] += len(message.get("body", b""))
+            await send(message)
+            if not message.get("more_body", False):
+                label = route_label(scope)
+                metrics.observe("response_bytes", sizes["body"], route=label)
+                metrics.observe("response_bytes_sent", sizes["sent"], route=label)
+
+        await self.app(scope, receive, send_wrapper)
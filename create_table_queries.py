@@ -27,7 +27,8 @@ CREATE TABLE IF NOT EXISTS users(
     email           VARCHAR(200)    UNIQUE  NOT NULL,
     avatar_url      TEXT            UNIQUE,
     description     VARCHAR(500),
-    created_at      TIMESTAMPTZ     DEFAULT now()
+    created_at      TIMESTAMPTZ     DEFAULT now(),
+    updated_at      TIMESTAMPTZ     NOT NULL  DEFAULT now()
 );
 """
 
@@ -75,8 +76,10 @@ CREATE TABLE IF NOT EXISTS user_default_shipping_settings(
 
 newsletter_frequency_options: str = """
 CREATE TABLE IF NOT EXISTS newsletter_frequency_options(
-    id      BIGINT          GENERATED ALWAYS AS IDENTITY  PRIMARY KEY,
-    title   VARCHAR(200)    NOT NULL
+    id              BIGINT          GENERATED ALWAYS AS IDENTITY  PRIMARY KEY,
+    title           VARCHAR(200)    NOT NULL,
+    send_interval   INTERVAL        NOT NULL  DEFAULT '7 days',
+    starts_after    INTERVAL        NOT NULL  DEFAULT '0 days'
 );
 """
 
@@ -92,7 +95,8 @@ CREATE TABLE IF NOT EXISTS user_email_notification_settings(
     other_companies_promotions          BOOL         NOT NULL  DEFAULT (false),
     newsletters                         BOOL         NOT NULL  DEFAULT (false),
     newsletter_frequency_id             BIGINT       NOT NULL  REFERENCES newsletter_frequency_options(id) DEFAULT (1),
-    newsletter_frequency_changed_at     TIMESTAMPTZ  NOT NULL  DEFAULT now()
+    newsletter_frequency_changed_at     TIMESTAMPTZ  NOT NULL  DEFAULT now(),
+    newsletter_last_sent_at             TIMESTAMPTZ
 );
 """
 
@@ -142,20 +146,25 @@ CREATE TABLE IF NOT EXISTS listings(
     title               TEXT            NOT NULL,
     description         TEXT,
     soft_deleted        BOOL            NOT NULL  DEFAULT (false),
-    soft_deleted_at     TIMESTAMPTZ     DEFAULT now(),
+    soft_deleted_at     TIMESTAMPTZ,
     pickup_available    BOOL            NOT NULL DEFAULT (false),
     buyer_insurance     BOOL            NOT NULL DEFAULT (true),
     user_id             BIGINT          REFERENCES users(id),
     type_id             BIGINT          REFERENCES listing_types(id),
     status_id           BIGINT          REFERENCES listing_statuses(id),
-    category_id         BIGINT          REFERENCES listing_categories(id)
+    category_id         BIGINT          REFERENCES listing_categories(id),
+    updated_at          TIMESTAMPTZ     NOT NULL  DEFAULT now(),
+    photos_updated_at   TIMESTAMPTZ     NOT NULL  DEFAULT now(),
+    city_id             INT             REFERENCES cities(id),
+    country_id          INT             REFERENCES countries(id)
 );
 """
 
 user_saved_listings: str = """
 CREATE TABLE IF NOT EXISTS user_saved_listings(
-    user_id     BIGINT  REFERENCES users(id),
-    listing_id  BIGINT  REFERENCES listings(id),
+    user_id     BIGINT          REFERENCES users(id),
+    listing_id  BIGINT          REFERENCES listings(id),
+    saved_at    TIMESTAMPTZ     NOT NULL  DEFAULT now(),
     PRIMARY KEY (user_id, listing_id)
 );
 """
@@ -339,6 +348,430 @@ CREATE TABLE IF NOT EXISTS user_ratings(
 rating_tables: list[str] = [user_ratings]
 
 
+# Notifications
+
+listing_change_events: str = """
+CREATE TABLE IF NOT EXISTS listing_change_events(
+    id                      BIGINT          GENERATED ALWAYS AS IDENTITY  PRIMARY KEY,
+    listing_id              BIGINT          REFERENCES listings(id),
+    change_type             TEXT            NOT NULL,
+    created_at              TIMESTAMPTZ     NOT NULL  DEFAULT now(),
+    fanout_after_user_id    BIGINT          NOT NULL  DEFAULT (0),
+    processed_at            TIMESTAMPTZ
+);
+"""
+
+notification_outbox: str = """
+CREATE TABLE IF NOT EXISTS notification_outbox(
+    id          BIGINT          GENERATED ALWAYS AS IDENTITY  PRIMARY KEY,
+    user_id     BIGINT          REFERENCES users(id),
+    kind        TEXT            NOT NULL,
+    event_id    BIGINT          REFERENCES listing_change_events(id),
+    payload     JSONB           NOT NULL,
+    created_at  TIMESTAMPTZ     NOT NULL  DEFAULT now(),
+    sent_at     TIMESTAMPTZ,
+    UNIQUE (event_id, user_id)
+);
+"""
+
+notification_tables: list[str] = [listing_change_events, notification_outbox]
+
+
+# Trending
+
+listing_trending_scores: str = """
+CREATE TABLE IF NOT EXISTS listing_trending_scores(
+    listing_id      BIGINT              PRIMARY KEY  REFERENCES listings(id),
+    category_id     BIGINT              REFERENCES listing_categories(id),
+    score           DOUBLE PRECISION    NOT NULL,
+    views           INT                 NOT NULL,
+    bids            INT                 NOT NULL,
+    saves           INT                 NOT NULL,
+    computed_at     TIMESTAMPTZ         NOT NULL
+);
+"""
+
+
+# Pricing
+
+listing_price_rollups: str = """
+CREATE TABLE IF NOT EXISTS listing_price_rollups(
+    category_id                 BIGINT          NOT NULL  REFERENCES listing_categories(id),
+    category_filter_option_id   BIGINT          NOT NULL  DEFAULT (0),
+    price_kind                  TEXT            NOT NULL,
+    sample_count                INT             NOT NULL,
+    p10                         NUMERIC         NOT NULL,
+    p25                         NUMERIC         NOT NULL,
+    p50                         NUMERIC         NOT NULL,
+    p75                         NUMERIC         NOT NULL,
+    p90                         NUMERIC         NOT NULL,
+    computed_at                 TIMESTAMPTZ     NOT NULL,
+    PRIMARY KEY (category_id, category_filter_option_id, price_kind)
+);
+"""
+
+
+# Locations
+# Active listings per seller location, kept up to date by the location triggers below.
+# city_id 0 counts the listings of sellers with a country but no city.
+
+listing_location_counts: str = """
+CREATE TABLE IF NOT EXISTS listing_location_counts(
+    country_id          INT     NOT NULL  REFERENCES countries(id),
+    city_id             INT     NOT NULL  DEFAULT (0),
+    active_listings     INT     NOT NULL,
+    PRIMARY KEY (country_id, city_id)
+);
+"""
+
+
+# Idempotency
+
+idempotency_keys: str = """
+CREATE TABLE IF NOT EXISTS idempotency_keys(
+    key             TEXT            NOT NULL,
+    method          TEXT            NOT NULL,
+    path            TEXT            NOT NULL,
+    request_hash    TEXT            NOT NULL,
+    status_code     INT             NOT NULL,
+    response_body   JSONB           NOT NULL,
+    created_at      TIMESTAMPTZ     NOT NULL  DEFAULT now(),
+    expires_at      TIMESTAMPTZ     NOT NULL,
+    PRIMARY KEY (key, method, path)
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx 
+    ON idempotency_keys(expires_at);
+"""
+
+
+# Archive
+
+archived_listing_tables: list[str] = [
+    "listings", "listing_photos", "listing_bids", "listing_views", "listing_attributes", 
+    "listing_price_suggestions", "listing_auction_attributes", "listing_buynow_attributes", 
+    "listing_shipping_settings"
+    ]
+
+archive_tables: list[str] = [
+    f"""
+CREATE TABLE IF NOT EXISTS {table}_archive(
+    LIKE {table},
+    archived_at     TIMESTAMPTZ     NOT NULL  DEFAULT now()
+);
+"""
+    for table in archived_listing_tables
+    ]
+
+
+# Migrations
+# Columns added to tables after they were first created. CREATE TABLE IF NOT EXISTS leaves
+# existing tables as they are, so existing databases get the columns here. The archive
+# copies get them without NOT NULL or defaults, rows archived before have no value.
+
+column_migrations: str = """
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+ALTER TABLE newsletter_frequency_options
+    ADD COLUMN IF NOT EXISTS send_interval INTERVAL NOT NULL DEFAULT '7 days',
+    ADD COLUMN IF NOT EXISTS starts_after INTERVAL NOT NULL DEFAULT '0 days';
+ALTER TABLE user_email_notification_settings
+    ADD COLUMN IF NOT EXISTS newsletter_last_sent_at TIMESTAMPTZ;
+ALTER TABLE listings
+    ALTER COLUMN soft_deleted_at DROP DEFAULT,
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    ADD COLUMN IF NOT EXISTS photos_updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    ADD COLUMN IF NOT EXISTS city_id INT REFERENCES cities(id),
+    ADD COLUMN IF NOT EXISTS country_id INT REFERENCES countries(id);
+ALTER TABLE listings_archive
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS photos_updated_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS city_id INT,
+    ADD COLUMN IF NOT EXISTS country_id INT;
+ALTER TABLE user_saved_listings
+    ADD COLUMN IF NOT EXISTS saved_at TIMESTAMPTZ NOT NULL DEFAULT now();
+"""
+
+# Listings created before the location columns existed take their seller's location, and the
+# counts are built from them once, while the table is still empty. The triggers keep both
+# up to date from then on.
+location_backfill: str = """
+UPDATE listings SET city_id = user_details.city_id, country_id = user_details.country_id
+FROM user_details
+WHERE user_details.user_id = listings.user_id
+AND listings.city_id IS NULL AND listings.country_id IS NULL
+AND (user_details.city_id IS NOT NULL OR user_details.country_id IS NOT NULL);
+INSERT INTO listing_location_counts(country_id, city_id, active_listings)
+SELECT country_id, coalesce(city_id, 0), count(*)
+FROM listings
+WHERE NOT soft_deleted AND country_id IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM listing_location_counts)
+GROUP BY country_id, coalesce(city_id, 0);
+"""
+
+migration_queries: list[str] = [column_migrations, location_backfill]
+
+
+# Indexes
+
+watchlist_indexes: str = """
+CREATE INDEX IF NOT EXISTS listing_bids_listing_id_bid_value_idx 
+    ON listing_bids(listing_id, bid_value DESC);
+CREATE INDEX IF NOT EXISTS listing_photos_listing_id_view_order_idx 
+    ON listing_photos(listing_id, view_order, id);
+"""
+
+notification_indexes: str = """
+CREATE INDEX IF NOT EXISTS user_saved_listings_listing_id_user_id_idx 
+    ON user_saved_listings(listing_id, user_id);
+CREATE INDEX IF NOT EXISTS listing_change_events_unprocessed_idx 
+    ON listing_change_events(id) WHERE processed_at IS NULL;
+CREATE INDEX IF NOT EXISTS notification_outbox_unsent_idx 
+    ON notification_outbox(id) WHERE sent_at IS NULL;
+"""
+
+newsletter_indexes: str = """
+CREATE INDEX IF NOT EXISTS user_email_notification_settings_newsletters_idx 
+    ON user_email_notification_settings(user_id) WHERE newsletters;
+CREATE INDEX IF NOT EXISTS listings_category_id_created_at_idx 
+    ON listings(category_id, created_at DESC) WHERE NOT soft_deleted;
+"""
+
+soft_delete_indexes: str = """
+CREATE INDEX IF NOT EXISTS listings_active_id_idx 
+    ON listings(id) INCLUDE (title) WHERE NOT soft_deleted;
+CREATE INDEX IF NOT EXISTS listings_soft_deleted_at_idx 
+    ON listings(soft_deleted_at) WHERE soft_deleted;
+CREATE INDEX IF NOT EXISTS listing_views_listing_id_idx 
+    ON listing_views(listing_id);
+CREATE INDEX IF NOT EXISTS user_messages_listing_id_idx 
+    ON user_messages(listing_id);
+CREATE INDEX IF NOT EXISTS listing_change_events_listing_id_idx 
+    ON listing_change_events(listing_id);
+"""
+
+projection_indexes: str = """
+CREATE INDEX IF NOT EXISTS users_id_username_idx 
+    ON users(id) INCLUDE (username);
+CREATE INDEX IF NOT EXISTS user_ratings_listing_reviewer_positive_idx 
+    ON user_ratings(listing_id, reviewing_user_id) INCLUDE (positive_review);
+"""
+
+trending_indexes: str = """
+CREATE INDEX IF NOT EXISTS listing_views_viewed_at_idx 
+    ON listing_views(viewed_at);
+CREATE INDEX IF NOT EXISTS listing_bids_bid_at_idx 
+    ON listing_bids(bid_at);
+CREATE INDEX IF NOT EXISTS user_saved_listings_saved_at_idx 
+    ON user_saved_listings(saved_at);
+CREATE INDEX IF NOT EXISTS listing_trending_scores_score_idx 
+    ON listing_trending_scores(score DESC);
+CREATE INDEX IF NOT EXISTS listing_trending_scores_category_id_score_idx 
+    ON listing_trending_scores(category_id, score DESC);
+"""
+
+analytics_indexes: str = """
+CREATE INDEX IF NOT EXISTS listings_updated_at_idx 
+    ON listings(updated_at);
+CREATE INDEX IF NOT EXISTS user_ratings_reviewed_at_idx 
+    ON user_ratings(reviewed_at);
+"""
+
+dashboard_indexes: str = """
+CREATE INDEX IF NOT EXISTS listings_user_id_created_at_idx 
+    ON listings(user_id, created_at DESC) WHERE NOT soft_deleted;
+CREATE INDEX IF NOT EXISTS listings_user_id_idx 
+    ON listings(user_id);
+"""
+
+rating_indexes: str = """
+CREATE INDEX IF NOT EXISTS user_ratings_reviewing_user_id_idx 
+    ON user_ratings(reviewing_user_id);
+"""
+
+location_indexes: str = """
+CREATE INDEX IF NOT EXISTS listings_country_id_id_idx 
+    ON listings(country_id, id) WHERE NOT soft_deleted;
+CREATE INDEX IF NOT EXISTS listings_city_id_id_idx 
+    ON listings(city_id, id) WHERE NOT soft_deleted;
+"""
+
+index_queries: list[str] = [
+    watchlist_indexes, notification_indexes, newsletter_indexes, soft_delete_indexes, 
+    projection_indexes, trending_indexes, analytics_indexes, 
+    dashboard_indexes, rating_indexes, location_indexes
+    ]
+
+
+# Triggers
+
+notify_shipping_matrix_changed: str = """
+CREATE OR REPLACE FUNCTION notify_shipping_matrix_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('shipping_matrix_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+shipping_matrix_triggers: str = """
+CREATE OR REPLACE TRIGGER shipping_companies_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON shipping_companies
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_shipping_matrix_changed();
+CREATE OR REPLACE TRIGGER product_weight_options_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON product_weight_options
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_shipping_matrix_changed();
+CREATE OR REPLACE TRIGGER product_size_options_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON product_size_options
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_shipping_matrix_changed();
+CREATE OR REPLACE TRIGGER shipping_ranges_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON shipping_ranges
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_shipping_matrix_changed();
+CREATE OR REPLACE TRIGGER estimated_shipping_costs_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON estimated_shipping_costs
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_shipping_matrix_changed();
+"""
+
+record_listing_change: str = """
+CREATE OR REPLACE FUNCTION record_listing_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'listings' THEN
+        INSERT INTO listing_change_events(listing_id, change_type) VALUES (NEW.id, TG_ARGV[0]);
+    ELSE
+        INSERT INTO listing_change_events(listing_id, change_type) VALUES (NEW.listing_id, TG_ARGV[0]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+listing_change_triggers: str = """
+CREATE OR REPLACE TRIGGER listings_changed
+    AFTER UPDATE OF title, description, status_id ON listings
+    FOR EACH ROW
+    WHEN (OLD.title IS DISTINCT FROM NEW.title
+          OR OLD.description IS DISTINCT FROM NEW.description
+          OR OLD.status_id IS DISTINCT FROM NEW.status_id)
+    EXECUTE FUNCTION record_listing_change('listing_updated');
+CREATE OR REPLACE TRIGGER listing_buynow_price_changed
+    AFTER UPDATE OF price ON listing_buynow_attributes
+    FOR EACH ROW
+    WHEN (OLD.price IS DISTINCT FROM NEW.price)
+    EXECUTE FUNCTION record_listing_change('price_changed');
+"""
+
+set_updated_at: str = """
+CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+touch_listing_photos: str = """
+CREATE OR REPLACE FUNCTION touch_listing_photos() RETURNS trigger AS $$
+BEGIN
+    -- now() is fixed per transaction, so a batch of photo changes updates the listing only once.
+    IF TG_OP = 'DELETE' THEN
+        UPDATE listings SET photos_updated_at = now()
+        WHERE id = OLD.listing_id AND photos_updated_at <> now();
+    ELSE
+        UPDATE listings SET photos_updated_at = now()
+        WHERE id = NEW.listing_id AND photos_updated_at <> now();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+updated_at_triggers: str = """
+CREATE OR REPLACE TRIGGER users_set_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE OR REPLACE TRIGGER listings_set_updated_at
+    BEFORE UPDATE ON listings
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE OR REPLACE TRIGGER listing_photos_touch_listing
+    AFTER INSERT OR UPDATE OR DELETE ON listing_photos
+    FOR EACH ROW EXECUTE FUNCTION touch_listing_photos();
+"""
+
+set_listing_location: str = """
+CREATE OR REPLACE FUNCTION set_listing_location() RETURNS trigger AS $$
+BEGIN
+    -- No user_details row sets both to NULL.
+    SELECT city_id, country_id INTO NEW.city_id, NEW.country_id
+    FROM user_details WHERE user_id = NEW.user_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+sync_listing_location: str = """
+CREATE OR REPLACE FUNCTION sync_listing_location() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE listings SET city_id = NULL, country_id = NULL
+        WHERE user_id = OLD.user_id AND (city_id IS NOT NULL OR country_id IS NOT NULL);
+    ELSE
+        UPDATE listings SET city_id = NEW.city_id, country_id = NEW.country_id
+        WHERE user_id = NEW.user_id
+        AND (city_id IS DISTINCT FROM NEW.city_id OR country_id IS DISTINCT FROM NEW.country_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+count_listing_locations: str = """
+CREATE OR REPLACE FUNCTION count_listing_locations() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        IF NOT OLD.soft_deleted AND OLD.country_id IS NOT NULL THEN
+            UPDATE listing_location_counts SET active_listings = active_listings - 1
+            WHERE country_id = OLD.country_id AND city_id = coalesce(OLD.city_id, 0);
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF NOT NEW.soft_deleted AND NEW.country_id IS NOT NULL THEN
+            INSERT INTO listing_location_counts(country_id, city_id, active_listings)
+            VALUES (NEW.country_id, coalesce(NEW.city_id, 0), 1)
+            ON CONFLICT (country_id, city_id) DO UPDATE
+            SET active_listings = listing_location_counts.active_listings + 1;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+location_triggers: str = """
+CREATE OR REPLACE TRIGGER listings_set_location
+    BEFORE INSERT OR UPDATE OF user_id ON listings
+    FOR EACH ROW EXECUTE FUNCTION set_listing_location();
+CREATE OR REPLACE TRIGGER user_details_sync_listing_location
+    AFTER INSERT OR DELETE OR UPDATE OF city_id, country_id ON user_details
+    FOR EACH ROW EXECUTE FUNCTION sync_listing_location();
+CREATE OR REPLACE TRIGGER listings_count_locations
+    AFTER INSERT OR DELETE ON listings
+    FOR EACH ROW EXECUTE FUNCTION count_listing_locations();
+CREATE OR REPLACE TRIGGER listings_count_locations_changed
+    AFTER UPDATE OF soft_deleted, city_id, country_id ON listings
+    FOR EACH ROW
+    WHEN (OLD.soft_deleted IS DISTINCT FROM NEW.soft_deleted
+          OR OLD.city_id IS DISTINCT FROM NEW.city_id
+          OR OLD.country_id IS DISTINCT FROM NEW.country_id)
+    EXECUTE FUNCTION count_listing_locations();
+"""
+
+trigger_queries: list[str] = [
+    notify_shipping_matrix_changed, shipping_matrix_triggers, 
+    record_listing_change, listing_change_triggers, 
+    set_updated_at, touch_listing_photos, updated_at_triggers, 
+    set_listing_location, sync_listing_location, count_listing_locations, location_triggers
+    ]
+
+
 all_tables_queries: list[str] = [
     countries, cities, users, user_details, user_selling_settings, shipping_companies, 
     user_default_shipping_settings, newsletter_frequency_options, 
@@ -348,5 +781,8 @@ all_tables_queries: list[str] = [
     listing_category_filter_options, listing_attributes, charity_organizations, 
     listing_auction_attributes, listing_buynow_attributes, product_weight_options, 
     product_size_options, shipping_ranges, estimated_shipping_costs, 
-    listing_shipping_settings, user_messages, user_messages_attachements, user_ratings
+    listing_shipping_settings, user_messages, user_messages_attachements, user_ratings, 
+    *notification_tables, listing_trending_scores, listing_price_rollups, 
+    idempotency_keys, listing_location_counts, *archive_tables, *migration_queries, 
+    *index_queries, *trigger_queries
     ]
@@ -0,0 +1,86 @@
+import asyncio
+import os
+
+import psycopg2
+from psycopg2.pool import PoolError
+from starlette.concurrency import run_in_threadpool
+
+import db
+import metrics
+import replicas
+
+"""
+The seller dashboard behind GET /user/{id}/dashboard.
+
+The dashboard is made of independent aggregate queries (COMPONENTS). They run at the same
+time, each on its own pooled read connection in the thread pool, so the dashboard takes
+as long as the slowest one instead of all of them together. Every component gets
+DASHBOARD_TIMEOUT_SECONDS, enforced both here and in Postgres with statement_timeout.
+A component that times out or fails is left out and listed under 'missing', the rest
+of the dashboard is still returned.
+"""
+
+
+DASHBOARD_TIMEOUT_SECONDS = float(os.getenv("DASHBOARD_TIMEOUT_SECONDS", "1"))
+ACTIVE_LISTINGS_LIMIT = 50
+
+COMPONENTS = {
+    "user": lambda con, user_id, timeout_ms: db.get_user_version(con, user_id),
+    "active_listings": lambda con, user_id, timeout_ms:
+        db.get_dashboard_active_listings(con, user_id, ACTIVE_LISTINGS_LIMIT, timeout_ms),
+    "bids": db.get_dashboard_bid_counts,
+    "views": db.get_dashboard_view_counts,
+    "unread_messages": db.get_dashboard_unread_messages,
+    "ratings": db.get_dashboard_rating_summary,
+}
+# Marks a component that timed out or failed.
+MISSING = object()
+
+
+def _run_component(request, function, user_id):
+    with replicas.read_connection(request) as connection:
+        return function(connection, user_id, int(DASHBOARD_TIMEOUT_SECONDS * 1000))
+
+
+async def _component(request, name, function, user_id):
+    try:
+        return await asyncio.wait_for(
+            run_in_threadpool(_run_component, request, function, user_id), DASHBOARD_TIMEOUT_SECONDS
+        )
+    except (asyncio.TimeoutError, psycopg2.errors.QueryCanceled):
+        metrics.increment("dashboard_component_failures", component=name, reason="timeout")
+    except (psycopg2.Error, PoolError):
+        metrics.increment("dashboard_component_failures", component=name, reason="error")
+    return MISSING
+
+
+async def build_dashboard(request, user_id):
+    """
+    Run all components concurrently and merge them. Returns None when the user doesn't exist.
+    """
+    results = dict(zip(COMPONENTS, await asyncio.gather(
+        *(_component(request, name, function, user_id) for name, function in COMPONENTS.items())
+    )))
+    if results["user"] is None:
+        return None
+
+    listings = results["active_listings"]
+    if listings is not MISSING:
+        bids = {} if results["bids"] is MISSING else {row["listing_id"]: row for row in results["bids"]}
+        views = {} if results["views"] is MISSING else {row["listing_id"]: row["views"] for row in results["views"]}
+        listings = [
+            {
+                **listing,
+                "bids": None if results["bids"] is MISSING else bids.get(listing["id"], {}).get("bids", 0),
+                "highest_bid": bids.get(listing["id"], {}).get("highest_bid"),
+                "views": None if results["views"] is MISSING else views.get(listing["id"], 0),
+            }
+            for listing in listings
+        ]
+    return {
+        "user_id": user_id,
+        "active_listings": None if listings is MISSING else listings,
+        "unread_messages": None if results["unread_messages"] is MISSING else results["unread_messages"],
+        "ratings": None if results["ratings"] is MISSING else results["ratings"],
+        "missing": [name for name, result in results.items() if result is MISSING],
+    }
@@ -1,48 +1,1068 @@
+import hashlib
+import os
+import re
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
 """
 This file is responsible for making database queries, which your fastapi endpoints/routes can use.
-The reason we split them up is to avoid clutter in the endpoints, so that the endpoints might focus on other tasks 
-
-- Try to return results with cursor.fetchall() or cursor.fetchone() when possible
-- Make sure you always give the user response if something went right or wrong, sometimes 
-you might need to use the RETURNING keyword to garantuee that something went right / wrong
-e.g when making DELETE or UPDATE queries
-- No need to use a class here
-- Try to raise exceptions to make them more reusable and work a lot with returns
-- You will need to decide which parameters each function should receive. All functions 
-start with a connection parameter.
-- Below, a few inspirational functions exist - feel free to completely ignore how they are structured
-- E.g, if you decide to use psycopg3, you'd be able to directly use pydantic models with the cursor, these examples are however using psycopg2 and RealDictCursor
+The reason we split them up is to avoid clutter in the endpoints, so that the endpoints might focus on other tasks
+
+- Every function starts with a connection parameter, normally a pooled connection from db_setup.pooled_connection
+- Functions return results from cursor.fetchall() or cursor.fetchone(), None means that nothing was found
+- Database errors (e.g psycopg2.errors.UniqueViolation) are raised as they are, the endpoints decide which
+HTTP response they turn into
+- Queries are run as server-side prepared statements through execute_prepared, so Postgres parses and plans
+them once per connection instead of on every call. Prepared queries use $1, $2, ... as placeholders.
+Set DB_PREPARED_STATEMENTS=0 to run them as plain queries instead.
+- List functions take an optional fields tuple that narrows the SELECT list. Fields are checked against
+the whitelists below (USER_FIELDS etc.) and ValueError is raised for unknown fields.
+- Functions ending in _json let Postgres build the JSON response with json_agg and return it as
+bytes, which the endpoint sends as it is (see responses.RawJSONResponse). They return None when
+there are no rows.
 """
 
 
-### THIS IS JUST AN EXAMPLE OF A FUNCTION FOR INSPIRATION FOR A LIST-OPERATION (FETCHING MANY ENTRIES)
-# def get_items(con):
-#     with con:
-#         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-#             cursor.execute("SELECT * FROM items;")
-#             items = cursor.fetchall()
-#     return items
-
-
-### THIS IS JUST INSPIRATION FOR A DETAIL OPERATION (FETCHING ONE ENTRY)
-# def get_item(con, item_id):
-#     with con:
-#         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-#             cursor.execute("""SELECT * FROM items WHERE id = %s""", (item_id,))
-#             item = cursor.fetchone()
-#             return item
-
-
-### THIS IS JUST INSPIRATION FOR A CREATE-OPERATION
-# def add_item(con, title, description):
-#     with con:
-#         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-#             cursor.execute(
-#                 "INSERT INTO items (title, description) VALUES (%s, %s) RETURNING id;",
-#                 (title, description),
-#             )
-#             item_id = cursor.fetchone()["id"]
-#     return item_id
+PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+
+USER_FIELDS = ("id", "username", "email", "avatar_url", "description", "created_at", "updated_at")
+LISTING_FIELDS = (
+    "id", "created_at", "title", "description", "soft_deleted", "soft_deleted_at",
+    "pickup_available", "buyer_insurance", "user_id", "type_id", "status_id", "category_id",
+    "updated_at", "photos_updated_at", "city_id", "country_id"
+)
+RATING_FIELDS = (
+    "listing_id", "reviewing_user_id", "reviewed_at", "positive_review", "review_comment",
+    "listing_description_rating", "listing_communication_rating", "listing_delivery_time_rating"
+)
+USER_DETAILS_FIELDS = (
+    "user_id", "first_name", "last_name", "phone", "street_address", "zip_code", "city_id",
+    "country_id", "is_company"
+)
+NOTIFICATION_SETTINGS_FIELDS = (
+    "user_id", "upon_new_device_login", "copy_read_messages", "favorites_list_updates",
+    "upon_missing_payment", "upon_failed_auction", "upon_bid_exceeding_starting_price",
+    "other_companies_promotions", "newsletters", "newsletter_frequency_id",
+    "newsletter_frequency_changed_at", "newsletter_last_sent_at"
+)
+AUCTION_FIELDS = (
+    "listing_id", "starting_price", "auction_deadline_datetime", "auto_republish", "minimum_price",
+    "storage_location", "charity_id", "share_info_upon_donation"
+)
+BUYNOW_FIELDS = (
+    "listing_id", "price", "auto_republish", "storage_location", "charity_id", "share_info_upon_donation"
+)
+SHIPPING_SETTINGS_FIELDS = (
+    "listing_id", "shipping_company_id", "user_shipping_cost", "packaging_fee",
+    "product_weight_id", "product_size_id", "shipping_range_id"
+)
+PHOTO_FIELDS = ("id", "listing_id", "url", "view_order", "uploaded_at")
+
+_PLACEHOLDER = re.compile(r"\$(\d+)")
+
+
+def _fetch_json(cursor):
+    """
+    Return the bytes of a single json_agg result, or None when it aggregated no rows.
+    """
+    row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else None
+
+
+def select_fields(fields, allowed):
+    """
+    Check fields against the allowed whitelist and return them in whitelist order without duplicates.
+    None means all allowed fields. Raises ValueError for unknown fields.
+    """
+    if fields is None:
+        return allowed
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    selected = tuple(field for field in allowed if field in fields)
+    if not selected:
+        raise ValueError("No fields selected")
+    return selected
+
+
+def _projection(name, fields, allowed):
+    """
+    Return the statement name and column list for a projection.
+    Every distinct projection gets its own prepared statement.
+    """
+    fields = select_fields(fields, allowed)
+    if fields != allowed:
+        name = f"{name}_{hashlib.md5(','.join(fields).encode()).hexdigest()[:8]}"
+    return name, ", ".join(fields)
+
+
+def _columns(fields, table=None):
+    """
+    Return the column list for fields, qualified with table when given.
+    Prepared statements list their columns instead of using *: a column added by a migration
+    would change the result type of * and fail the statements already prepared on pooled connections.
+    """
+    return ", ".join(f"{table}.{field}" if table else field for field in fields)
+
+
+def _as_plain_query(query, parameters):
+    """
+    Turn a $n query into a %s query with the parameters in matching order.
+    """
+    order = [int(number) - 1 for number in _PLACEHOLDER.findall(query)]
+    return _PLACEHOLDER.sub("%s", query.replace("%", "%%")), [parameters[index] for index in order]
+
+
+def execute_prepared(cursor, name, query, parameters=()):
+    """
+    Execute query as the prepared statement 'name', preparing it first if this connection
+    has not seen it yet. Falls back to a plain query for connections that do not keep
+    track of their prepared statements (see db_setup.PreparingConnection).
+    """
+    prepared = getattr(cursor.connection, "prepared_statements", None)
+    if not PREPARED_STATEMENTS or prepared is None:
+        cursor.execute(*_as_plain_query(query, parameters))
+        return
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {query}")
+        prepared.add(name)
+    if parameters:
+        placeholders = ", ".join(["%s"] * len(parameters))
+        cursor.execute(f"EXECUTE {name}({placeholders});", parameters)
+    else:
+        cursor.execute(f"EXECUTE {name};")
+
+
+# Users
+
+def get_user(con, user_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_user", f"""
+                             SELECT {_columns(USER_FIELDS)} FROM users
+                             WHERE id = $1;
+                             """, (user_id,))
+            return cursor.fetchone()
+
+
+def get_user_version(con, user_id):
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, "get_user_version", """
+                             SELECT updated_at FROM users
+                             WHERE id = $1;
+                             """, (user_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+
+def list_users(con, limit, fields=None):
+    name, columns = _projection("list_users", fields, USER_FIELDS)
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, name, f"""
+                             SELECT {columns} FROM users
+                             ORDER BY id
+                             LIMIT $1;
+                             """, (limit,))
+            return cursor.fetchall()
+
+
+def list_users_json(con, limit, fields=None):
+    name, columns = _projection("list_users_json", fields, USER_FIELDS)
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, name, f"""
+                             SELECT convert_to(json_agg(page)::text, 'UTF8')
+                             FROM (
+                                 SELECT {columns} FROM users
+                                 ORDER BY id
+                                 LIMIT $1
+                             ) AS page;
+                             """, (limit,))
+            return _fetch_json(cursor)
+
+
+def get_user_newsletter_frequency(con, user_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_user_newsletter_frequency", """
+                             SELECT user_id, id, title
+                             FROM newsletter_frequency_options
+                             INNER JOIN user_email_notification_settings
+                             ON newsletter_frequency_options.id = user_email_notification_settings.newsletter_frequency_id
+                             WHERE user_id = $1;
+                             """, (user_id,))
+            return cursor.fetchone()
+
+
+def add_country(con, name):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_country", """
+                             INSERT INTO countries(name)
+                             VALUES ($1)
+                             RETURNING id;
+                             """, (name,))
+            return cursor.fetchone()["id"]
+
+
+def add_city(con, name, country_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_city", """
+                             INSERT INTO cities(name, country_id)
+                             VALUES ($1, $2)
+                             RETURNING id;
+                             """, (name, country_id))
+            return cursor.fetchone()["id"]
+
+
+def add_user(con, username, email):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_user", """
+                             INSERT INTO users(username, email)
+                             VALUES ($1, $2)
+                             RETURNING id;
+                             """, (username, email))
+            return cursor.fetchone()["id"]
+
+
+def add_user_details(con, user_id, first_name, last_name, phone, street_address,
+                     zip_code, city_id, country_id, is_company):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_user_details", """
+                             INSERT INTO user_details(
+                                 user_id, first_name, last_name, phone,
+                                 street_address, zip_code, city_id,
+                                 country_id, is_company
+                             )
+                             VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9);
+                             """, (user_id, first_name, last_name, phone, street_address,
+                                   zip_code, city_id, country_id, is_company))
+
+
+def add_newsletter_frequency_option(con, title, send_interval, starts_after):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_newsletter_frequency_option", """
+                             INSERT INTO newsletter_frequency_options(title, send_interval, starts_after)
+                             VALUES ($1, $2, $3)
+                             RETURNING id;
+                             """, (title, send_interval, starts_after))
+            return cursor.fetchone()["id"]
+
+
+def add_user_notification_settings(con, user_id, upon_new_device_login, copy_read_messages,
+                                   favorites_list_updates, upon_missing_payment, upon_failed_auction,
+                                   upon_bid_exceeding_starting_price, other_companies_promotions,
+                                   newsletters, newsletter_frequency_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_user_notification_settings", """
+                             INSERT INTO user_email_notification_settings(
+                                 user_id, upon_new_device_login,
+                                 copy_read_messages, favorites_list_updates,
+                                 upon_missing_payment, upon_failed_auction,
+                                 upon_bid_exceeding_starting_price,
+                                 other_companies_promotions, newsletters,
+                                 newsletter_frequency_id
+                             )
+                             VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10);
+                             """, (user_id, upon_new_device_login, copy_read_messages,
+                                   favorites_list_updates, upon_missing_payment, upon_failed_auction,
+                                   upon_bid_exceeding_starting_price, other_companies_promotions,
+                                   newsletters, newsletter_frequency_id))
+
+
+def upsert_user_details(con, user_id, first_name, last_name, phone, street_address,
+                        zip_code, city_id, country_id, is_company):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "upsert_user_details", f"""
+                             INSERT INTO user_details(
+                                 user_id, first_name, last_name, phone,
+                                 street_address, zip_code, city_id,
+                                 country_id, is_company
+                             )
+                             VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                             ON CONFLICT (user_id) DO UPDATE SET
+                                 first_name = EXCLUDED.first_name,
+                                 last_name = EXCLUDED.last_name,
+                                 phone = EXCLUDED.phone,
+                                 street_address = EXCLUDED.street_address,
+                                 zip_code = EXCLUDED.zip_code,
+                                 city_id = EXCLUDED.city_id,
+                                 country_id = EXCLUDED.country_id,
+                                 is_company = EXCLUDED.is_company
+                             RETURNING {_columns(USER_DETAILS_FIELDS)};
+                             """, (user_id, first_name, last_name, phone, street_address,
+                                   zip_code, city_id, country_id, is_company))
+            return cursor.fetchone()
+
+
+def upsert_user_notification_settings(con, user_id, upon_new_device_login, copy_read_messages,
+                                      favorites_list_updates, upon_missing_payment, upon_failed_auction,
+                                      upon_bid_exceeding_starting_price, other_companies_promotions,
+                                      newsletters, newsletter_frequency_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "upsert_user_notification_settings", f"""
+                             INSERT INTO user_email_notification_settings AS settings(
+                                 user_id, upon_new_device_login,
+                                 copy_read_messages, favorites_list_updates,
+                                 upon_missing_payment, upon_failed_auction,
+                                 upon_bid_exceeding_starting_price,
+                                 other_companies_promotions, newsletters,
+                                 newsletter_frequency_id
+                             )
+                             VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                             ON CONFLICT (user_id) DO UPDATE SET
+                                 upon_new_device_login = EXCLUDED.upon_new_device_login,
+                                 copy_read_messages = EXCLUDED.copy_read_messages,
+                                 favorites_list_updates = EXCLUDED.favorites_list_updates,
+                                 upon_missing_payment = EXCLUDED.upon_missing_payment,
+                                 upon_failed_auction = EXCLUDED.upon_failed_auction,
+                                 upon_bid_exceeding_starting_price = EXCLUDED.upon_bid_exceeding_starting_price,
+                                 other_companies_promotions = EXCLUDED.other_companies_promotions,
+                                 newsletters = EXCLUDED.newsletters,
+                                 newsletter_frequency_id = EXCLUDED.newsletter_frequency_id,
+                                 newsletter_frequency_changed_at = CASE
+                                     WHEN settings.newsletter_frequency_id = EXCLUDED.newsletter_frequency_id
+                                     THEN settings.newsletter_frequency_changed_at
+                                     ELSE now()
+                                 END
+                             RETURNING {_columns(NOTIFICATION_SETTINGS_FIELDS)};
+                             """, (user_id, upon_new_device_login, copy_read_messages,
+                                   favorites_list_updates, upon_missing_payment, upon_failed_auction,
+                                   upon_bid_exceeding_starting_price, other_companies_promotions,
+                                   newsletters, newsletter_frequency_id))
+            return cursor.fetchone()
+
+
+# Listings
+
+def get_listing_version(con, listing_id, include_deleted=False):
+    with con:
+        with con.cursor() as cursor:
+            if include_deleted:
+                execute_prepared(cursor, "get_listing_version_including_deleted", """
+                                 SELECT updated_at FROM listings
+                                 WHERE id = $1;
+                                 """, (listing_id,))
+            else:
+                execute_prepared(cursor, "get_listing_version", """
+                                 SELECT updated_at FROM listings
+                                 WHERE id = $1 AND NOT soft_deleted;
+                                 """, (listing_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+
+def get_listing_photos_version(con, listing_id):
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, "get_listing_photos_version", """
+                             SELECT photos_updated_at FROM listings
+                             WHERE id = $1 AND NOT soft_deleted;
+                             """, (listing_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+
+def get_listing(con, listing_id, include_deleted=False, fields=None):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            if include_deleted:
+                name, columns = _projection("get_listing_including_deleted", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT {columns} FROM listings
+                                 WHERE id = $1;
+                                 """, (listing_id,))
+            else:
+                name, columns = _projection("get_listing", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT {columns} FROM listings
+                                 WHERE id = $1 AND NOT soft_deleted;
+                                 """, (listing_id,))
+            return cursor.fetchall()
+
+
+def list_listings(con, limit, include_deleted=False, fields=None):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            if include_deleted:
+                name, columns = _projection("list_listings_including_deleted", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT {columns} FROM listings
+                                 ORDER BY id
+                                 LIMIT $1;
+                                 """, (limit,))
+            else:
+                name, columns = _projection("list_listings", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT {columns} FROM listings
+                                 WHERE NOT soft_deleted
+                                 ORDER BY id
+                                 LIMIT $1;
+                                 """, (limit,))
+            return cursor.fetchall()
+
+
+def list_listings_json(con, limit, include_deleted=False, fields=None):
+    with con:
+        with con.cursor() as cursor:
+            if include_deleted:
+                name, columns = _projection("list_listings_including_deleted_json", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT convert_to(json_agg(page)::text, 'UTF8')
+                                 FROM (
+                                     SELECT {columns} FROM listings
+                                     ORDER BY id
+                                     LIMIT $1
+                                 ) AS page;
+                                 """, (limit,))
+            else:
+                name, columns = _projection("list_listings_json", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT convert_to(json_agg(page)::text, 'UTF8')
+                                 FROM (
+                                     SELECT {columns} FROM listings
+                                     WHERE NOT soft_deleted
+                                     ORDER BY id
+                                     LIMIT $1
+                                 ) AS page;
+                                 """, (limit,))
+            return _fetch_json(cursor)
+
+
+def list_trending_listings_json(con, limit, category_id=None):
+    """
+    Listings with the highest trending score (see trending.py), overall or within one category.
+    """
+    with con:
+        with con.cursor() as cursor:
+            if category_id is None:
+                execute_prepared(cursor, "list_trending_listings_json", """
+                                 SELECT convert_to(json_agg(page)::text, 'UTF8')
+                                 FROM (
+                                     SELECT listings.id, listings.title, listings.category_id,
+                                            scores.score, scores.views, scores.bids, scores.saves
+                                     FROM listing_trending_scores AS scores
+                                     INNER JOIN listings ON listings.id = scores.listing_id
+                                     WHERE NOT listings.soft_deleted
+                                     ORDER BY scores.score DESC
+                                     LIMIT $1
+                                 ) AS page;
+                                 """, (limit,))
+            else:
+                execute_prepared(cursor, "list_trending_listings_in_category_json", """
+                                 SELECT convert_to(json_agg(page)::text, 'UTF8')
+                                 FROM (
+                                     SELECT listings.id, listings.title, listings.category_id,
+                                            scores.score, scores.views, scores.bids, scores.saves
+                                     FROM listing_trending_scores AS scores
+                                     INNER JOIN listings ON listings.id = scores.listing_id
+                                     WHERE scores.category_id = $2 AND NOT listings.soft_deleted
+                                     ORDER BY scores.score DESC
+                                     LIMIT $1
+                                 ) AS page;
+                                 """, (limit, category_id))
+            return _fetch_json(cursor)
+
+
+def create_listing(con, listing, auction=None, buy_now=None, shipping=None,
+                   category_filter_option_ids=(), photos=()):
+    """
+    Create a listing with its auction / buy-now attributes, shipping settings, filter options and
+    photos in one transaction. listing, auction, buy_now and shipping are dicts of column values,
+    photos are (url, view_order) pairs. Options and photos are inserted with one statement each.
+    Returns the created aggregate.
+    """
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "create_listing", f"""
+                             INSERT INTO listings(
+                                 user_id, title, description, pickup_available, buyer_insurance,
+                                 type_id, status_id, category_id
+                             )
+                             VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                             RETURNING {_columns(LISTING_FIELDS)};
+                             """, (listing["user_id"], listing["title"], listing["description"],
+                                   listing["pickup_available"], listing["buyer_insurance"],
+                                   listing["type_id"], listing["status_id"], listing["category_id"]))
+            created = dict(cursor.fetchone())
+            listing_id = created["id"]
+
+            created["auction"] = None
+            if auction is not None:
+                execute_prepared(cursor, "create_listing_auction_attributes", f"""
+                                 INSERT INTO listing_auction_attributes(
+                                     listing_id, starting_price, auction_deadline_datetime, auto_republish,
+                                     minimum_price, storage_location, charity_id, share_info_upon_donation
+                                 )
+                                 VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                                 RETURNING {_columns(AUCTION_FIELDS)};
+                                 """, (listing_id, auction["starting_price"], auction["auction_deadline_datetime"],
+                                       auction["auto_republish"], auction["minimum_price"],
+                                       auction["storage_location"], auction["charity_id"],
+                                       auction["share_info_upon_donation"]))
+                created["auction"] = cursor.fetchone()
+
+            created["buy_now"] = None
+            if buy_now is not None:
+                execute_prepared(cursor, "create_listing_buynow_attributes", f"""
+                                 INSERT INTO listing_buynow_attributes(
+                                     listing_id, price, auto_republish, storage_location,
+                                     charity_id, share_info_upon_donation
+                                 )
+                                 VALUES ($1, $2, $3, $4, $5, $6)
+                                 RETURNING {_columns(BUYNOW_FIELDS)};
+                                 """, (listing_id, buy_now["price"], buy_now["auto_republish"],
+                                       buy_now["storage_location"], buy_now["charity_id"],
+                                       buy_now["share_info_upon_donation"]))
+                created["buy_now"] = cursor.fetchone()
+
+            created["shipping"] = None
+            if shipping is not None:
+                execute_prepared(cursor, "create_listing_shipping_settings", f"""
+                                 INSERT INTO listing_shipping_settings(
+                                     listing_id, shipping_company_id, user_shipping_cost, packaging_fee,
+                                     product_weight_id, product_size_id, shipping_range_id
+                                 )
+                                 VALUES ($1, $2, $3, $4, $5, $6, $7)
+                                 RETURNING {_columns(SHIPPING_SETTINGS_FIELDS)};
+                                 """, (listing_id, shipping["shipping_company_id"], shipping["user_shipping_cost"],
+                                       shipping["packaging_fee"], shipping["product_weight_id"],
+                                       shipping["product_size_id"], shipping["shipping_range_id"]))
+                created["shipping"] = cursor.fetchone()
+
+            created["category_filter_option_ids"] = []
+            if category_filter_option_ids:
+                execute_prepared(cursor, "create_listing_attributes", """
+                                 INSERT INTO listing_attributes(listing_id, category_filter_option_id)
+                                 SELECT $1, option_id FROM unnest($2::bigint[]) AS option_id
+                                 ON CONFLICT DO NOTHING
+                                 RETURNING category_filter_option_id;
+                                 """, (listing_id, list(category_filter_option_ids)))
+                created["category_filter_option_ids"] = sorted(
+                    row["category_filter_option_id"] for row in cursor.fetchall()
+                )
+
+            created["photos"] = []
+            if photos:
+                urls, view_orders = zip(*photos)
+                execute_prepared(cursor, "create_listing_photos", f"""
+                                 INSERT INTO listing_photos(listing_id, url, view_order)
+                                 SELECT $1, photo.url, photo.view_order
+                                 FROM unnest($2::text[], $3::bigint[]) AS photo(url, view_order)
+                                 RETURNING {_columns(PHOTO_FIELDS)};
+                                 """, (listing_id, list(urls), list(view_orders)))
+                created["photos"] = sorted(cursor.fetchall(), key=lambda photo: (photo["view_order"], photo["id"]))
+            return created
+
+
+def soft_delete_listing(con, listing_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "soft_delete_listing", """
+                             UPDATE listings
+                             SET soft_deleted = true, soft_deleted_at = now()
+                             WHERE id = $1 AND NOT soft_deleted
+                             RETURNING id;
+                             """, (listing_id,))
+            return cursor.fetchone()
+
+
+def get_listing_photos(con, listing_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_listing_photos", f"""
+                             SELECT {_columns(PHOTO_FIELDS, "listing_photos")} FROM listing_photos
+                             INNER JOIN listings ON listings.id = listing_photos.listing_id
+                             WHERE listing_photos.listing_id = $1 AND NOT listings.soft_deleted
+                             ORDER BY listing_photos.view_order, listing_photos.id;
+                             """, (listing_id,))
+            return cursor.fetchall()
+
+
+def list_listing_photos(con, limit, after_id=0):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "list_listing_photos", f"""
+                             SELECT {_columns(PHOTO_FIELDS, "listing_photos")} FROM listing_photos
+                             INNER JOIN listings ON listings.id = listing_photos.listing_id
+                             WHERE listing_photos.id > $1 AND NOT listings.soft_deleted
+                             ORDER BY listing_photos.id
+                             LIMIT $2;
+                             """, (after_id, limit))
+            return cursor.fetchall()
+
+
+def get_listing_photos_json(con, listing_id):
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, "get_listing_photos_json", f"""
+                             SELECT convert_to(json_agg(photo ORDER BY photo.view_order, photo.id)::text, 'UTF8')
+                             FROM (
+                                 SELECT {_columns(PHOTO_FIELDS, "listing_photos")} FROM listing_photos
+                                 INNER JOIN listings ON listings.id = listing_photos.listing_id
+                                 WHERE listing_photos.listing_id = $1 AND NOT listings.soft_deleted
+                             ) AS photo;
+                             """, (listing_id,))
+            return _fetch_json(cursor)
+
+
+def list_listing_photos_json(con, limit, after_id=0):
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, "list_listing_photos_json", f"""
+                             SELECT convert_to(json_agg(page)::text, 'UTF8')
+                             FROM (
+                                 SELECT {_columns(PHOTO_FIELDS, "listing_photos")} FROM listing_photos
+                                 INNER JOIN listings ON listings.id = listing_photos.listing_id
+                                 WHERE listing_photos.id > $1 AND NOT listings.soft_deleted
+                                 ORDER BY listing_photos.id
+                                 LIMIT $2
+                             ) AS page;
+                             """, (after_id, limit))
+            return _fetch_json(cursor)
+
+
+def delete_listing_photo(con, photo_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "delete_listing_photo", """
+                             DELETE FROM listing_photos
+                             WHERE id = $1
+                             RETURNING id;
+                             """, (photo_id,))
+            return cursor.fetchone()
+
+
+def delete_listing_photos(con, listing_id, user_id, photo_ids):
+    """
+    Delete photos of a listing owned by user_id, all of them or none: when any of the ids
+    is not a photo of that listing, nothing is deleted and an empty list is returned.
+    Returns the deleted photo ids.
+    """
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, "delete_listing_photos", """
+                             WITH requested AS (
+                                 SELECT DISTINCT unnest($3::bigint[]) AS id
+                             ),
+                             owned AS (
+                                 SELECT listing_photos.id FROM listing_photos
+                                 INNER JOIN listings ON listings.id = listing_photos.listing_id
+                                 WHERE listing_photos.id IN (SELECT id FROM requested)
+                                 AND listing_photos.listing_id = $1
+                                 AND listings.user_id = $2
+                                 FOR UPDATE OF listing_photos
+                             )
+                             DELETE FROM listing_photos
+                             WHERE id IN (SELECT id FROM owned)
+                             AND (SELECT count(*) FROM owned) = (SELECT count(*) FROM requested)
+                             RETURNING id;
+                             """, (listing_id, user_id, list(photo_ids)))
+            return sorted(row[0] for row in cursor.fetchall())
+
+
+def reorder_listing_photos(con, listing_id, user_id, photo_ids):
+    """
+    Set view_order of all photos of a listing owned by user_id to their position in photo_ids.
+    photo_ids has to list every photo of the listing exactly once, otherwise nothing changes
+    and an empty list is returned. Returns the photos' ids and new view_order.
+    """
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "reorder_listing_photos", """
+                             WITH new_order AS (
+                                 SELECT photo_id, position
+                                 FROM unnest($3::bigint[]) WITH ORDINALITY AS new_order(photo_id, position)
+                             ),
+                             current_photos AS (
+                                 SELECT listing_photos.id FROM listing_photos
+                                 INNER JOIN listings ON listings.id = listing_photos.listing_id
+                                 WHERE listing_photos.listing_id = $1
+                                 AND listings.user_id = $2
+                                 FOR UPDATE OF listing_photos
+                             )
+                             UPDATE listing_photos SET view_order = new_order.position
+                             FROM new_order
+                             WHERE listing_photos.id = new_order.photo_id
+                             AND listing_photos.listing_id = $1
+                             AND (SELECT count(*) FROM new_order) = (SELECT count(*) FROM current_photos)
+                             AND (SELECT count(DISTINCT photo_id) FROM new_order) = (SELECT count(*) FROM current_photos)
+                             AND NOT EXISTS (
+                                 SELECT 1 FROM new_order
+                                 WHERE photo_id NOT IN (SELECT id FROM current_photos)
+                             )
+                             RETURNING listing_photos.id, listing_photos.view_order;
+                             """, (listing_id, user_id, list(photo_ids)))
+            return sorted(cursor.fetchall(), key=lambda photo: photo["view_order"])
+
+
+def get_listing_shipping_settings(con, listing_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_listing_shipping_settings", """
+                             SELECT shipping_company_id, user_shipping_cost, packaging_fee,
+                                    product_weight_id, product_size_id, shipping_range_id
+                             FROM listing_shipping_settings
+                             WHERE listing_id = $1;
+                             """, (listing_id,))
+            return cursor.fetchone()
+
+
+# Saved listings
+
+def list_saved_listings(con, user_id, limit, after_listing_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "list_saved_listings", """
+                             SELECT listings.id AS listing_id, listings.title,
+                                    listings.status_id, listing_statuses.title AS status,
+                                    listing_buynow_attributes.price,
+                                    listing_auction_attributes.starting_price,
+                                    highest_bid.bid_value AS highest_bid,
+                                    first_photo.url AS photo_url
+                             FROM user_saved_listings
+                             INNER JOIN listings
+                             ON listings.id = user_saved_listings.listing_id
+                             LEFT JOIN listing_statuses
+                             ON listing_statuses.id = listings.status_id
+                             LEFT JOIN listing_buynow_attributes
+                             ON listing_buynow_attributes.listing_id = listings.id
+                             LEFT JOIN listing_auction_attributes
+                             ON listing_auction_attributes.listing_id = listings.id
+                             LEFT JOIN LATERAL (
+                                 SELECT bid_value FROM listing_bids
+                                 WHERE listing_bids.listing_id = listings.id
+                                 ORDER BY bid_value DESC
+                                 LIMIT 1
+                             ) AS highest_bid ON true
+                             LEFT JOIN LATERAL (
+                                 SELECT url FROM listing_photos
+                                 WHERE listing_photos.listing_id = listings.id
+                                 ORDER BY view_order, id
+                                 LIMIT 1
+                             ) AS first_photo ON true
+                             WHERE user_saved_listings.user_id = $1
+                             AND user_saved_listings.listing_id > $2
+                             AND NOT listings.soft_deleted
+                             ORDER BY user_saved_listings.listing_id
+                             LIMIT $3;
+                             """, (user_id, after_listing_id, limit))
+            return cursor.fetchall()
+
+
+def add_saved_listing(con, user_id, listing_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "add_saved_listing", """
+                             INSERT INTO user_saved_listings(user_id, listing_id)
+                             VALUES ($1, $2)
+                             ON CONFLICT DO NOTHING;
+                             """, (user_id, listing_id))
+
+
+def delete_saved_listing(con, user_id, listing_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "delete_saved_listing", """
+                             DELETE FROM user_saved_listings
+                             WHERE user_id = $1 AND listing_id = $2
+                             RETURNING listing_id;
+                             """, (user_id, listing_id))
+            return cursor.fetchone()
+
+
+# Ratings
+
+def get_received_ratings(con, user_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_received_ratings", """
+                             SELECT user_id, listing_id, reviewing_user_id, reviewed_at,
+                                    positive_review, review_comment, listing_description_rating,
+                                    listing_communication_rating, listing_delivery_time_rating
+                             FROM listings
+                             INNER JOIN user_ratings
+                             ON listings.id = user_ratings.listing_id
+                             WHERE user_id = $1;
+                             """, (user_id,))
+            return cursor.fetchall()
+
+
+def get_provided_ratings(con, user_id):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_provided_ratings", f"""
+                             SELECT {_columns(RATING_FIELDS)}
+                             FROM user_ratings
+                             WHERE reviewing_user_id = $1;
+                             """, (user_id,))
+            return cursor.fetchone()
+
+
+def list_ratings(con, limit, fields=None):
+    name, columns = _projection("list_ratings", fields, RATING_FIELDS)
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, name, f"""
+                             SELECT {columns} FROM user_ratings
+                             ORDER BY listing_id, reviewing_user_id
+                             LIMIT $1;
+                             """, (limit,))
+            return cursor.fetchall()
+
+
+def list_ratings_json(con, limit, fields=None):
+    name, columns = _projection("list_ratings_json", fields, RATING_FIELDS)
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, name, f"""
+                             SELECT convert_to(json_agg(page)::text, 'UTF8')
+                             FROM (
+                                 SELECT {columns} FROM user_ratings
+                                 ORDER BY listing_id, reviewing_user_id
+                                 LIMIT $1
+                             ) AS page;
+                             """, (limit,))
+            return _fetch_json(cursor)
+
+
+# Locations
+# Listings carry their seller's city_id and country_id and listing_location_counts holds the
+# number of active listings per location, both kept in sync by triggers (see create_table_queries.py).
+
+def list_country_listing_counts(con):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "list_country_listing_counts", """
+                             SELECT countries.id AS country_id, countries.name,
+                                    sum(counts.active_listings)::int AS active_listings
+                             FROM listing_location_counts AS counts
+                             INNER JOIN countries ON countries.id = counts.country_id
+                             GROUP BY countries.id, countries.name
+                             HAVING sum(counts.active_listings) > 0
+                             ORDER BY active_listings DESC, countries.id;
+                             """)
+            return cursor.fetchall()
+
+
+def list_city_listing_counts(con, country_id):
+    """
+    Active listings per city of a country. city_id 0 (name None) are sellers without a city.
+    """
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "list_city_listing_counts", """
+                             SELECT counts.city_id, cities.name, counts.active_listings
+                             FROM listing_location_counts AS counts
+                             LEFT JOIN cities ON cities.id = counts.city_id
+                             WHERE counts.country_id = $1 AND counts.active_listings > 0
+                             ORDER BY counts.active_listings DESC, counts.city_id;
+                             """, (country_id,))
+            return cursor.fetchall()
+
+
+def list_listings_by_location_json(con, limit, after_id=0, country_id=None, city_id=None, fields=None):
+    """
+    Active listings of sellers in a city, or else in a country, by id after after_id.
+    """
+    with con:
+        with con.cursor() as cursor:
+            if city_id is not None:
+                name, columns = _projection("list_listings_in_city_json", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT convert_to(json_agg(page)::text, 'UTF8')
+                                 FROM (
+                                     SELECT {columns} FROM listings
+                                     WHERE city_id = $1 AND NOT soft_deleted AND id > $2
+                                     ORDER BY id
+                                     LIMIT $3
+                                 ) AS page;
+                                 """, (city_id, after_id, limit))
+            else:
+                name, columns = _projection("list_listings_in_country_json", fields, LISTING_FIELDS)
+                execute_prepared(cursor, name, f"""
+                                 SELECT convert_to(json_agg(page)::text, 'UTF8')
+                                 FROM (
+                                     SELECT {columns} FROM listings
+                                     WHERE country_id = $1 AND NOT soft_deleted AND id > $2
+                                     ORDER BY id
+                                     LIMIT $3
+                                 ) AS page;
+                                 """, (country_id, after_id, limit))
+            return _fetch_json(cursor)
+
+
+# Dashboard
+# Aggregates for GET /user/{id}/dashboard, every function is one query that can run on its own
+# connection in parallel with the others. timeout_ms limits the query with statement_timeout.
+
+def _set_statement_timeout(cursor, timeout_ms):
+    if timeout_ms is not None:
+        cursor.execute("SET LOCAL statement_timeout = %s;", (int(timeout_ms),))
+
+
+def get_dashboard_active_listings(con, user_id, limit=50, timeout_ms=None):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            _set_statement_timeout(cursor, timeout_ms)
+            execute_prepared(cursor, "get_dashboard_active_listings", """
+                             SELECT id, title, created_at, status_id FROM listings
+                             WHERE user_id = $1 AND NOT soft_deleted
+                             ORDER BY created_at DESC
+                             LIMIT $2;
+                             """, (user_id, limit))
+            return cursor.fetchall()
+
+
+def get_dashboard_bid_counts(con, user_id, timeout_ms=None):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            _set_statement_timeout(cursor, timeout_ms)
+            execute_prepared(cursor, "get_dashboard_bid_counts", """
+                             SELECT listings.id AS listing_id, count(*) AS bids,
+                                    max(listing_bids.bid_value) AS highest_bid
+                             FROM listings
+                             INNER JOIN listing_bids ON listing_bids.listing_id = listings.id
+                             WHERE listings.user_id = $1 AND NOT listings.soft_deleted
+                             GROUP BY listings.id;
+                             """, (user_id,))
+            return cursor.fetchall()
+
+
+def get_dashboard_view_counts(con, user_id, timeout_ms=None):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            _set_statement_timeout(cursor, timeout_ms)
+            execute_prepared(cursor, "get_dashboard_view_counts", """
+                             SELECT listings.id AS listing_id, count(*) AS views
+                             FROM listings
+                             INNER JOIN listing_views ON listing_views.listing_id = listings.id
+                             WHERE listings.user_id = $1 AND NOT listings.soft_deleted
+                             GROUP BY listings.id;
+                             """, (user_id,))
+            return cursor.fetchall()
+
+
+def get_dashboard_unread_messages(con, user_id, timeout_ms=None):
+    """
+    Messages from other users about the user's listings that the user hasn't opened yet.
+    """
+    with con:
+        with con.cursor() as cursor:
+            _set_statement_timeout(cursor, timeout_ms)
+            execute_prepared(cursor, "get_dashboard_unread_messages", """
+                             SELECT count(*) FROM user_messages
+                             INNER JOIN listings ON listings.id = user_messages.listing_id
+                             WHERE listings.user_id = $1
+                             AND user_messages.sender_user_id <> $1
+                             AND user_messages.recipient_opened_at IS NULL;
+                             """, (user_id,))
+            return cursor.fetchone()[0]
+
+
+def get_dashboard_rating_summary(con, user_id, timeout_ms=None):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            _set_statement_timeout(cursor, timeout_ms)
+            execute_prepared(cursor, "get_dashboard_rating_summary", """
+                             SELECT count(*) AS ratings,
+                                    count(*) FILTER (WHERE positive_review) AS positive_ratings,
+                                    round(avg(listing_description_rating), 2) AS description_rating,
+                                    round(avg(listing_communication_rating), 2) AS communication_rating,
+                                    round(avg(listing_delivery_time_rating), 2) AS delivery_time_rating
+                             FROM listings
+                             INNER JOIN user_ratings ON user_ratings.listing_id = listings.id
+                             WHERE listings.user_id = $1;
+                             """, (user_id,))
+            return cursor.fetchone()
+
+
+# Pricing
+
+def get_price_rollups(con, category_id, category_filter_option_ids=()):
+    """
+    The price rollups of a category itself and of the given filter options in it (see pricing_insights.py).
+    """
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_price_rollups", """
+                             SELECT category_filter_option_id, price_kind, sample_count,
+                                    p10, p25, p50, p75, p90, computed_at
+                             FROM listing_price_rollups
+                             WHERE category_id = $1
+                             AND category_filter_option_id = ANY($2::bigint[] || 0::bigint);
+                             """, (category_id, list(category_filter_option_ids)))
+            return cursor.fetchall()
+
+
+# Idempotency keys
+
+def get_idempotent_response(con, key, method, path):
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            execute_prepared(cursor, "get_idempotent_response", """
+                             SELECT request_hash, status_code, response_body
+                             FROM idempotency_keys
+                             WHERE key = $1 AND method = $2 AND path = $3 AND expires_at > now();
+                             """, (key, method, path))
+            return cursor.fetchone()
+
+
+def save_idempotent_response(con, key, method, path, request_hash, status_code, response_body, ttl):
+    """
+    Store the response for an Idempotency-Key for ttl (a timedelta). response_body is JSON text.
+    An expired row with the same key is replaced, and a few other expired rows are deleted on the way.
+    """
+    with con:
+        with con.cursor() as cursor:
+            execute_prepared(cursor, "save_idempotent_response", """
+                             INSERT INTO idempotency_keys(
+                                 key, method, path, request_hash, status_code, response_body, expires_at
+                             )
+                             VALUES ($1, $2, $3, $4, $5, $6::jsonb, now() + $7::interval)
+                             ON CONFLICT (key, method, path) DO UPDATE SET
+                                 request_hash = EXCLUDED.request_hash,
+                                 status_code = EXCLUDED.status_code,
+                                 response_body = EXCLUDED.response_body,
+                                 created_at = now(),
+                                 expires_at = EXCLUDED.expires_at
+                             WHERE idempotency_keys.expires_at <= now();
+                             """, (key, method, path, request_hash, status_code, response_body, ttl))
+            execute_prepared(cursor, "delete_expired_idempotency_keys", """
+                             DELETE FROM idempotency_keys
+                             WHERE ctid IN (
+                                 SELECT ctid FROM idempotency_keys
+                                 WHERE expires_at <= now()
+                                 LIMIT 10
+                             );
+                             """)
+
+
+# Warm-up
+
+def warm_up(con):
+    """
+    Run the hot read queries once with ids that don't exist, which prepares their statements
+    on this connection and loads the catalog caches. Used by the app before it takes traffic.
+    """
+    get_user_version(con, 0)
+    get_user(con, 0)
+    list_users_json(con, 1)
+    get_listing_version(con, 0)
+    get_listing(con, 0)
+    list_listings_json(con, 1)
+    get_listing_photos_version(con, 0)
+    get_listing_photos_json(con, 0)
+    list_listing_photos_json(con, 1)
+    list_trending_listings_json(con, 1)
+    list_saved_listings(con, 0, 1, 0)
+    list_ratings_json(con, 1)
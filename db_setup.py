@@ -1,32 +1,191 @@
+import environment  # loads .env, keep it first
 import os
+import threading
+import time
 import psycopg2
-from dotenv import load_dotenv
-from create_table_queries import all_tables_queries
-from insert_fictive_data_queries import all_fictive_data
+import metrics
+from contextlib import ExitStack, contextmanager
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 
-load_dotenv(override=True)
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 PASSWORD = os.getenv("PASSWORD")
+POOL_MIN_SIZE = int(os.getenv("POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT_SECONDS = float(os.getenv("POOL_TIMEOUT_SECONDS", "5"))
+
+
+def parse_timeouts(value):
+    """
+    Parse "<statement_timeout ms>/<lock_timeout ms>" into a tuple of ints.
+    """
+    statement_ms, _, lock_ms = value.partition("/")
+    return int(statement_ms), int(lock_ms or statement_ms)
+
+
+# statement_timeout and lock_timeout of every pooled connection, unless the borrower asks for others
+# (see query_timeouts.py for the per-route values).
+QUERY_TIMEOUTS = parse_timeouts(os.getenv("DB_QUERY_TIMEOUTS", "5000/2000"))
+
+CONNECTION_PARAMETERS = {
+    "dbname": DATABASE_NAME,
+    "user": "postgres",
+    "password": PASSWORD,
+    "host": os.getenv("DATABASE_HOST", "localhost"),
+    "port": os.getenv("DATABASE_PORT", "5432"),
+}
+# Streaming replicas for reads, e.g DATABASE_REPLICAS=localhost:5433,localhost:5434 (see replicas.py).
+REPLICA_ADDRESSES = [address.strip() for address in os.getenv("DATABASE_REPLICAS", "").split(",") if address.strip()]
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Connection that remembers which statements have been prepared in its session,
+    see db.execute_prepared.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.timeouts = None
+
+    def set_timeouts(self, timeouts):
+        """
+        Set statement_timeout and lock_timeout (milliseconds) for this session,
+        skipped when they already have these values.
+        """
+        if timeouts == self.timeouts:
+            return
+        statement_ms, lock_ms = timeouts
+        with self:
+            with self.cursor() as cursor:
+                cursor.execute("""SELECT set_config('statement_timeout', %s, false),
+                                         set_config('lock_timeout', %s, false);""",
+                               (f"{statement_ms}ms", f"{lock_ms}ms"))
+        self.timeouts = timeouts
 
 
 def get_connection():
     """
     Function that returns a single connection.
     """
-    return psycopg2.connect(
-        dbname=DATABASE_NAME,
-        user="postgres",
-        password=PASSWORD,
-        host="localhost",
-        port="5432",
-    )
+    return psycopg2.connect(connection_factory=PreparingConnection, **CONNECTION_PARAMETERS)
+
+
+# Recent time spent waiting for a pooled connection, used for load shedding.
+pool_wait = metrics.DecayingAverage()
+
+
+class DatabasePool:
+    """
+    A lazily created ThreadedConnectionPool for one database server.
+    ThreadedConnectionPool raises right away when it is empty, the semaphore makes callers wait instead.
+    """
+
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+
+    def get(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        POOL_MIN_SIZE, POOL_MAX_SIZE,
+                        connection_factory=PreparingConnection, **self.parameters
+                    )
+        return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    @contextmanager
+    def connection(self, timeout=None, query_timeouts=None):
+        """
+        Lend a connection from the pool and give it back afterwards.
+        Waits up to timeout (default POOL_TIMEOUT_SECONDS) for a free connection and raises PoolError after that.
+        The connection's statement and lock timeouts are set to query_timeouts (default QUERY_TIMEOUTS).
+        """
+        started = time.monotonic()
+        acquired = self._slots.acquire(timeout=POOL_TIMEOUT_SECONDS if timeout is None else timeout)
+        waited = time.monotonic() - started
+        pool_wait.add(waited)
+        metrics.observe("pool_wait_seconds", waited, pool=self.name)
+        if not acquired:
+            metrics.increment("pool_timeouts", pool=self.name)
+            raise PoolError("Timed out waiting for a database connection")
+        try:
+            pool = self.get()
+            connection = pool.getconn()
+            try:
+                connection.set_timeouts(query_timeouts or QUERY_TIMEOUTS)
+                yield connection
+            finally:
+                try:
+                    if not connection.closed:
+                        connection.rollback()
+                except psycopg2.Error:
+                    connection.close()
+                pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self._slots.release()
+
+    def warm_up(self, prepare):
+        """
+        Open POOL_MIN_SIZE connections at once and run prepare(connection) on each of them,
+        so the first requests don't pay for connecting and preparing statements.
+        """
+        with ExitStack() as stack:
+            for _ in range(POOL_MIN_SIZE):
+                prepare(stack.enter_context(self.connection()))
+
+
+def _replica_parameters(address):
+    host, _, port = address.partition(":")
+    # A replica that is down should fail fast, reads fall back to the primary.
+    return {**CONNECTION_PARAMETERS, "host": host, "port": port or "5432",
+            "connect_timeout": int(os.getenv("REPLICA_CONNECT_TIMEOUT", "2"))}
+
+
+primary_pool = DatabasePool("primary", CONNECTION_PARAMETERS)
+replica_pools = [DatabasePool(address, _replica_parameters(address)) for address in REPLICA_ADDRESSES]
+
+
+def get_pool():
+    """
+    Function that returns the shared connection pool of the primary, created on first use.
+    """
+    return primary_pool.get()
+
+
+def close_pool():
+    """
+    Function that closes all connections in the shared pools.
+    """
+    for pool in [primary_pool, *replica_pools]:
+        pool.close()
+
+
+def pooled_connection(query_timeouts=None):
+    """
+    Context manager that lends a connection to the primary from the pool and gives it back afterwards.
+    Waits up to POOL_TIMEOUT_SECONDS for a free connection and raises PoolError after that.
+    """
+    return primary_pool.connection(query_timeouts=query_timeouts)
 
 
 def create_tables():
     """
     Function to create the necessary tables for the project.
     """
+    # Imported here, the API never needs the (large) schema and seed SQL.
+    from create_table_queries import all_tables_queries
     connection = get_connection()
     with connection:
         with connection.cursor() as cursor:
@@ -41,6 +200,7 @@ def seed_fictive_data():
     """
     Function to fill all tables with some fictive data.
     """
+    from insert_fictive_data_queries import all_fictive_data
     connection = get_connection()
     with connection:
         with connection.cursor() as cursor:
@@ -54,4 +214,4 @@ def seed_fictive_data():
 if __name__ == "__main__":
     print(create_tables())
     # Uncomment below and run to insert fictive data:
-    # print(seed_fictive_data())        
+    # print(seed_fictive_data())
@@ -0,0 +1,29 @@
+import os
+
+"""
+Loads the .env file next to the code into os.environ, before any module reads its settings.
+
+Import it before the other project modules (app.py and db_setup.py do). python-dotenv is
+only imported when a .env file exists, so containers that get their settings from the real
+environment skip it, and the file is read from a fixed path instead of searching for it.
+"""
+
+
+ENV_FILE = os.getenv("ENV_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+_loaded = False
+
+
+def load_environment():
+    """
+    Load ENV_FILE once, values in the file win over the real environment.
+    """
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    if os.path.exists(ENV_FILE):
+        from dotenv import load_dotenv
+        load_dotenv(ENV_FILE, override=True)
+
+
+load_environment()
@@ -0,0 +1,77 @@
+import hashlib
+import os
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response, status
+
+"""
+ETag / Last-Modified support for read endpoints.
+
+An endpoint first reads a cheap version of the resource (an updated_at column
+maintained by triggers, see create_table_queries.py), builds the validators from it
+and answers If-None-Match / If-Modified-Since with 304 Not Modified before the full
+resource is fetched and serialized.
+
+Cache-Control per route can be changed with the CACHE_CONTROL_<ROUTE> environment
+variables, e.g CACHE_CONTROL_LISTING="public, max-age=60".
+"""
+
+
+CACHE_CONTROL = {
+    "user": os.getenv("CACHE_CONTROL_USER", "private, no-cache"),
+    "listing": os.getenv("CACHE_CONTROL_LISTING", "public, max-age=30, must-revalidate"),
+    "listing_photos": os.getenv("CACHE_CONTROL_LISTING_PHOTOS", "public, max-age=60, must-revalidate"),
+}
+
+
+class Validators:
+    def __init__(self, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+def make_validators(request: Request, version):
+    """
+    Build a weak ETag from the version and the request URL (query parameters like
+    fields= change the representation), and Last-Modified from the version.
+    """
+    key = f"{request.url.path}?{request.url.query}|{version.isoformat()}"
+    etag = f'W/"{hashlib.md5(key.encode()).hexdigest()[:20]}"'
+    return Validators(etag, version.astimezone(timezone.utc).replace(microsecond=0))
+
+
+def is_not_modified(request: Request, validators):
+    """
+    True when the client's cached copy is still current.
+    If-None-Match wins over If-Modified-Since, as in RFC 9110.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        weak_etag = validators.etag.removeprefix("W/")
+        return "*" in tags or any(tag.removeprefix("W/") == weak_etag for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return validators.last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def apply_headers(response: Response, validators, route):
+    """
+    Add ETag, Last-Modified and Cache-Control to a response.
+    """
+    response.headers["ETag"] = validators.etag
+    response.headers["Last-Modified"] = format_datetime(validators.last_modified, usegmt=True)
+    response.headers["Cache-Control"] = CACHE_CONTROL[route]
+    return response
+
+
+def not_modified(validators, route):
+    """
+    Return an empty 304 response with the validators.
+    """
+    return apply_headers(Response(status_code=status.HTTP_304_NOT_MODIFIED), validators, route)
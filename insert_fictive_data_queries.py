@@ -113,13 +113,13 @@ VALUES
 """
 
 newsletter_frequency_options = """
-INSERT INTO newsletter_frequency_options(title)
+INSERT INTO newsletter_frequency_options(title, send_interval, starts_after)
 VALUES
-    ('Jag vill ta del av samtliga erbjudanden, rabattkoder & rekommendationer'),
-    ('Endast 1 gång per vecka'),
-    ('Endast 1 gång varannan vecka'),
-    ('Endast 1 gång i månaden'),
-    ('Pausa alla nyhetsbrev i 3 månader')
+    ('Jag vill ta del av samtliga erbjudanden, rabattkoder & rekommendationer', '1 day',    '0 days'),
+    ('Endast 1 gång per vecka',                                                '7 days',   '0 days'),
+    ('Endast 1 gång varannan vecka',                                           '14 days',  '0 days'),
+    ('Endast 1 gång i månaden',                                                '1 month',  '0 days'),
+    ('Pausa alla nyhetsbrev i 3 månader',                                      '7 days',   '3 months')
 ;
 """
 
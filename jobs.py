@@ -0,0 +1,81 @@
+import time
+
+from db_setup import get_connection
+
+"""
+Shared pieces of the background jobs (notification_worker.py, newsletter_digest.py,
+listing_purge.py, trending.py, pricing_insights.py): progress counters and the loop
+of the jobs that periodically recompute a whole table.
+"""
+
+
+PROGRESS_EVERY_SECONDS = 10
+
+
+class ProgressMetrics:
+    """
+    Counters for a running worker, printed every PROGRESS_EVERY_SECONDS.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.monotonic()
+        self.last_report_at = self.started_at
+        self.counters = {}
+
+    def add(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report_at < PROGRESS_EVERY_SECONDS:
+            return
+        self.last_report_at = now
+        elapsed = now - self.started_at
+        parts = [f"{counter}={value} ({value / elapsed:.1f}/s)" for counter, value in self.counters.items()]
+        print(f"[{self.name}] {elapsed:.0f}s " + " ".join(parts))
+
+
+def refresh_locked(connection, lock_id, refresh):
+    """
+    Run refresh(cursor) in one transaction that holds the advisory lock lock_id, so only one
+    refresh runs at a time. Returns what refresh returned, or None when another refresh held the lock.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT pg_try_advisory_xact_lock(%s);""", (lock_id,))
+            if not cursor.fetchone()[0]:
+                return None
+            return refresh(cursor)
+
+
+def delete_unrefreshed(cursor, table):
+    """
+    Delete the rows of table that the running refresh didn't write. The refresh sets computed_at
+    to now(), which is the transaction start, on every row it writes.
+    """
+    cursor.execute(f"""DELETE FROM {table} WHERE computed_at < now();""")
+
+
+def run_refresher(name, refresh, lock_id, interval_seconds, once=False, counter="rows"):
+    """
+    Run refresh(cursor) under refresh_locked every interval_seconds, counting the rows
+    it returns as counter. A turn where another refresh held the lock is skipped.
+    """
+    connection = get_connection()
+    metrics = ProgressMetrics(name)
+    try:
+        while True:
+            started = time.monotonic()
+            refreshed = refresh_locked(connection, lock_id, refresh)
+            if refreshed is None:
+                metrics.add("refreshes_skipped")
+            else:
+                metrics.add("refreshes")
+                metrics.add(counter, refreshed)
+            metrics.report(force=True)
+            if once:
+                break
+            time.sleep(max(0.0, interval_seconds - (time.monotonic() - started)))
+    finally:
+        connection.close()
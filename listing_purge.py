@@ -0,0 +1,130 @@
+import argparse
+import time
+
+import psycopg2
+
+from create_table_queries import archived_listing_tables
+from db_setup import get_connection
+from jobs import ProgressMetrics
+
+"""
+Background job that moves long soft deleted listings to the archive tables.
+
+Listings are handled in small chunks, each in its own short transaction with a
+lock_timeout, so the job never holds many locks or blocks API traffic for long.
+Dependent rows in the tables from create_table_queries.archived_listing_tables
+are moved to their '<table>_archive' copy, saved-listing rows, trending scores and
+change events are deleted. Listings that have ratings or messages are kept, since those belong
+to other users' history.
+
+Run with: python listing_purge.py --older-than-days 90
+"""
+
+
+CHUNK_SIZE = 100
+LOCK_TIMEOUT = "2s"
+PAUSE_BETWEEN_CHUNKS_SECONDS = 0.2
+
+
+def claim_purgeable_listings(cursor, older_than_days, chunk_size=CHUNK_SIZE):
+    """
+    Lock and return ids of listings that have been soft deleted for longer than older_than_days.
+    """
+    cursor.execute("""
+                   SELECT id FROM listings
+                   WHERE soft_deleted
+                   AND soft_deleted_at < now() - make_interval(days => %s)
+                   AND NOT EXISTS (SELECT 1 FROM user_ratings WHERE user_ratings.listing_id = listings.id)
+                   AND NOT EXISTS (SELECT 1 FROM user_messages WHERE user_messages.listing_id = listings.id)
+                   ORDER BY soft_deleted_at
+                   LIMIT %s
+                   FOR UPDATE SKIP LOCKED;
+                   """, (older_than_days, chunk_size))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def table_columns(cursor, table):
+    """
+    Column names of table, in table order.
+    """
+    cursor.execute("""
+                   SELECT attname FROM pg_attribute
+                   WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+                   ORDER BY attnum;
+                   """, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def archive_listings(cursor, listing_ids):
+    """
+    Move the listings and their dependent rows to the archive tables.
+    Dependents are moved first and the listings last, so foreign keys hold throughout.
+    """
+    cursor.execute("""DELETE FROM user_saved_listings WHERE listing_id = ANY(%s);""", (listing_ids,))
+    cursor.execute("""DELETE FROM listing_trending_scores WHERE listing_id = ANY(%s);""", (listing_ids,))
+    cursor.execute("""
+                   UPDATE notification_outbox SET event_id = NULL
+                   WHERE event_id IN (SELECT id FROM listing_change_events WHERE listing_id = ANY(%s));
+                   """, (listing_ids,))
+    cursor.execute("""DELETE FROM listing_change_events WHERE listing_id = ANY(%s);""", (listing_ids,))
+
+    for table in archived_listing_tables[1:] + archived_listing_tables[:1]:
+        key = "id" if table == "listings" else "listing_id"
+        # By name, columns added by create_table_queries.column_migrations come after archived_at in the archive.
+        columns = ", ".join(table_columns(cursor, table))
+        cursor.execute(f"""
+                       WITH moved AS (
+                           DELETE FROM {table}
+                           WHERE {key} = ANY(%s)
+                           RETURNING {columns}
+                       )
+                       INSERT INTO {table}_archive({columns}, archived_at)
+                       SELECT {columns}, now() FROM moved;
+                       """, (listing_ids,))
+
+
+def purge_next_chunk(connection, older_than_days):
+    """
+    Archive one chunk of listings in its own transaction.
+    Returns the number of listings archived, 0 when there is nothing left.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""SET LOCAL lock_timeout = %s;""", (LOCK_TIMEOUT,))
+            listing_ids = claim_purgeable_listings(cursor, older_than_days)
+            if listing_ids:
+                archive_listings(cursor, listing_ids)
+    return len(listing_ids)
+
+
+def run_purge(older_than_days):
+    """
+    Archive chunks until no purgeable listings are left.
+    A chunk that runs into a lock timeout is retried after a pause.
+    """
+    connection = get_connection()
+    metrics = ProgressMetrics("purge")
+    try:
+        while True:
+            try:
+                archived = purge_next_chunk(connection, older_than_days)
+            except psycopg2.errors.LockNotAvailable:
+                metrics.add("lock_timeouts")
+                time.sleep(PAUSE_BETWEEN_CHUNKS_SECONDS * 10)
+                continue
+            if archived == 0:
+                break
+            metrics.add("listings_archived", archived)
+            metrics.report()
+            time.sleep(PAUSE_BETWEEN_CHUNKS_SECONDS)
+    finally:
+        metrics.report(force=True)
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive listings that were soft deleted long ago.")
+    parser.add_argument("--older-than-days", type=int, default=90)
+    args = parser.parse_args()
+
+    run_purge(args.older_than_days)
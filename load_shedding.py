@@ -0,0 +1,51 @@
+import os
+
+import db_setup
+import metrics
+from rate_limiting import EXEMPT_PATHS, send_json_error
+
+"""
+Adaptive load shedding.
+
+When this worker already has MAX_IN_FLIGHT_REQUESTS requests in progress, or requests
+have recently been waiting longer than POOL_WAIT_SHED_SECONDS for a database connection
+(see db_setup.pool_wait), new requests get 503 Service Unavailable with a Retry-After
+header right away instead of queueing up behind the pool.
+"""
+
+
+MAX_IN_FLIGHT_REQUESTS = int(os.getenv("MAX_IN_FLIGHT_REQUESTS", "64"))
+POOL_WAIT_SHED_SECONDS = float(os.getenv("POOL_WAIT_SHED_SECONDS", "0.5"))
+SHED_RETRY_AFTER_SECONDS = 2
+
+
+class LoadSheddingMiddleware:
+    def __init__(self, app, max_in_flight=MAX_IN_FLIGHT_REQUESTS, pool_wait_threshold=POOL_WAIT_SHED_SECONDS):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.pool_wait_threshold = pool_wait_threshold
+        self.in_flight = 0
+
+    def overload_reason(self):
+        if self.in_flight >= self.max_in_flight:
+            return "in_flight"
+        if db_setup.pool_wait.value() > self.pool_wait_threshold:
+            return "pool_wait"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        reason = self.overload_reason()
+        if reason is not None:
+            metrics.increment("shed_requests", reason=reason)
+            await send_json_error(send, 503, "Service overloaded, try again later", SHED_RETRY_AFTER_SECONDS)
+            return
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,89 @@
+import math
+import threading
+import time
+
+"""
+In-memory metrics for the running process, served as JSON by GET /metrics.
+
+- increment("name", route="/listings") counts events
+- observe("name", value, route="/listings") keeps count, sum and max of a value (sizes, durations)
+- DecayingAverage tracks a recent average that fades back to 0 when nothing is recorded
+
+Labels are given as keyword arguments. Every worker process has its own metrics.
+"""
+
+
+_lock = threading.Lock()
+_counters = {}
+_observations = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        summary = _observations.get(key)
+        if summary is None:
+            _observations[key] = {"count": 1, "sum": value, "max": value}
+        else:
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+
+def snapshot():
+    """
+    Return all metrics as {"counters": [...], "observations": [...]}.
+    """
+    with _lock:
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in _counters.items()
+        ]
+        observations = [
+            {"name": name, "labels": dict(labels), **summary,
+             "mean": summary["sum"] / summary["count"]}
+            for (name, labels), summary in _observations.items()
+        ]
+    return {"counters": counters, "observations": observations}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _observations.clear()
+
+
+class DecayingAverage:
+    """
+    Exponentially weighted average of recent values. Without new values it decays
+    towards 0 with the given half-life, so a spike stops mattering once it is over.
+    """
+
+    def __init__(self, half_life_seconds=5.0):
+        self.half_life_seconds = half_life_seconds
+        self._value = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _decayed(self, now):
+        return self._value * math.pow(0.5, (now - self._updated_at) / self.half_life_seconds)
+
+    def add(self, value):
+        now = time.monotonic()
+        with self._lock:
+            self._value = (self._decayed(now) + value) / 2
+            self._updated_at = now
+
+    def value(self):
+        with self._lock:
+            return self._decayed(time.monotonic())
@@ -0,0 +1,167 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from psycopg2.extras import Json, RealDictCursor, execute_values
+
+from db_setup import get_connection
+from jobs import ProgressMetrics
+
+"""
+Batch job that writes newsletter digests to 'notification_outbox'.
+
+A user is due when newsletters are turned on, the chosen frequency option's
+starts_after has passed since newsletter_frequency_changed_at, and send_interval
+has passed since newsletter_last_sent_at. Due users are read in chunks ordered by
+user_id, the digest for a whole chunk (newest listings in the categories the user
+has saved listings in) is built with one query, and each chunk is written and marked
+as sent in its own transaction, so memory use is bounded by CHUNK_SIZE.
+
+Workers split users by user_id modulo the number of workers.
+The outbox is then delivered by: python notification_worker.py send
+Run with: python newsletter_digest.py --workers 4
+"""
+
+
+CHUNK_SIZE = 2000
+LISTINGS_PER_DIGEST = 5
+
+
+def fetch_due_digests(connection, worker, workers, after_user_id, chunk_size=CHUNK_SIZE):
+    """
+    Return the next chunk of due users with their digest listings.
+    """
+    with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("""
+                       SELECT due.user_id, users.username, due.since,
+                              COALESCE(digest.listings, '[]') AS listings
+                       FROM (
+                           SELECT user_email_notification_settings.user_id,
+                                  COALESCE(user_email_notification_settings.newsletter_last_sent_at,
+                                           now() - newsletter_frequency_options.send_interval) AS since
+                           FROM user_email_notification_settings
+                           INNER JOIN newsletter_frequency_options
+                           ON newsletter_frequency_options.id = user_email_notification_settings.newsletter_frequency_id
+                           WHERE user_email_notification_settings.newsletters
+                           AND user_email_notification_settings.user_id > %(after_user_id)s
+                           AND user_email_notification_settings.user_id %% %(workers)s = %(worker)s
+                           AND user_email_notification_settings.newsletter_frequency_changed_at
+                               + newsletter_frequency_options.starts_after <= now()
+                           AND (user_email_notification_settings.newsletter_last_sent_at IS NULL
+                                OR user_email_notification_settings.newsletter_last_sent_at
+                                   + newsletter_frequency_options.send_interval <= now())
+                           ORDER BY user_email_notification_settings.user_id
+                           LIMIT %(chunk_size)s
+                       ) AS due
+                       INNER JOIN users
+                       ON users.id = due.user_id
+                       LEFT JOIN LATERAL (
+                           SELECT json_agg(json_build_object('listing_id', newest.id, 'title', newest.title)
+                                           ORDER BY newest.created_at DESC) AS listings
+                           FROM (
+                               SELECT listings.id, listings.title, listings.created_at
+                               FROM listings
+                               WHERE listings.category_id IN (
+                                   SELECT saved.category_id
+                                   FROM user_saved_listings
+                                   INNER JOIN listings AS saved
+                                   ON saved.id = user_saved_listings.listing_id
+                                   WHERE user_saved_listings.user_id = due.user_id
+                               )
+                               AND listings.created_at > due.since
+                               AND NOT listings.soft_deleted
+                               AND listings.user_id IS DISTINCT FROM due.user_id
+                               ORDER BY listings.created_at DESC
+                               LIMIT %(per_digest)s
+                           ) AS newest
+                       ) AS digest ON true
+                       ORDER BY due.user_id;
+                       """, {
+                           "after_user_id": after_user_id,
+                           "workers": workers,
+                           "worker": worker,
+                           "chunk_size": chunk_size,
+                           "per_digest": LISTINGS_PER_DIGEST,
+                       })
+        return cursor.fetchall()
+
+
+def render_digest(digest):
+    """
+    Render the outbox payload for one user's digest.
+    """
+    lines = [f"Hej {digest['username']}!", "", "Nya annonser som du kanske gillar:"]
+    for listing in digest["listings"]:
+        lines.append(f"- {listing['title']} (/listing/{listing['listing_id']})")
+    return {
+        "subject": "Ditt nyhetsbrev",
+        "body": "\n".join(lines),
+        "listings": digest["listings"],
+    }
+
+
+def write_digests(connection, digests):
+    """
+    Write rendered digests to the outbox and mark every user in the chunk as sent.
+    Users without any new listings get no mail but still wait a full interval.
+    """
+    rows = [
+        (digest["user_id"], "newsletter_digest", Json(render_digest(digest)))
+        for digest in digests if digest["listings"]
+    ]
+    with connection.cursor() as cursor:
+        if rows:
+            execute_values(cursor, """
+                           INSERT INTO notification_outbox(user_id, kind, payload)
+                           VALUES %s;
+                           """, rows)
+        cursor.execute("""
+                       UPDATE user_email_notification_settings
+                       SET newsletter_last_sent_at = now()
+                       WHERE user_id = ANY(%s);
+                       """, ([digest["user_id"] for digest in digests],))
+    return len(rows)
+
+
+def run_worker(worker, workers):
+    """
+    Build digests for every due user in this worker's share of users.
+    """
+    connection = get_connection()
+    metrics = ProgressMetrics(f"digest {worker + 1}/{workers}")
+    after_user_id = 0
+    try:
+        while True:
+            with connection:
+                digests = fetch_due_digests(connection, worker, workers, after_user_id)
+                if not digests:
+                    break
+                written = write_digests(connection, digests)
+            after_user_id = digests[-1]["user_id"]
+            metrics.add("users_processed", len(digests))
+            metrics.add("digests_written", written)
+            metrics.report()
+    finally:
+        metrics.report(force=True)
+        connection.close()
+    return metrics.counters
+
+
+def run_digests(workers):
+    """
+    Run the digest job with the given number of worker processes.
+    """
+    if workers == 1:
+        return [run_worker(0, 1)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_worker, range(workers), [workers] * workers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build newsletter digests for all due users.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    results = run_digests(args.workers)
+    print(f"Users processed: {sum(result.get('users_processed', 0) for result in results)}")
+    print(f"Digests written: {sum(result.get('digests_written', 0) for result in results)}")
@@ -0,0 +1,233 @@
+import argparse
+import time
+
+from psycopg2.extras import RealDictCursor
+
+from db_setup import get_connection
+from jobs import ProgressMetrics
+
+"""
+Background worker that turns listing change events into notifications.
+
+- fanout: claims one unprocessed row from 'listing_change_events' at a time and
+  writes a 'notification_outbox' row for every user that saved the listing and
+  has favorites_list_updates turned on. Users are resolved in batches ordered by
+  user_id, and the event remembers how far it got, so a crash resumes where it stopped.
+- send: delivers unsent outbox rows through a mail sender and marks them as sent.
+
+Several workers can run at the same time, rows are claimed with FOR UPDATE SKIP LOCKED.
+Run with: python notification_worker.py fanout   (or: send)
+"""
+
+
+FANOUT_BATCH_SIZE = 5000
+SEND_BATCH_SIZE = 500
+# Fan-out pauses when this many notifications are waiting to be sent,
+# and resumes when the sender has brought it down to the low watermark.
+OUTBOX_HIGH_WATERMARK = 200_000
+OUTBOX_LOW_WATERMARK = 50_000
+BACKPRESSURE_CHECK_EVERY = 10
+IDLE_SLEEP_SECONDS = 2
+
+
+class LocalMailSender:
+    """
+    Stand-in for a real mail sender, prints every mail or appends it to a file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def send(self, email, kind, payload):
+        line = f"To: {email} | {kind} | {payload}"
+        if self.path is None:
+            print(line)
+        else:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+
+
+def count_unsent_notifications(connection):
+    """
+    Return the number of outbox rows waiting to be sent. Ends its transaction, so the connection
+    doesn't sit idle in transaction while the caller sleeps.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT count(*) FROM notification_outbox WHERE sent_at IS NULL;""")
+            return cursor.fetchone()[0]
+
+
+def wait_for_outbox_capacity(connection, metrics):
+    """
+    Block while the outbox is above the high watermark.
+    """
+    if count_unsent_notifications(connection) < OUTBOX_HIGH_WATERMARK:
+        return
+    metrics.add("backpressure_pauses")
+    while count_unsent_notifications(connection) > OUTBOX_LOW_WATERMARK:
+        metrics.report()
+        time.sleep(IDLE_SLEEP_SECONDS)
+
+
+def fan_out_next_batch(connection, batch_size=FANOUT_BATCH_SIZE):
+    """
+    Claim the oldest unprocessed change event and write one batch of its notifications.
+    Returns (users_in_batch, notifications_written, event_finished),
+    or None when there are no events to process.
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                           SELECT id, listing_id, change_type, fanout_after_user_id
+                           FROM listing_change_events
+                           WHERE processed_at IS NULL
+                           ORDER BY id
+                           LIMIT 1
+                           FOR UPDATE SKIP LOCKED;
+                           """)
+            event = cursor.fetchone()
+            if not event:
+                return None
+            cursor.execute("""
+                           WITH batch AS (
+                               SELECT user_saved_listings.user_id
+                               FROM user_saved_listings
+                               LEFT JOIN user_email_notification_settings
+                               ON user_email_notification_settings.user_id = user_saved_listings.user_id
+                               WHERE user_saved_listings.listing_id = %(listing_id)s
+                               AND user_saved_listings.user_id > %(after_user_id)s
+                               -- Users without a settings row get the column default, true.
+                               AND coalesce(user_email_notification_settings.favorites_list_updates, true)
+                               ORDER BY user_saved_listings.user_id
+                               LIMIT %(batch_size)s
+                           ),
+                           inserted AS (
+                               INSERT INTO notification_outbox(user_id, kind, event_id, payload)
+                               SELECT batch.user_id, 'favorites_list_update', %(event_id)s,
+                                      json_build_object(
+                                          'listing_id', listings.id,
+                                          'title', listings.title,
+                                          'change_type', %(change_type)s
+                                      )
+                               FROM batch
+                               INNER JOIN listings
+                               ON listings.id = %(listing_id)s
+                               ON CONFLICT (event_id, user_id) DO NOTHING
+                               RETURNING 1
+                           )
+                           SELECT count(*) AS users_in_batch,
+                                  max(user_id) AS last_user_id,
+                                  (SELECT count(*) FROM inserted) AS written
+                           FROM batch;
+                           """, {
+                               "event_id": event["id"],
+                               "listing_id": event["listing_id"],
+                               "change_type": event["change_type"],
+                               "after_user_id": event["fanout_after_user_id"],
+                               "batch_size": batch_size,
+                           })
+            batch = cursor.fetchone()
+            finished = batch["users_in_batch"] < batch_size
+            cursor.execute("""
+                           UPDATE listing_change_events
+                           SET fanout_after_user_id = COALESCE(%s, fanout_after_user_id),
+                               processed_at = CASE WHEN %s THEN now() END
+                           WHERE id = %s;
+                           """, (batch["last_user_id"], finished, event["id"]))
+    return batch["users_in_batch"], batch["written"], finished
+
+
+def send_next_batch(connection, sender, batch_size=SEND_BATCH_SIZE):
+    """
+    Claim a batch of unsent outbox rows, send them and mark them as sent.
+    If sending fails the transaction is rolled back and the rows stay unsent.
+    Returns the number of notifications sent.
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                           UPDATE notification_outbox
+                           SET sent_at = now()
+                           FROM users
+                           WHERE users.id = notification_outbox.user_id
+                           AND notification_outbox.id IN (
+                               SELECT id FROM notification_outbox
+                               WHERE sent_at IS NULL
+                               ORDER BY id
+                               LIMIT %s
+                               FOR UPDATE SKIP LOCKED
+                           )
+                           RETURNING notification_outbox.id, users.email,
+                                     notification_outbox.kind, notification_outbox.payload;
+                           """, (batch_size,))
+            notifications = cursor.fetchall()
+            for notification in notifications:
+                sender.send(notification["email"], notification["kind"], notification["payload"])
+    return len(notifications)
+
+
+def run_fanout(once=False):
+    """
+    Fan out change events until stopped (or until none are left when once=True).
+    """
+    connection = get_connection()
+    metrics = ProgressMetrics("fanout")
+    batches = 0
+    try:
+        while True:
+            if batches % BACKPRESSURE_CHECK_EVERY == 0:
+                wait_for_outbox_capacity(connection, metrics)
+            result = fan_out_next_batch(connection)
+            if result is None:
+                if once:
+                    break
+                metrics.report()
+                time.sleep(IDLE_SLEEP_SECONDS)
+                continue
+            users_in_batch, written, finished = result
+            batches += 1
+            metrics.add("batches")
+            metrics.add("users_resolved", users_in_batch)
+            metrics.add("notifications_written", written)
+            if finished:
+                metrics.add("events_processed")
+            metrics.report()
+    finally:
+        metrics.report(force=True)
+        connection.close()
+
+
+def run_sender(sender, once=False):
+    """
+    Send outbox notifications until stopped (or until none are left when once=True).
+    """
+    connection = get_connection()
+    metrics = ProgressMetrics("send")
+    try:
+        while True:
+            sent = send_next_batch(connection, sender)
+            if sent == 0:
+                if once:
+                    break
+                metrics.report()
+                time.sleep(IDLE_SLEEP_SECONDS)
+                continue
+            metrics.add("notifications_sent", sent)
+            metrics.report()
+    finally:
+        metrics.report(force=True)
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Favorites-update notification worker.")
+    parser.add_argument("mode", choices=["fanout", "send"])
+    parser.add_argument("--once", action="store_true", help="Stop when there is nothing left to do.")
+    parser.add_argument("--mail-log", help="Write mails to this file instead of printing them.")
+    args = parser.parse_args()
+
+    if args.mode == "fanout":
+        run_fanout(once=args.once)
+    else:
+        run_sender(LocalMailSender(args.mail_log), once=args.once)
@@ -0,0 +1,515 @@
+import argparse
+import functools
+import sys
+import uuid
+from datetime import timedelta
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import db
+import db_setup
+import pricing_insights
+import shipping_quotes
+import trending
+from benchmarks import print_table
+
+"""
+Query plan regression checks for the statements behind the endpoints in app.py.
+
+Every check calls a db.py function the way an endpoint does, on a connection that runs
+EXPLAIN (ANALYZE, BUFFERS) for each statement before executing it. The EXPLAIN runs in a
+savepoint that is rolled back, so writes only take effect once. Each plan is checked for:
+
+- no sequential scan on a large table (at least LARGE_TABLE_ROWS rows by pg_class.reltuples),
+  unless the check allows it with "seq_scans"
+- the indexes the check expects ("indexes") show up in the plan
+- row estimates of table scans within ROW_ESTIMATE_FACTOR of the actual rows, for scans
+  with at least ROW_ESTIMATE_MIN_ROWS rows that don't run under a LIMIT
+- execution time ("max_ms") and shared buffers touched ("max_buffers") within budget,
+  DEFAULT_BUDGET unless the check sets its own
+
+The script exits with status 1 when any plan fails, so it can run in CI after a change to a
+query, an index or the schema. Statements run as plain queries, so Postgres plans them for the
+actual parameter values (a custom plan).
+
+--generate creates the tables, seeds the fictive data when the database is empty and adds
+a scaled dataset on top (--scale 1 is about 10 000 listings), then refreshes the trending
+scores and price rollups and runs ANALYZE. Use a scratch database, the write checks add rows.
+
+Run with: python plan_check.py --generate --scale 10
+          python plan_check.py
+          python plan_check.py --checks get_listing list_saved_listings
+"""
+
+
+LARGE_TABLE_ROWS = 10_000
+ROW_ESTIMATE_FACTOR = 10
+ROW_ESTIMATE_MIN_ROWS = 100
+DEFAULT_BUDGET = {"max_ms": 50.0, "max_buffers": 2_000}
+GENERATED = "Generated by plan_check.py"
+
+# Statements that are explained, SET and the like are only executed.
+EXPLAINED_STATEMENTS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+# The scaled dataset, every statement gets the sizes from generate_data as parameters.
+SCALED_DATA = [
+    f"""
+    INSERT INTO users(username, email, description)
+    SELECT 'plan_user_' || (base + n), 'plan_user_' || (base + n) || '@example.com', '{GENERATED}'
+    FROM generate_series(1, %(users)s) AS n,
+         (SELECT coalesce(max(id), 0) AS base FROM users) AS offsets;
+    """,
+    # Sellers get a location before their listings, the listings copy it (see location triggers).
+    f"""
+    INSERT INTO user_details(user_id, city_id, country_id)
+    SELECT users.id, cities.ids[1 + mod(users.id, cardinality(cities.ids))],
+           cities.country_ids[1 + mod(users.id, cardinality(cities.ids))]
+    FROM users,
+         (SELECT array_agg(id ORDER BY id) AS ids, array_agg(country_id ORDER BY id) AS country_ids
+          FROM cities) AS cities
+    WHERE users.description = '{GENERATED}'
+    ON CONFLICT DO NOTHING;
+    """,
+    f"""
+    INSERT INTO listings(title, description, user_id, type_id, status_id, category_id,
+                         created_at, soft_deleted, soft_deleted_at)
+    SELECT 'Generated listing ' || n, '{GENERATED}',
+           sellers.ids[1 + floor(cardinality(sellers.ids) * random())::int],
+           types.ids[1 + mod(n, cardinality(types.ids))],
+           statuses.ids[1 + mod(n, cardinality(statuses.ids))],
+           categories.ids[1 + mod(n, cardinality(categories.ids))],
+           now() - random() * interval '365 days',
+           mod(n, 20) = 0, CASE WHEN mod(n, 20) = 0 THEN now() END
+    FROM generate_series(1, %(listings)s) AS n,
+         (SELECT array_agg(id) AS ids FROM users WHERE description = '{GENERATED}') AS sellers,
+         (SELECT array_agg(id) AS ids FROM listing_types) AS types,
+         (SELECT array_agg(id) AS ids FROM listing_statuses) AS statuses,
+         (SELECT array_agg(id) AS ids FROM listing_categories) AS categories;
+    """,
+    f"""
+    INSERT INTO listing_photos(listing_id, url, view_order)
+    SELECT listings.id, 'https://example.com/plan-check/' || listings.id || '/' || position || '.jpg', position
+    FROM listings, generate_series(1, %(photos_per_listing)s) AS position
+    WHERE listings.description = '{GENERATED}'
+    ON CONFLICT (url) DO NOTHING;
+    """,
+    f"""
+    INSERT INTO listing_buynow_attributes(listing_id, price)
+    SELECT id, round((10 + random() * 990)::numeric, 2)
+    FROM listings
+    WHERE description = '{GENERATED}' AND mod(id, 2) = 0
+    ON CONFLICT DO NOTHING;
+    """,
+    f"""
+    INSERT INTO listing_attributes(listing_id, category_filter_option_id)
+    SELECT DISTINCT ON (listings.id) listings.id, options.id
+    FROM listings
+    INNER JOIN listing_category_filters AS filters ON filters.listing_category_id = listings.category_id
+    INNER JOIN listing_category_filter_options AS options ON options.listing_filter_id = filters.id
+    WHERE listings.description = '{GENERATED}'
+    ORDER BY listings.id, mod(listings.id + options.id, 7)
+    ON CONFLICT DO NOTHING;
+    """,
+    f"""
+    INSERT INTO listing_bids(user_id, listing_id, bid_value, bid_at)
+    SELECT buyers.ids[1 + floor(cardinality(buyers.ids) * random())::int], listings.id,
+           round((10 + position * 5 + random() * 5)::numeric, 2), now() - random() * interval '30 days'
+    FROM listings,
+         generate_series(1, %(bids_per_listing)s) AS position,
+         (SELECT array_agg(id) AS ids FROM users WHERE description = '{GENERATED}') AS buyers
+    WHERE listings.description = '{GENERATED}' AND mod(listings.id, 3) = 0;
+    """,
+    f"""
+    INSERT INTO listing_views(ip_address, listing_id, viewed_at)
+    SELECT '100.64.0.0'::inet + (listings.id * 100 + position), listings.id, now() - random() * interval '30 days'
+    FROM listings, generate_series(1, %(views_per_listing)s) AS position
+    WHERE listings.description = '{GENERATED}'
+    ON CONFLICT DO NOTHING;
+    """,
+    f"""
+    INSERT INTO user_saved_listings(user_id, listing_id, saved_at)
+    SELECT savers.ids[1 + floor(cardinality(savers.ids) * random())::int], listings.id,
+           now() - random() * interval '30 days'
+    FROM listings,
+         generate_series(1, 3) AS position,
+         (SELECT array_agg(id) AS ids FROM users WHERE description = '{GENERATED}') AS savers
+    WHERE listings.description = '{GENERATED}'
+    ON CONFLICT DO NOTHING;
+    """,
+    f"""
+    INSERT INTO user_messages(sender_user_id, listing_id, body, created_at, recipient_opened_at)
+    SELECT senders.ids[1 + floor(cardinality(senders.ids) * random())::int], listings.id,
+           'Is this still available?', now() - random() * interval '30 days',
+           CASE WHEN mod(listings.id + position, 3) = 0 THEN NULL ELSE now() END
+    FROM listings,
+         generate_series(1, 2) AS position,
+         (SELECT array_agg(id) AS ids FROM users WHERE description = '{GENERATED}') AS senders
+    WHERE listings.description = '{GENERATED}';
+    """,
+    f"""
+    INSERT INTO user_ratings(listing_id, reviewing_user_id, reviewed_at, positive_review,
+                             listing_description_rating, listing_communication_rating,
+                             listing_delivery_time_rating)
+    SELECT listings.id, reviewers.ids[1 + floor(cardinality(reviewers.ids) * random())::int],
+           now() - random() * interval '365 days', random() > 0.1,
+           1 + mod(listings.id, 5), 1 + mod(listings.id + 1, 5), 1 + mod(listings.id + 2, 5)
+    FROM listings,
+         (SELECT array_agg(id) AS ids FROM users WHERE description = '{GENERATED}') AS reviewers
+    WHERE listings.description = '{GENERATED}' AND mod(listings.id, 4) = 0
+    ON CONFLICT DO NOTHING;
+    """,
+]
+
+
+class ExplainingCursor:
+    """
+    Cursor mixin that runs EXPLAIN (ANALYZE, BUFFERS) for a statement before executing it
+    and adds (statement, plan) to connection.plans.
+    """
+
+    def execute(self, query, vars=None):
+        statement = self.mogrify(query, vars).decode()
+        if statement.split(None, 1)[0].upper() in EXPLAINED_STATEMENTS:
+            super().execute("SAVEPOINT plan_check;")
+            try:
+                super().execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}")
+                row = super().fetchone()
+                plan = row["QUERY PLAN"] if isinstance(row, dict) else row[0]
+                self.connection.plans.append((statement, plan[0]))
+            finally:
+                super().execute("ROLLBACK TO SAVEPOINT plan_check;")
+        return super().execute(query, vars)
+
+
+@functools.cache
+def _explaining(cursor_class):
+    return type(f"Explaining{cursor_class.__name__}", (ExplainingCursor, cursor_class), {})
+
+
+class ExplainingConnection(psycopg2.extensions.connection):
+    """
+    Connection whose cursors explain every statement, see ExplainingCursor. It doesn't keep
+    track of prepared statements, so db.execute_prepared runs plain queries on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.plans = []
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        cursor_class = cursor_factory or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(*args, cursor_factory=_explaining(cursor_class), **kwargs)
+
+
+def generate_data(scale):
+    """
+    Create the tables, seed the fictive data when there are no users yet and add the scaled dataset.
+    """
+    print(db_setup.create_tables())
+    connection = db_setup.get_connection()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""SELECT NOT EXISTS (SELECT 1 FROM users);""")
+                empty = cursor.fetchone()[0]
+        if empty:
+            print(db_setup.seed_fictive_data())
+        sizes = {
+            "users": 1_000 * scale,
+            "listings": 10_000 * scale,
+            "photos_per_listing": 4,
+            "bids_per_listing": 5,
+            "views_per_listing": 10,
+        }
+        with connection:
+            with connection.cursor() as cursor:
+                for statement in SCALED_DATA:
+                    cursor.execute(statement, sizes)
+        trending.refresh_trending_scores(connection)
+        pricing_insights.refresh_price_rollups(connection)
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("""ANALYZE;""")
+    finally:
+        connection.close()
+    print(f"Generated {sizes['listings']} listings for {sizes['users']} users.")
+
+
+def sample_ids(connection):
+    """
+    Ids for the checks, picked to be the expensive cases: the seller with the most listings,
+    their listing with the most photos and the category with the most trending listings.
+    """
+    with connection:
+        with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                           SELECT user_id FROM listings
+                           WHERE NOT soft_deleted AND user_id IS NOT NULL
+                           GROUP BY user_id ORDER BY count(*) DESC LIMIT 1;
+                           """)
+            user_id = cursor.fetchone()["user_id"]
+            cursor.execute("""SELECT min(id) AS id FROM users WHERE id <> %s;""", (user_id,))
+            other_user_id = cursor.fetchone()["id"]
+            cursor.execute("""
+                           SELECT listings.id, listings.category_id FROM listings
+                           LEFT JOIN listing_photos ON listing_photos.listing_id = listings.id
+                           WHERE listings.user_id = %s AND NOT listings.soft_deleted
+                           GROUP BY listings.id ORDER BY count(listing_photos.id) DESC LIMIT 1;
+                           """, (user_id,))
+            listing = cursor.fetchone()
+            cursor.execute("""
+                           SELECT array_agg(id ORDER BY view_order, id) AS ids FROM listing_photos
+                           WHERE listing_id = %s;
+                           """, (listing["id"],))
+            photo_ids = cursor.fetchone()["ids"] or []
+            cursor.execute("""
+                           SELECT category_id FROM listing_trending_scores
+                           WHERE category_id IS NOT NULL
+                           GROUP BY category_id ORDER BY count(*) DESC LIMIT 1;
+                           """)
+            trending_category = cursor.fetchone()
+            category_id = trending_category["category_id"] if trending_category else listing["category_id"]
+            cursor.execute("""
+                           SELECT array_agg(DISTINCT category_filter_option_id) AS ids
+                           FROM listing_price_rollups
+                           WHERE category_id = %s AND category_filter_option_id <> 0;
+                           """, (category_id,))
+            option_ids = (cursor.fetchone()["ids"] or [])[:5]
+            cursor.execute("""SELECT min(id) AS id FROM newsletter_frequency_options;""")
+            frequency_id = cursor.fetchone()["id"]
+            cursor.execute("""SELECT id, country_id FROM cities ORDER BY id LIMIT 1;""")
+            city = cursor.fetchone()
+    return {
+        "user_id": user_id,
+        "other_user_id": other_user_id,
+        "listing_id": listing["id"],
+        "photo_ids": photo_ids,
+        "category_id": category_id,
+        "option_ids": option_ids,
+        "frequency_id": frequency_id,
+        "city_id": city["id"],
+        "country_id": city["country_id"],
+    }
+
+
+def new_user(connection):
+    name = f"plan_check_{uuid.uuid4().hex[:12]}"
+    return db.add_user(connection, name, f"{name}@example.com")
+
+
+def new_listing(connection, ids):
+    name = uuid.uuid4().hex[:12]
+    listing = {
+        "user_id": ids["user_id"], "title": f"Plan check {name}", "description": GENERATED,
+        "pickup_available": False, "buyer_insurance": True, "type_id": None, "status_id": None,
+        "category_id": ids["category_id"],
+    }
+    buy_now = {"price": 100, "auto_republish": False, "storage_location": None,
+               "charity_id": None, "share_info_upon_donation": False}
+    photos = [(f"https://example.com/plan-check/{name}/{position}.jpg", position) for position in range(1, 4)]
+    return db.create_listing(connection, listing, buy_now=buy_now, photos=photos,
+                             category_filter_option_ids=ids["option_ids"])
+
+
+def plan_checks(ids):
+    """
+    The statements behind the endpoints, as (name, function(connection), budget) triples.
+    budget overrides DEFAULT_BUDGET and can list the "indexes" a plan has to use and the
+    large tables it may scan sequentially ("seq_scans").
+    """
+    user_id, listing_id = ids["user_id"], ids["listing_id"]
+    settings = (True, False, True, False, True, False, False, True, ids["frequency_id"])
+    return [
+        # Users
+        ("get_user_version", lambda con: db.get_user_version(con, user_id), {}),
+        ("get_user", lambda con: db.get_user(con, user_id), {}),
+        ("list_users_json", lambda con: db.list_users_json(con, 25), {}),
+        ("get_user_newsletter_frequency", lambda con: db.get_user_newsletter_frequency(con, user_id), {}),
+        ("add_user", new_user, {}),
+        ("add_country", lambda con: db.add_country(con, f"Plan check {uuid.uuid4().hex[:12]}"), {}),
+        ("add_city", lambda con: db.add_city(con, f"Plan check {uuid.uuid4().hex[:12]}", ids["country_id"]), {}),
+        ("add_newsletter_frequency_option",
+         lambda con: db.add_newsletter_frequency_option(con, f"Plan check {uuid.uuid4().hex[:12]}",
+                                                        timedelta(days=7), timedelta(0)), {}),
+        ("add_user_details",
+         lambda con: db.add_user_details(con, new_user(con), "Plan", "Check", 12345678, "Street 1",
+                                         1234, ids["city_id"], ids["country_id"], False), {}),
+        ("add_user_notification_settings",
+         lambda con: db.add_user_notification_settings(con, new_user(con), *settings), {}),
+        ("upsert_user_details",
+         lambda con: db.upsert_user_details(con, user_id, "Plan", "Check", 12345678, "Street 1",
+                                            1234, ids["city_id"], ids["country_id"], False), {}),
+        ("upsert_user_notification_settings",
+         lambda con: db.upsert_user_notification_settings(con, user_id, *settings), {}),
+        # Listings
+        ("get_listing_version", lambda con: db.get_listing_version(con, listing_id), {}),
+        ("get_listing", lambda con: db.get_listing(con, listing_id), {}),
+        ("list_listings_json", lambda con: db.list_listings_json(con, 25), {}),
+        ("list_trending_listings_json", lambda con: db.list_trending_listings_json(con, 25),
+         {"indexes": ["listing_trending_scores_score_idx"]}),
+        ("list_trending_listings_json_category",
+         lambda con: db.list_trending_listings_json(con, 25, ids["category_id"]),
+         {"indexes": ["listing_trending_scores_category_id_score_idx"]}),
+        ("create_listing", lambda con: new_listing(con, ids), {}),
+        ("soft_delete_listing", lambda con: db.soft_delete_listing(con, 0), {}),
+        ("get_listing_photos_version", lambda con: db.get_listing_photos_version(con, listing_id), {}),
+        ("get_listing_photos_json", lambda con: db.get_listing_photos_json(con, listing_id),
+         {"indexes": ["listing_photos_listing_id_view_order_idx"]}),
+        ("list_listing_photos_json", lambda con: db.list_listing_photos_json(con, 25), {}),
+        ("delete_listing_photo", lambda con: db.delete_listing_photo(con, 0), {}),
+        # Id 0 doesn't exist, so the whole set is rejected and nothing is deleted.
+        ("delete_listing_photos", lambda con: db.delete_listing_photos(con, listing_id, user_id, [*ids["photo_ids"], 0]),
+         {}),
+        ("reorder_listing_photos", lambda con: db.reorder_listing_photos(con, listing_id, user_id, ids["photo_ids"]),
+         {}),
+        ("get_listing_shipping_settings", lambda con: db.get_listing_shipping_settings(con, listing_id), {}),
+        ("load_shipping_matrix", shipping_quotes.load_shipping_matrix, {}),
+        # Saved listings
+        ("list_saved_listings", lambda con: db.list_saved_listings(con, user_id, 25, 0), {}),
+        ("add_saved_listing", lambda con: db.add_saved_listing(con, ids["other_user_id"], listing_id), {}),
+        ("delete_saved_listing", lambda con: db.delete_saved_listing(con, ids["other_user_id"], 0), {}),
+        # Ratings
+        ("get_received_ratings", lambda con: db.get_received_ratings(con, user_id), {}),
+        ("get_provided_ratings", lambda con: db.get_provided_ratings(con, user_id), {}),
+        ("list_ratings_json", lambda con: db.list_ratings_json(con, 25), {}),
+        # Locations
+        ("list_country_listing_counts", db.list_country_listing_counts, {}),
+        ("list_city_listing_counts", lambda con: db.list_city_listing_counts(con, ids["country_id"]), {}),
+        ("list_listings_by_location_json_country",
+         lambda con: db.list_listings_by_location_json(con, 25, country_id=ids["country_id"]), {}),
+        ("list_listings_by_location_json_city",
+         lambda con: db.list_listings_by_location_json(con, 25, city_id=ids["city_id"]),
+         {"indexes": ["listings_city_id_id_idx"]}),
+        # Dashboard
+        ("get_dashboard_active_listings", lambda con: db.get_dashboard_active_listings(con, user_id),
+         {"indexes": ["listings_user_id_created_at_idx"]}),
+        ("get_dashboard_bid_counts", lambda con: db.get_dashboard_bid_counts(con, user_id), {}),
+        ("get_dashboard_view_counts", lambda con: db.get_dashboard_view_counts(con, user_id), {}),
+        ("get_dashboard_unread_messages", lambda con: db.get_dashboard_unread_messages(con, user_id), {}),
+        ("get_dashboard_rating_summary", lambda con: db.get_dashboard_rating_summary(con, user_id), {}),
+        # Pricing
+        ("get_price_rollups", lambda con: db.get_price_rollups(con, ids["category_id"], ids["option_ids"]),
+         {"indexes": ["listing_price_rollups_pkey"]}),
+        # Idempotency keys
+        ("get_idempotent_response",
+         lambda con: db.get_idempotent_response(con, uuid.uuid4().hex, "PUT", "/user/1/details"),
+         {"indexes": ["idempotency_keys_pkey"]}),
+        ("save_idempotent_response",
+         lambda con: db.save_idempotent_response(con, uuid.uuid4().hex, "PUT", "/user/1/details",
+                                                 "plan_check", 200, "{}", timedelta(minutes=1)), {}),
+    ]
+
+
+def large_tables(connection):
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                           SELECT relname FROM pg_class
+                           WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace
+                           AND reltuples >= %s;
+                           """, (LARGE_TABLE_ROWS,))
+            return {row[0] for row in cursor.fetchall()}
+
+
+def plan_nodes(node, under_limit=False):
+    """
+    Yield (node, under_limit) for a plan node and all nodes below it.
+    """
+    yield node, under_limit
+    under_limit = under_limit or node["Node Type"] == "Limit"
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child, under_limit)
+
+
+def check_plan(plan, budget, large):
+    """
+    Return the problems with one EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) plan, an empty list when it passes.
+    """
+    problems = []
+    root = plan["Plan"]
+    if plan["Execution Time"] > budget["max_ms"]:
+        problems.append(f"took {plan['Execution Time']:.1f} ms, budget {budget['max_ms']} ms")
+    buffers = root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0)
+    if buffers > budget["max_buffers"]:
+        problems.append(f"touched {buffers} buffers, budget {budget['max_buffers']}")
+
+    used_indexes = set()
+    for node, under_limit in plan_nodes(root):
+        relation = node.get("Relation Name")
+        if "Index Name" in node:
+            used_indexes.add(node["Index Name"])
+        if node["Node Type"] in ("Seq Scan", "Parallel Seq Scan") and relation in large \
+                and relation not in budget.get("seq_scans", ()):
+            problems.append(f"sequential scan on {relation}")
+        if relation is None or under_limit or not node.get("Actual Loops"):
+            continue
+        estimated, actual = node["Plan Rows"], node["Actual Rows"]
+        if max(estimated, actual) >= ROW_ESTIMATE_MIN_ROWS \
+                and max(estimated, actual) > ROW_ESTIMATE_FACTOR * max(min(estimated, actual), 1):
+            problems.append(f"{relation}: estimated {estimated} rows, got {actual}")
+    for index in budget.get("indexes", ()):
+        if index not in used_indexes:
+            problems.append(f"doesn't use {index}")
+    return problems
+
+
+def run_checks(names=None):
+    """
+    Run the checks (all of them, or the ones in names), print a table and return the number of failed statements.
+    """
+    connection = psycopg2.connect(connection_factory=ExplainingConnection, **db_setup.CONNECTION_PARAMETERS)
+    try:
+        ids = sample_ids(connection)
+        large = large_tables(connection)
+        rows, failures = [], []
+        for name, function, overrides in plan_checks(ids):
+            if names and name not in names:
+                continue
+            budget = {**DEFAULT_BUDGET, **overrides}
+            connection.plans = []
+            try:
+                function(connection)
+            except psycopg2.Error as error:
+                failures.append((name, "", [f"failed: {error}".strip()]))
+                rows.append((name, "", "", "", "", "ERROR"))
+                continue
+            finally:
+                connection.rollback()
+            for number, (statement, plan) in enumerate(connection.plans, start=1):
+                label = name if len(connection.plans) == 1 else f"{name} #{number}"
+                problems = check_plan(plan, budget, large)
+                root = plan["Plan"]
+                rows.append((
+                    label,
+                    root["Node Type"],
+                    f"{plan['Execution Time']:.2f}",
+                    root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0),
+                    f"{root['Plan Rows']}/{root['Actual Rows']}",
+                    "FAIL" if problems else "ok",
+                ))
+                if problems:
+                    failures.append((label, statement, problems))
+    finally:
+        connection.close()
+
+    print_table(["statement", "top node", "ms", "buffers", "rows est/actual", "result"], rows)
+    for label, statement, problems in failures:
+        print(f"\n{label}:")
+        for problem in problems:
+            print(f"  - {problem}")
+        if statement:
+            print("  " + " ".join(statement.split()))
+    return len(failures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the query plans of the endpoint statements.")
+    parser.add_argument("--generate", action="store_true", help="Create the tables and add a scaled dataset first.")
+    parser.add_argument("--scale", type=int, default=1, help="Dataset size for --generate, 1 is about 10 000 listings.")
+    parser.add_argument("--checks", nargs="+", help="Only run these checks.")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_data(args.scale)
+    sys.exit(1 if run_checks(args.checks) else 0)
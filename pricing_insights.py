@@ -0,0 +1,147 @@
+import argparse
+import os
+
+from jobs import delete_unrefreshed, refresh_locked, run_refresher
+
+"""
+Price percentiles per category and category filter option, for GET /pricing-insights.
+
+A background refresh recomputes listing_price_rollups from the listings of the last
+PRICING_WINDOW_DAYS in a single set-based query: Postgres sorts each group once and
+reads all percentiles from the same sort (percentile_cont with an array of fractions),
+which stays a few sequential passes even over millions of rows. Rollups are kept per
+price kind:
+
+- buynow: listing_buynow_attributes.price
+- highest_bid: the highest listing_bids.bid_value per listing
+- suggestion: listing_price_suggestions.suggested_price
+
+and per category (category_filter_option_id 0) and per category and filter option.
+Combinations of several options are not rolled up, they would multiply the table;
+choose_rollups picks the requested single option with the most samples instead, as long
+as it has PRICING_MIN_SAMPLES, and the whole category otherwise.
+
+Run with: python pricing_insights.py --interval 3600
+          python pricing_insights.py --once
+"""
+
+
+WINDOW_DAYS = int(os.getenv("PRICING_WINDOW_DAYS", "365"))
+MIN_SAMPLES = int(os.getenv("PRICING_MIN_SAMPLES", "5"))
+PRICE_KINDS = ("buynow", "highest_bid", "suggestion")
+# Only one refresh runs at a time, a second one skips its turn.
+REFRESH_LOCK_ID = 42
+
+
+def compute_price_rollups(cursor):
+    """
+    Recompute all price rollups in the running transaction. Returns the number of rollup rows.
+    """
+    cursor.execute("""
+                   WITH recent_listings AS (
+                       SELECT id, category_id FROM listings
+                       WHERE category_id IS NOT NULL
+                       AND created_at > now() - make_interval(days => %(window_days)s)
+                   ),
+                   prices AS (
+                       SELECT recent_listings.id AS listing_id, recent_listings.category_id,
+                              'buynow' AS price_kind, buynow.price
+                       FROM listing_buynow_attributes AS buynow
+                       INNER JOIN recent_listings ON recent_listings.id = buynow.listing_id
+                       UNION ALL
+                       SELECT recent_listings.id, recent_listings.category_id,
+                              'highest_bid', max(bids.bid_value)
+                       FROM listing_bids AS bids
+                       INNER JOIN recent_listings ON recent_listings.id = bids.listing_id
+                       GROUP BY recent_listings.id, recent_listings.category_id
+                       UNION ALL
+                       SELECT recent_listings.id, recent_listings.category_id,
+                              'suggestion', suggestions.suggested_price
+                       FROM listing_price_suggestions AS suggestions
+                       INNER JOIN recent_listings ON recent_listings.id = suggestions.listing_id
+                   ),
+                   percentiles AS (
+                       SELECT category_id, 0 AS category_filter_option_id, price_kind,
+                              count(*) AS sample_count,
+                              percentile_cont(ARRAY[0.1, 0.25, 0.5, 0.75, 0.9])
+                                  WITHIN GROUP (ORDER BY price::float8) AS p
+                       FROM prices
+                       GROUP BY category_id, price_kind
+                       UNION ALL
+                       SELECT prices.category_id, attributes.category_filter_option_id, prices.price_kind,
+                              count(*),
+                              percentile_cont(ARRAY[0.1, 0.25, 0.5, 0.75, 0.9])
+                                  WITHIN GROUP (ORDER BY prices.price::float8)
+                       FROM prices
+                       INNER JOIN listing_attributes AS attributes
+                       ON attributes.listing_id = prices.listing_id
+                       GROUP BY prices.category_id, attributes.category_filter_option_id, prices.price_kind
+                   )
+                   INSERT INTO listing_price_rollups(
+                       category_id, category_filter_option_id, price_kind, sample_count,
+                       p10, p25, p50, p75, p90, computed_at
+                   )
+                   SELECT category_id, category_filter_option_id, price_kind, sample_count,
+                          round(p[1]::numeric, 2), round(p[2]::numeric, 2), round(p[3]::numeric, 2),
+                          round(p[4]::numeric, 2), round(p[5]::numeric, 2), now()
+                   FROM percentiles
+                   ON CONFLICT (category_id, category_filter_option_id, price_kind) DO UPDATE SET
+                       sample_count = EXCLUDED.sample_count,
+                       p10 = EXCLUDED.p10,
+                       p25 = EXCLUDED.p25,
+                       p50 = EXCLUDED.p50,
+                       p75 = EXCLUDED.p75,
+                       p90 = EXCLUDED.p90,
+                       computed_at = EXCLUDED.computed_at;
+                   """, {"window_days": WINDOW_DAYS})
+    rollups = cursor.rowcount
+    delete_unrefreshed(cursor, "listing_price_rollups")
+    return rollups
+
+
+def refresh_price_rollups(connection):
+    """
+    Recompute all price rollups. Returns the number of rollup rows, or None when
+    another refresh was already running.
+    """
+    return refresh_locked(connection, REFRESH_LOCK_ID, compute_price_rollups)
+
+
+def choose_rollups(rows, min_samples=MIN_SAMPLES):
+    """
+    From the rollup rows of one category (the category itself and some filter options),
+    pick per price kind the option rollup with the most samples, if it has at least
+    min_samples, and the category rollup otherwise.
+    Returns {price_kind: row}, kinds without any rollup are left out.
+    """
+    chosen = {}
+    for kind in PRICE_KINDS:
+        kind_rows = [row for row in rows if row["price_kind"] == kind]
+        options = [row for row in kind_rows if row["category_filter_option_id"] != 0
+                   and row["sample_count"] >= min_samples]
+        category = [row for row in kind_rows if row["category_filter_option_id"] == 0]
+        if options:
+            chosen[kind] = max(options, key=lambda row: row["sample_count"])
+        elif category:
+            chosen[kind] = category[0]
+    return chosen
+
+
+def suggest_price(chosen):
+    """
+    The median asking price, or the median highest bid when there are no buy-now prices.
+    """
+    for kind in ("buynow", "highest_bid"):
+        if kind in chosen:
+            return chosen[kind]["p50"]
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the price percentile rollups.")
+    parser.add_argument("--interval", type=int, default=3600, help="Seconds between refreshes.")
+    parser.add_argument("--once", action="store_true", help="Refresh once and stop.")
+    args = parser.parse_args()
+
+    run_refresher("pricing", compute_price_rollups, REFRESH_LOCK_ID, args.interval, once=args.once,
+                  counter="rollups_written")
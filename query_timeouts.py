@@ -0,0 +1,162 @@
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from starlette.concurrency import run_in_threadpool
+
+from db_setup import QUERY_TIMEOUTS, parse_timeouts
+
+"""
+Database time budgets per route, and cancellation of queries whose client went away.
+
+Every connection an endpoint borrows gets the route's statement_timeout and lock_timeout
+(see db_setup.PreparingConnection.set_timeouts), so a slow query or a query stuck behind
+a lock gives its thread and connection back after a bounded time. app.py turns the errors
+into responses: a statement timeout becomes 504, a lock timeout 503 with Retry-After.
+
+Budgets are "<statement_timeout ms>/<lock_timeout ms>": DB_QUERY_TIMEOUTS for all routes
+(db_setup.py), ROUTE_TIMEOUTS below for single routes, and DB_ROUTE_TIMEOUTS to override
+those, e.g DB_ROUTE_TIMEOUTS="GET /listings/trending=500/200,POST /listings=10000/3000".
+
+QueryCancellationMiddleware reads the request body up front and then listens for the
+client disconnecting. When it does, the queries running on the connections the request
+registered (cancel_on_disconnect) are cancelled with a cancel request to Postgres.
+"""
+
+
+def _parse_route_timeouts(value):
+    routes = {}
+    for item in value.split(","):
+        route, _, timeouts = item.rpartition("=")
+        if route.strip():
+            routes[route.strip()] = parse_timeouts(timeouts.strip())
+    return routes
+
+
+# "<METHOD> <route path>": (statement_timeout ms, lock_timeout ms)
+ROUTE_TIMEOUTS = {
+    "GET /listings": (2000, 1000),
+    "GET /listings/photos": (2000, 1000),
+    "GET /listings/trending": (1000, 1000),
+    "GET /pricing-insights": (1000, 1000),
+    "POST /listings": (5000, 2000),
+    "DELETE /listing/{id}/photos": (2000, 1000),
+    "PUT /listing/{id}/photos/order": (2000, 1000),
+    **_parse_route_timeouts(os.getenv("DB_ROUTE_TIMEOUTS", "")),
+}
+SCOPE_KEY = "query_cancellation"
+
+
+def route_key(request):
+    """
+    "<METHOD> <route path>" of the route that matched the request, the raw path when none did.
+    """
+    route = request.scope.get("route")
+    return f"{request.method} {route.path if route is not None else request.url.path}"
+
+
+def for_request(request):
+    return ROUTE_TIMEOUTS.get(route_key(request), QUERY_TIMEOUTS)
+
+
+class QueryCancellation:
+    """
+    The connections a request is running queries on, cancelled together when its client disconnects.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._finished = False
+        self.cancelled = False
+
+    def add(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def discard(self, connection):
+        # Waits for a cancel in progress, so a connection is never cancelled after it went back to the pool.
+        with self._lock:
+            self._connections.discard(connection)
+
+    def finish(self):
+        with self._lock:
+            self._finished = True
+
+    def cancel(self):
+        with self._lock:
+            if self._finished:
+                return
+            self.cancelled = True
+            for connection in self._connections:
+                try:
+                    connection.cancel()
+                except psycopg2.Error:
+                    pass
+
+
+def client_disconnected(request):
+    cancellation = request.scope.get(SCOPE_KEY)
+    return cancellation is not None and cancellation.cancelled
+
+
+@contextmanager
+def cancel_on_disconnect(request, connection):
+    """
+    Cancel the query running on connection when the request's client disconnects.
+    """
+    cancellation = request.scope.get(SCOPE_KEY)
+    if cancellation is None:
+        yield connection
+        return
+    cancellation.add(connection)
+    try:
+        yield connection
+    finally:
+        cancellation.discard(connection)
+
+
+class QueryCancellationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                # The client left before sending the whole body, there is no one to answer.
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+
+        cancellation = scope[SCOPE_KEY] = QueryCancellation()
+        listener = asyncio.ensure_future(self._listen(receive, cancellation))
+        pending = [{"type": "http.request", "body": b"".join(body), "more_body": False}]
+
+        async def replay():
+            if pending:
+                return pending.pop()
+            # shield: an app that stops waiting for the disconnect mustn't stop the listener.
+            return await asyncio.shield(listener)
+
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            cancellation.finish()
+            listener.cancel()
+
+    @staticmethod
+    async def _listen(receive, cancellation):
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            # Sending the cancel requests blocks, keep it off the event loop.
+            await run_in_threadpool(cancellation.cancel)
+        return message
@@ -0,0 +1,191 @@
+import math
+import os
+import threading
+import time
+
+import metrics
+from responses import dumps
+from starlette.concurrency import run_in_threadpool
+
+"""
+Token-bucket rate limiting per client and route class.
+
+Every client (IP address) gets one bucket per route class: 'read' for GET/HEAD and
+'write' for everything else. A bucket holds up to 'burst' tokens and refills with
+'rate' tokens per second, each request takes one token, and a request that finds the
+bucket empty gets 429 Too Many Requests with a Retry-After header.
+
+Buckets live in a backend:
+- InMemoryBackend (default) keeps them in this process, so every worker limits on its own
+- RedisBackend keeps them in Redis, shared by all workers and servers
+  (RATE_LIMIT_BACKEND=redis, REDIS_URL=redis://..., needs the redis package). Redis is called
+  from the thread pool, and when it fails or is slower than REDIS_TIMEOUT_SECONDS the request
+  is let through and counted as rate_limit_backend_errors
+
+Limits are configured with RATE_LIMIT_READ / RATE_LIMIT_WRITE as "<rate per second>/<burst>".
+"""
+
+
+def _parse_limit(value):
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+
+RATE_LIMITS = {
+    "read": _parse_limit(os.getenv("RATE_LIMIT_READ", "20/40")),
+    "write": _parse_limit(os.getenv("RATE_LIMIT_WRITE", "5/10")),
+}
+EXEMPT_PATHS = {"/metrics", "/health/live", "/health/ready"}
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "0") == "1"
+# Number of trusted proxies in front of the API, each appends one X-Forwarded-For address.
+FORWARDED_FOR_HOPS = int(os.getenv("FORWARDED_FOR_HOPS", "1"))
+REDIS_TIMEOUT_SECONDS = float(os.getenv("REDIS_TIMEOUT_SECONDS", "0.2"))
+
+
+class InMemoryBackend:
+    """
+    Buckets in a dict in this process. Idle buckets are dropped now and then.
+    """
+
+    # take() doesn't block, the middleware calls it on the event loop.
+    blocking = False
+
+    def __init__(self, cleanup_every_seconds=60):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._cleanup_every_seconds = cleanup_every_seconds
+        self._cleaned_at = time.monotonic()
+
+    def take(self, key, rate, burst):
+        """
+        Take one token from the bucket. Returns (allowed, retry_after_seconds).
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if now - self._cleaned_at > self._cleanup_every_seconds:
+                self._cleanup(now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def _cleanup(self, now):
+        # A bucket that has been idle long enough to refill completely is the same as no bucket.
+        self._buckets = {
+            key: (tokens, updated_at) for key, (tokens, updated_at) in self._buckets.items()
+            if now - updated_at < self._cleanup_every_seconds
+        }
+        self._cleaned_at = now
+
+
+class RedisBackend:
+    """
+    Buckets in Redis, updated atomically by a Lua script.
+    """
+
+    SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or ARGV[2])
+    local updated_at = tonumber(redis.call('HGET', KEYS[1], 'updated_at') or ARGV[3])
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    # take() is a network round trip, the middleware runs it in the thread pool.
+    blocking = True
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=REDIS_TIMEOUT_SECONDS,
+                                            socket_connect_timeout=REDIS_TIMEOUT_SECONDS)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._errors = redis.RedisError
+
+    def take(self, key, rate, burst):
+        """
+        Like InMemoryBackend.take, but lets the request through when Redis fails.
+        """
+        try:
+            allowed, tokens = self._script(keys=[f"rate_limit:{key}"], args=[rate, burst, time.time()])
+        except self._errors:
+            metrics.increment("rate_limit_backend_errors", backend="redis")
+            return True, 0.0
+        tokens = float(tokens)
+        return bool(allowed), 0.0 if allowed else (1 - tokens) / rate
+
+
+def create_backend():
+    if os.getenv("RATE_LIMIT_BACKEND", "memory") == "redis":
+        return RedisBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    return InMemoryBackend()
+
+
+def client_id(scope):
+    """
+    The client's IP address. Behind trusted proxies (TRUST_FORWARDED_FOR) it is the X-Forwarded-For
+    address FORWARDED_FOR_HOPS from the right: the one the outermost trusted proxy appended.
+    Addresses further left are sent by the client and can be anything.
+    """
+    if TRUST_FORWARDED_FOR:
+        addresses = [
+            address.strip()
+            for name, value in scope["headers"] if name == b"x-forwarded-for"
+            for address in value.decode("latin-1").split(",") if address.strip()
+        ]
+        if len(addresses) >= FORWARDED_FOR_HOPS:
+            return addresses[-FORWARDED_FOR_HOPS]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def route_class(method):
+    return "read" if method in ("GET", "HEAD") else "write"
+
+
+async def send_json_error(send, status_code, detail, retry_after):
+    body = dumps({"detail": detail})
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, backend=None, limits=None):
+        self.app = app
+        self.backend = backend or create_backend()
+        self.limits = limits or RATE_LIMITS
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        kind = route_class(scope["method"])
+        rate, burst = self.limits[kind]
+        key = f"{client_id(scope)}:{kind}"
+        if self.backend.blocking:
+            allowed, retry_after = await run_in_threadpool(self.backend.take, key, rate, burst)
+        else:
+            allowed, retry_after = self.backend.take(key, rate, burst)
+        if not allowed:
+            metrics.increment("rate_limited_requests", route_class=kind)
+            await send_json_error(send, 429, "Too many requests", retry_after)
+            return
+        await self.app(scope, receive, send)
@@ -0,0 +1,156 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+import db_setup
+import metrics
+
+"""
+Routing of reads to streaming replicas.
+
+GET/HEAD requests read from one of the replicas in DATABASE_REPLICAS, everything else
+goes to the primary. Without replicas configured everything goes to the primary.
+
+- Read your writes: a write sets the 'read_primary_until' cookie, and for STICKY_SECONDS
+  after that the client's reads go to the primary as well. Keep it above REPLICA_MAX_LAG_SECONDS.
+- Health: a monitor thread checks every replica each REPLICA_CHECK_INTERVAL_SECONDS.
+  A replica that can't be reached, is not in recovery (e.g promoted) or lags behind more than
+  REPLICA_MAX_LAG_SECONDS gets no reads until a later check finds it healthy again.
+- Failover: when no replica is healthy, or connecting to the chosen one fails, the read
+  goes to the primary.
+"""
+
+
+STICKY_SECONDS = int(os.getenv("STICKY_SECONDS", "10"))
+STICKY_COOKIE = "read_primary_until"
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_INTERVAL_SECONDS = float(os.getenv("REPLICA_CHECK_INTERVAL_SECONDS", "2"))
+
+# Seconds since the last replayed transaction, or 0 when everything received has been replayed
+# (an idle primary sends no transactions, so the replay timestamp alone would look like lag).
+REPLICA_STATUS_QUERY = """
+    SELECT pg_is_in_recovery() AS in_recovery,
+           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END AS lag_seconds;
+"""
+
+_healthy = set()
+_healthy_lock = threading.Lock()
+_round_robin = itertools.count()
+_monitor_thread = None
+_monitor_stop = threading.Event()
+
+
+def _set_health(pool, healthy):
+    with _healthy_lock:
+        if healthy:
+            _healthy.add(pool.name)
+        else:
+            _healthy.discard(pool.name)
+
+
+def healthy_replicas():
+    with _healthy_lock:
+        return [pool for pool in db_setup.replica_pools if pool.name in _healthy]
+
+
+def check_replica(pool):
+    """
+    Check one replica and update its health. Returns its lag in seconds, or None when unreachable.
+    """
+    try:
+        with pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(REPLICA_STATUS_QUERY)
+                in_recovery, lag_seconds = cursor.fetchone()
+    except (PoolError, psycopg2.Error):
+        metrics.increment("replica_check_failures", replica=pool.name)
+        _set_health(pool, False)
+        return None
+    lag_seconds = float(lag_seconds)
+    metrics.observe("replica_lag_seconds", lag_seconds, replica=pool.name)
+    _set_health(pool, in_recovery and lag_seconds <= REPLICA_MAX_LAG_SECONDS)
+    return lag_seconds
+
+
+def _monitor_replicas():
+    while not _monitor_stop.is_set():
+        for pool in db_setup.replica_pools:
+            check_replica(pool)
+        _monitor_stop.wait(REPLICA_CHECK_INTERVAL_SECONDS)
+
+
+def start_monitor():
+    """
+    Start the background thread that checks replica health and lag.
+    """
+    global _monitor_thread
+    if not db_setup.replica_pools or (_monitor_thread is not None and _monitor_thread.is_alive()):
+        return
+    _monitor_stop.clear()
+    _monitor_thread = threading.Thread(target=_monitor_replicas, name="replica-monitor", daemon=True)
+    _monitor_thread.start()
+
+
+def stop_monitor():
+    """
+    Stop the background monitor thread.
+    """
+    _monitor_stop.set()
+    if _monitor_thread is not None:
+        _monitor_thread.join(timeout=REPLICA_CHECK_INTERVAL_SECONDS + 1)
+
+
+def stick_to_primary(response):
+    """
+    Send the client's reads to the primary for the next STICKY_SECONDS, call this on writes.
+    """
+    until = int(time.time()) + STICKY_SECONDS
+    response.set_cookie(STICKY_COOKIE, str(until), max_age=STICKY_SECONDS, httponly=True, samesite="lax")
+
+
+def is_sticky(request):
+    try:
+        return int(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def choose_replica():
+    """
+    Pick the next healthy replica round robin, or None.
+    """
+    replicas = healthy_replicas()
+    if not replicas:
+        return None
+    return replicas[next(_round_robin) % len(replicas)]
+
+
+@contextmanager
+def read_connection(request=None, query_timeouts=None):
+    """
+    Lend a connection for reading: a healthy replica when there is one and the client
+    has not written recently, the primary otherwise. query_timeouts as in DatabasePool.connection.
+    """
+    with ExitStack() as stack:
+        connection = None
+        pool = None if request is not None and is_sticky(request) else choose_replica()
+        if pool is not None:
+            try:
+                connection = stack.enter_context(pool.connection(query_timeouts=query_timeouts))
+            except psycopg2.OperationalError:
+                _set_health(pool, False)
+                metrics.increment("replica_failovers", replica=pool.name)
+            except PoolError:
+                metrics.increment("replica_failovers", replica=pool.name)
+        if connection is None:
+            pool = db_setup.primary_pool
+            connection = stack.enter_context(pool.connection(query_timeouts=query_timeouts))
+        metrics.increment("read_connections", pool=pool.name)
+        yield connection
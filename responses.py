@@ -0,0 +1,45 @@
+import ipaddress
+from datetime import timedelta
+from decimal import Decimal
+
+import orjson
+from fastapi.responses import JSONResponse, Response
+
+"""
+Response classes for the fast JSON path.
+
+- FastJSONResponse serializes with orjson, which handles datetime natively. NUMERIC (Decimal),
+INET (ipaddress) and INTERVAL (timedelta) values are handled by _default.
+- RawJSONResponse sends JSON that Postgres already built (see the *_json functions in db.py)
+without decoding or re-encoding it.
+
+Returning one of these from an endpoint skips FastAPI's jsonable_encoder.
+"""
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (ipaddress.IPv4Address, ipaddress.IPv6Address,
+                          ipaddress.IPv4Network, ipaddress.IPv6Network,
+                          ipaddress.IPv4Interface, ipaddress.IPv6Interface)):
+        return str(value)
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, memoryview):
+        return bytes(value).decode()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content):
+    """Serialize content to JSON bytes."""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+
+class RawJSONResponse(Response):
+    media_type = "application/json"
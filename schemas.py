@@ -1,5 +1,6 @@
-from datetime import date
-from pydantic import BaseModel, Field, EmailStr
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from pydantic import BaseModel, Field, EmailStr, model_validator
 
 
 # Geographical
@@ -18,8 +19,7 @@ class UserCreate(BaseModel):
     username: str = Field(..., max_length=50)
     email: EmailStr = Field(..., max_length=200)
 
-class UserDetailsCreate(BaseModel):
-    user_id: int = Field(...,)
+class UserDetailsUpdate(BaseModel):
     first_name: str = Field(max_length=100)
     last_name: str = Field(max_length=100)
     phone: int
@@ -29,11 +29,18 @@ class UserDetailsCreate(BaseModel):
     country_id: int
     is_company: bool
 
+class UserDetailsCreate(UserDetailsUpdate):
+    user_id: int = Field(...,)
+
+class SavedListingCreate(BaseModel):
+    listing_id: int
+
 class NewsletterFrequencyOptionCreate(BaseModel):
     title: str = Field(..., max_length=200)
+    send_interval: timedelta = timedelta(days=7)
+    starts_after: timedelta = timedelta(0)
 
-class UserNotificationSettingsCreate(BaseModel):
-    user_id: int
+class UserNotificationSettingsUpdate(BaseModel):
     upon_new_device_login: bool
     copy_read_messages: bool
     favorites_list_updates: bool
@@ -43,3 +50,66 @@ class UserNotificationSettingsCreate(BaseModel):
     other_companies_promotions: bool
     newsletters: bool
     newsletter_frequency_id: int
+
+class UserNotificationSettingsCreate(UserNotificationSettingsUpdate):
+    user_id: int
+
+
+# Listings
+
+class ListingAuctionAttributesCreate(BaseModel):
+    starting_price: Decimal = Field(..., ge=0)
+    auction_deadline_datetime: datetime
+    auto_republish: bool = False
+    minimum_price: Decimal | None = Field(None, ge=0)
+    storage_location: str | None = None
+    charity_id: int | None = None
+    share_info_upon_donation: bool = False
+
+class ListingBuyNowAttributesCreate(BaseModel):
+    price: Decimal = Field(..., ge=0)
+    auto_republish: bool = False
+    storage_location: str | None = None
+    charity_id: int | None = None
+    share_info_upon_donation: bool = False
+
+class ListingShippingSettingsCreate(BaseModel):
+    shipping_company_id: int | None = None
+    user_shipping_cost: Decimal | None = Field(None, ge=0)
+    packaging_fee: Decimal | None = Field(None, ge=0)
+    product_weight_id: int
+    product_size_id: int | None = None
+    shipping_range_id: int | None = None
+
+class ListingPhotoCreate(BaseModel):
+    url: str
+    view_order: int | None = None
+
+class ListingCreate(BaseModel):
+    user_id: int
+    title: str = Field(..., min_length=1)
+    description: str | None = None
+    pickup_available: bool = False
+    buyer_insurance: bool = True
+    type_id: int
+    status_id: int = 1
+    category_id: int
+    auction: ListingAuctionAttributesCreate | None = None
+    buy_now: ListingBuyNowAttributesCreate | None = None
+    shipping: ListingShippingSettingsCreate | None = None
+    category_filter_option_ids: list[int] = Field([], max_length=50)
+    photos: list[ListingPhotoCreate] = Field([], max_length=50)
+
+    @model_validator(mode="after")
+    def check_sale_attributes(self):
+        if self.auction is None and self.buy_now is None:
+            raise ValueError("A listing needs auction or buy_now attributes, or both")
+        return self
+
+class ListingPhotosDelete(BaseModel):
+    user_id: int
+    photo_ids: list[int] = Field(..., min_length=1, max_length=100)
+
+class ListingPhotosReorder(BaseModel):
+    user_id: int
+    photo_ids: list[int] = Field(..., min_length=1, max_length=100)
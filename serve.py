@@ -0,0 +1,46 @@
+import argparse
+import os
+
+import uvicorn
+
+"""
+Production entry point: runs the API in several uvicorn worker processes.
+
+python serve.py --workers 4 --port 8000
+
+- Workers default to WEB_CONCURRENCY, or the number of CPU cores
+- Every worker is its own process with its own connection pools, shipping matrix and metrics.
+  Together they open up to workers * POOL_MAX_SIZE connections per database server,
+  keep that below Postgres' max_connections
+- Every worker warms up in the app's lifespan (pools, prepared statements, reference data)
+  before it takes traffic, point the load balancer's readiness check at /health/ready
+- On SIGTERM/SIGINT workers stop accepting connections, finish the requests in progress
+  for up to --graceful-timeout seconds, and then close their pools
+"""
+
+
+def default_workers():
+    return int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the API with multiple worker processes.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="Seconds to let requests in progress finish on shutdown.")
+    parser.add_argument("--keep-alive", type=int, default=int(os.getenv("KEEP_ALIVE", "5")),
+                        help="Seconds to keep idle client connections open.")
+    args = parser.parse_args()
+
+    uvicorn.run(
+        "app:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        timeout_keep_alive=args.keep_alive,
+        proxy_headers=True,
+        access_log=False,
+    )
@@ -0,0 +1,209 @@
+import select
+import threading
+import time
+from decimal import Decimal
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from db_setup import get_connection
+
+"""
+In-memory shipping cost matrix used to quote shipping without joining the
+shipping tables on every request.
+
+The matrix is loaded once from estimated_shipping_costs, shipping_companies,
+product_weight_options, product_size_options and shipping_ranges. The tables
+have triggers (see create_table_queries.py) that send a NOTIFY on the
+'shipping_matrix_changed' channel, and a listener thread reloads the matrix
+when that happens.
+"""
+
+
+SHIPPING_MATRIX_CHANNEL = "shipping_matrix_changed"
+LISTENER_POLL_SECONDS = 5
+LISTENER_RETRY_SECONDS = 10
+
+
+class ShippingMatrix:
+    """
+    Snapshot of the shipping reference tables.
+    A new snapshot replaces the old one as a whole, so readers never see a half loaded matrix.
+    """
+
+    def __init__(self, companies, weights, sizes, ranges, costs):
+        self.companies = companies
+        self.weights = weights
+        self.sizes = sizes
+        self.ranges = ranges
+        # {product_weight_id: [(shipping_company_id, estimated_cost), ...]}
+        self.costs = costs
+
+
+_matrix = None
+_matrix_lock = threading.Lock()
+_listener_thread = None
+_listener_stop = threading.Event()
+
+
+def load_shipping_matrix(connection):
+    """
+    Read all shipping reference tables and build a new ShippingMatrix.
+    """
+    with connection.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("""SELECT id, title FROM shipping_companies;""")
+        companies = {row["id"]: row["title"] for row in cursor.fetchall()}
+
+        cursor.execute("""SELECT id, weight FROM product_weight_options;""")
+        weights = {row["id"]: row["weight"] for row in cursor.fetchall()}
+
+        cursor.execute("""SELECT id, size FROM product_size_options;""")
+        sizes = {row["id"]: row["size"] for row in cursor.fetchall()}
+
+        cursor.execute("""SELECT id, range_title FROM shipping_ranges;""")
+        ranges = {row["id"]: row["range_title"] for row in cursor.fetchall()}
+
+        cursor.execute("""SELECT shipping_company_id, product_weight_id, estimated_cost
+                          FROM estimated_shipping_costs;""")
+        costs = {}
+        for row in cursor.fetchall():
+            costs.setdefault(row["product_weight_id"], []).append(
+                (row["shipping_company_id"], row["estimated_cost"])
+            )
+    return ShippingMatrix(companies, weights, sizes, ranges, costs)
+
+
+def refresh_shipping_matrix():
+    """
+    Reload the matrix from the database and swap it in.
+    """
+    global _matrix
+    connection = get_connection()
+    try:
+        with connection:
+            new_matrix = load_shipping_matrix(connection)
+    finally:
+        connection.close()
+    with _matrix_lock:
+        _matrix = new_matrix
+    return new_matrix
+
+
+def get_shipping_matrix():
+    """
+    Return the current matrix, loading it on first use.
+    """
+    matrix = _matrix
+    if matrix is None:
+        with _matrix_lock:
+            matrix = _matrix
+        if matrix is None:
+            matrix = refresh_shipping_matrix()
+    return matrix
+
+
+def invalidate_shipping_matrix():
+    """
+    Drop the current matrix so the next quote reloads it.
+    """
+    global _matrix
+    with _matrix_lock:
+        _matrix = None
+
+
+def _listen_for_changes():
+    """
+    Keep a LISTEN connection open and reload the matrix on every notification.
+    If the connection is lost the matrix is invalidated and the listener reconnects.
+    """
+    while not _listener_stop.is_set():
+        try:
+            connection = get_connection()
+        except psycopg2.OperationalError:
+            _listener_stop.wait(LISTENER_RETRY_SECONDS)
+            continue
+        try:
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {SHIPPING_MATRIX_CHANNEL};")
+            # Changes made while we were not listening are picked up by a fresh load.
+            invalidate_shipping_matrix()
+            while not _listener_stop.is_set():
+                if select.select([connection], [], [], LISTENER_POLL_SECONDS) == ([], [], []):
+                    continue
+                connection.poll()
+                if connection.notifies:
+                    connection.notifies.clear()
+                    refresh_shipping_matrix()
+        except psycopg2.Error:
+            invalidate_shipping_matrix()
+            _listener_stop.wait(LISTENER_RETRY_SECONDS)
+        finally:
+            connection.close()
+
+
+def start_listener():
+    """
+    Start the background thread that keeps the matrix in sync with the database.
+    """
+    global _listener_thread
+    if _listener_thread is not None and _listener_thread.is_alive():
+        return
+    _listener_stop.clear()
+    _listener_thread = threading.Thread(
+        target=_listen_for_changes, name="shipping-matrix-listener", daemon=True
+    )
+    _listener_thread.start()
+
+
+def stop_listener():
+    """
+    Stop the background listener thread.
+    """
+    _listener_stop.set()
+    if _listener_thread is not None:
+        _listener_thread.join(timeout=LISTENER_POLL_SECONDS + 1)
+
+
+def quote_shipping(product_weight_id, product_size_id=None, shipping_range_id=None,
+                   packaging_fee=None, seller_company_id=None, user_shipping_cost=None):
+    """
+    Return shipping options for the given weight, cheapest first.
+
+    Estimated costs only vary by carrier and weight, size and range are validated
+    against the matrix and echoed back. If the seller has chosen a carrier with their own
+    shipping cost, that cost replaces the estimate for that carrier.
+    Raises LookupError when an id does not exist.
+    """
+    matrix = get_shipping_matrix()
+    if product_weight_id not in matrix.weights:
+        raise LookupError("Product weight not found")
+    if product_size_id is not None and product_size_id not in matrix.sizes:
+        raise LookupError("Product size not found")
+    if shipping_range_id is not None and shipping_range_id not in matrix.ranges:
+        raise LookupError("Shipping range not found")
+
+    packaging_fee = packaging_fee or Decimal(0)
+    options = []
+    carriers = dict(matrix.costs.get(product_weight_id, []))
+    if seller_company_id is not None and user_shipping_cost is not None:
+        carriers[seller_company_id] = user_shipping_cost
+    for company_id, shipping_cost in carriers.items():
+        options.append({
+            "shipping_company_id": company_id,
+            "shipping_company_title": matrix.companies.get(company_id),
+            "shipping_cost": shipping_cost,
+            "packaging_fee": packaging_fee,
+            "total_cost": shipping_cost + packaging_fee,
+            "seller_choice": company_id == seller_company_id,
+        })
+    options.sort(key=lambda option: (option["total_cost"], not option["seller_choice"]))
+    return {
+        "product_weight_id": product_weight_id,
+        "weight": matrix.weights[product_weight_id],
+        "product_size_id": product_size_id,
+        "size": matrix.sizes.get(product_size_id),
+        "shipping_range_id": shipping_range_id,
+        "range_title": matrix.ranges.get(shipping_range_id),
+        "options": options,
+    }
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+"""
+Request coalescing for hot keys.
+
+SingleFlight.do(key, function) runs function() once for all callers that ask for the same key
+at the same time: the first caller (the leader) runs it, the others wait for it and get the
+same result, or the same exception. With reuse_seconds the result is also handed to callers
+that arrive within that many seconds after it was loaded, without running anything.
+
+Metrics (see metrics.py), labelled with the group name:
+- single_flight_loads: function() calls
+- single_flight_shared: callers that waited for a leader instead of loading themselves
+- single_flight_reused: callers served from a reused result
+The keys that saved the most loads are kept per group, see hot_keys().
+"""
+
+
+MAX_TRACKED_KEYS = 1000
+MAX_REUSED_RESULTS = 10000
+
+_groups = []
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, name, reuse_seconds=0.0):
+        self.name = name
+        self.reuse_seconds = reuse_seconds
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = {}
+        self.saved = Counter()
+        _groups.append(self)
+
+    def _count_saved(self, key, kind):
+        metrics.increment(f"single_flight_{kind}", group=self.name)
+        with self._lock:
+            self.saved[key] += 1
+            if len(self.saved) > 2 * MAX_TRACKED_KEYS:
+                self.saved = Counter(dict(self.saved.most_common(MAX_TRACKED_KEYS)))
+
+    def _reuse(self, key, now):
+        entry = self._results.get(key)
+        if entry is not None and entry[0] > now:
+            return entry
+        return None
+
+    def do(self, key, function):
+        with self._lock:
+            reused = self._reuse(key, time.monotonic()) if self.reuse_seconds else None
+            call = self._calls.get(key)
+            leader = reused is None and call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if reused is not None:
+            self._count_saved(key, "reused")
+            return reused[1]
+        if not leader:
+            call.done.wait()
+            self._count_saved(key, "shared")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.increment("single_flight_loads", group=self.name)
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if self.reuse_seconds and call.error is None:
+                    now = time.monotonic()
+                    if len(self._results) >= MAX_REUSED_RESULTS:
+                        self._results = {k: v for k, v in self._results.items() if v[0] > now}
+                    self._results[key] = (now + self.reuse_seconds, call.result)
+            call.done.set()
+        return call.result
+
+    def hot_keys(self, top=20):
+        with self._lock:
+            return [{"key": str(key), "saved_loads": count} for key, count in self.saved.most_common(top)]
+
+
+def hot_keys(top=20):
+    """
+    The keys that saved the most loads, per group.
+    """
+    return {group.name: group.hot_keys(top) for group in _groups}
@@ -0,0 +1,94 @@
+import argparse
+import math
+import os
+
+from jobs import delete_unrefreshed, refresh_locked, run_refresher
+
+"""
+Background job that keeps listing_trending_scores up to date for GET /listings/trending.
+
+Every refresh scores each listing by its recent activity: every view, bid and save within
+TRENDING_WINDOW_DAYS counts with its weight, halved for every TRENDING_HALF_LIFE_HOURS of age.
+All scores are replaced in one transaction, so readers keep seeing the previous scores until
+the new ones are committed and are never blocked. Listings without recent activity or that
+were soft deleted drop out of the table.
+
+Run with: python trending.py --interval 300
+          python trending.py --once
+"""
+
+
+VIEW_WEIGHT = float(os.getenv("TRENDING_VIEW_WEIGHT", "1"))
+BID_WEIGHT = float(os.getenv("TRENDING_BID_WEIGHT", "5"))
+SAVE_WEIGHT = float(os.getenv("TRENDING_SAVE_WEIGHT", "3"))
+HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "24"))
+WINDOW_DAYS = int(os.getenv("TRENDING_WINDOW_DAYS", "7"))
+# Only one refresh runs at a time, a second one skips its turn.
+REFRESH_LOCK_ID = 41
+
+
+def score_listings(cursor):
+    """
+    Recompute all trending scores in the running transaction. Returns the number of scored listings.
+    """
+    decay_per_second = math.log(2) / (HALF_LIFE_HOURS * 3600)
+    cursor.execute("""
+                   WITH events AS (
+                       SELECT listing_id, 'view' AS kind, %(view_weight)s AS weight, viewed_at AS happened_at
+                       FROM listing_views
+                       WHERE viewed_at > now() - make_interval(days => %(window_days)s)
+                       UNION ALL
+                       SELECT listing_id, 'bid', %(bid_weight)s, bid_at
+                       FROM listing_bids
+                       WHERE bid_at > now() - make_interval(days => %(window_days)s)
+                       UNION ALL
+                       SELECT listing_id, 'save', %(save_weight)s, saved_at
+                       FROM user_saved_listings
+                       WHERE saved_at > now() - make_interval(days => %(window_days)s)
+                   )
+                   INSERT INTO listing_trending_scores(
+                       listing_id, category_id, score, views, bids, saves, computed_at
+                   )
+                   SELECT listings.id, listings.category_id,
+                          sum(events.weight * exp(-%(decay)s * extract(epoch FROM now() - events.happened_at))),
+                          count(*) FILTER (WHERE events.kind = 'view'),
+                          count(*) FILTER (WHERE events.kind = 'bid'),
+                          count(*) FILTER (WHERE events.kind = 'save'),
+                          now()
+                   FROM events
+                   INNER JOIN listings ON listings.id = events.listing_id
+                   WHERE NOT listings.soft_deleted
+                   GROUP BY listings.id, listings.category_id
+                   ON CONFLICT (listing_id) DO UPDATE SET
+                       category_id = EXCLUDED.category_id,
+                       score = EXCLUDED.score,
+                       views = EXCLUDED.views,
+                       bids = EXCLUDED.bids,
+                       saves = EXCLUDED.saves,
+                       computed_at = EXCLUDED.computed_at;
+                   """, {
+                       "view_weight": VIEW_WEIGHT, "bid_weight": BID_WEIGHT,
+                       "save_weight": SAVE_WEIGHT, "window_days": WINDOW_DAYS,
+                       "decay": decay_per_second,
+                   })
+    scored = cursor.rowcount
+    delete_unrefreshed(cursor, "listing_trending_scores")
+    return scored
+
+
+def refresh_trending_scores(connection):
+    """
+    Recompute all trending scores. Returns the number of scored listings, or None when
+    another refresh was already running.
+    """
+    return refresh_locked(connection, REFRESH_LOCK_ID, score_listings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the trending listing scores.")
+    parser.add_argument("--interval", type=int, default=300, help="Seconds between refreshes.")
+    parser.add_argument("--once", action="store_true", help="Refresh once and stop.")
+    args = parser.parse_args()
+
+    run_refresher("trending", score_listings, REFRESH_LOCK_ID, args.interval, once=args.once,
+                  counter="listings_scored")